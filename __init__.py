@@ -2,24 +2,29 @@ bl_info = {
     "name": "Spiralizer",
     "author": "Raffael Mancini",
     "version": (0, 1),
-    "blender": (2, 80, 0),
+    "blender": (3, 2, 0),
     "location": "View3D > Tools > Spiralizer",
     "description": "Creates a spiral mesh along a manifold object to be exported as G-Code",
     "category": "Object"
 }
 
-import bpy
+try:
+    import bpy
+except ImportError:
+    # Imported without Blender, e.g. by slicing worker processes. Only the bpy-free modules are usable.
+    bpy = None
 
-from . import slice, spiralize, export, ui
+if bpy is not None:
+    from . import slice, spiralize, export, ui
+
+    classes = [
+        slice.SliceOperator,
+        spiralize.SpiralizeOperator,
+        export.GcodeExportOperator,
+        ui.SlicePanel,
+        ui.spiralizer_settings
+    ]
 
-classes = [
-    slice.SliceOperator,
-    spiralize.SpiralizeOperator,
-    export.GcodeExportOperator,
-    ui.SlicePanel,
-    ui.spiralizer_settings
-]
-    
 def register():
     for cls in classes:
         bpy.utils.register_class(cls)
@@ -0,0 +1,145 @@
+"""
+Replaces runs of g-code moves that lie on a helix, within a tolerance, by G2/G3 arcs.
+"""
+import math
+
+import numpy as np
+
+G1 = 1
+G2 = 2 # clockwise seen from above
+G3 = 3 # counter-clockwise
+
+# Arcs are kept below a full turn, so their end point never coincides with their start
+MAX_SWEEP = 1.5 * math.pi
+
+# Runs of up to this many moves are tried before a move is left a G1. Circles through a few unevenly spaced
+# points are ill-conditioned, longer runs pin them down.
+SEED_MOVES = 16
+
+def circle_xy(points):
+    """
+    Center and radius of the circle through the first and the last of points in the XY plane that passes
+    the others closest (least squares), (None, None) if they are collinear.
+    """
+    xy = points[:, :2]
+    middle = (xy[0] + xy[-1]) / 2
+    chord = xy[-1] - xy[0]
+    half_sq = chord @ chord / 4
+    if half_sq == 0:
+        return None, None
+    normal = np.array((-chord[1], chord[0])) / math.sqrt(4 * half_sq)
+
+    # The center is middle + u * normal, |p - center| = |start - center| is linear in u for every point p
+    rel = xy[1:-1] - middle
+    a = np.einsum('ij,ij->i', rel, rel) - half_sq
+    b = 2 * (rel @ normal)
+    bb = b @ b
+    if bb < 1e-12:
+        return None, None
+    center = middle + (a @ b / bb) * normal
+    return center, math.hypot(*(xy[0] - center))
+
+def fit_arc(points, tolerance, max_radius):
+    """
+    Try to replace the polyline through points by one helical arc.
+    The arc has to pass all points and the middles of all segments within tolerance, turn the same way
+    all along and rise linearly with the swept angle.
+    Returns the G2/G3 code and the arc center, None if the points are no such arc.
+    """
+    center, radius = circle_xy(points)
+    if center is None or radius > max_radius:
+        return None
+
+    rel = points[:, :2] - center
+    if np.abs(np.hypot(rel[:, 0], rel[:, 1]) - radius).max() > tolerance:
+        return None
+
+    angles = np.arctan2(rel[:, 1], rel[:, 0])
+    steps = (np.diff(angles) + math.pi) % (2*math.pi) - math.pi
+    if not ((steps > 0).all() or (steps < 0).all()):
+        return None
+    sweep = steps.sum()
+    if abs(sweep) > MAX_SWEEP:
+        return None
+
+    # Sagitta between the arc and the chords it replaces
+    if (radius * (1 - np.cos(steps / 2))).max() > tolerance:
+        return None
+
+    swept = np.concatenate(([0.0], np.cumsum(steps)))
+    z_helix = points[0, 2] + (points[-1, 2] - points[0, 2]) * swept / sweep
+    if np.abs(points[:, 2] - z_helix).max() > tolerance:
+        return None
+
+    return (G3 if sweep > 0 else G2), center
+
+def fit_arcs(start, xyz, e, f, breaks=(), tolerance=0.01, max_radius=1000.0):
+    """
+    Replace runs of moves by G2/G3 arcs where they fit within tolerance.
+
+    start is the position before the first move, xyz, e and f are the targets, relative E and feed rates
+    of the moves. Arcs neither span a feed rate change nor the moves listed in breaks.
+    Returns the move codes (G1, G2, G3), targets, arc centers relative to the move start (I, J),
+    summed E and feed rates of the new moves and the new indices of the breaks.
+    """
+    move_count = len(e)
+    points = np.concatenate((np.asarray(start, dtype=np.float64).reshape(1, 3), xyz))
+
+    # A point is a boundary if arcs must not pass through it
+    boundary = np.zeros(move_count + 1, dtype=bool)
+    boundary[np.asarray(list(breaks), dtype=np.int64) + 1] = True
+    boundary[1:-1] |= f[1:] != f[:-1]
+    boundary[move_count] = True
+    next_boundary = np.flatnonzero(boundary)
+
+    codes = []
+    ends = []
+    centers = []
+    s = 0
+    while s < move_count:
+        limit = int(next_boundary[np.searchsorted(next_boundary, s, side='right')])
+
+        # Grow the arc exponentially, up to SEED_MOVES until one fits, then narrow down its end by bisection
+        ok_end, ok_fit, failed_end = None, None, None
+        length = 2
+        while s + 2 <= limit:
+            t = min(s + length, limit)
+            fit = fit_arc(points[s:t+1], tolerance, max_radius)
+            if fit is None:
+                failed_end = t
+                if ok_end is not None or length >= SEED_MOVES:
+                    break
+            else:
+                ok_end, ok_fit, failed_end = t, fit, None
+            if t == limit:
+                break
+            length *= 2
+        if ok_end is not None and failed_end is not None:
+            lo, hi = ok_end, failed_end
+            while hi - lo > 1:
+                mid = (lo + hi) // 2
+                fit = fit_arc(points[s:mid+1], tolerance, max_radius)
+                if fit is None:
+                    hi = mid
+                else:
+                    lo, ok_fit = mid, fit
+            ok_end = lo
+
+        if ok_end is None:
+            codes.append(G1)
+            ends.append(s + 1)
+            centers.append((math.nan, math.nan))
+            s += 1
+        else:
+            code, center = ok_fit
+            codes.append(code)
+            ends.append(ok_end)
+            centers.append(tuple(center - points[s, :2]))
+            s = ok_end
+
+    ends = np.array(ends, dtype=np.int64)
+    starts = np.concatenate(([0], ends[:-1]))
+    e_cum = np.concatenate(([0.0], np.cumsum(e)))
+    new_breaks = np.flatnonzero(np.isin(ends - 1, np.asarray(list(breaks), dtype=np.int64)))
+    return [np.array(codes, dtype=np.int8), points[ends], np.array(centers).reshape(-1, 2),
+            e_cum[ends] - e_cum[starts], f[ends - 1], new_breaks]
@@ -0,0 +1,3 @@
+"""
+Benchmarks of the bpy-free pipeline on synthetic meshes, run with python -m spiralizer.benchmarks.
+"""
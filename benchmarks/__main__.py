@@ -0,0 +1,174 @@
+"""
+Time slicing, spiralizing and g-code export of synthetic vases, headless and without Blender.
+
+    python -m spiralizer.benchmarks --scale small --output results.json
+    python -m spiralizer.benchmarks --scale small --update-baseline
+
+Every stage is timed on its own, best of --repeat runs, and run once more under tracemalloc for its peak
+memory. The results are written as JSON and compared with the stored baseline of the scale: the exit
+status is 1 if a stage got slower, needs more memory or writes more g-code than the baseline allows.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from .. import gcode, slicer, spiral
+from . import meshes
+
+# Per scale the cases: name, mesh generator and its arguments, layer count
+LAYER_HEIGHT = 0.1
+CASES = {
+    'small': [
+        ('cylinder', meshes.cylinder, (128, 4), 100),
+        ('sphere', meshes.uv_sphere, (64, 16), 200),
+        ('twisted', meshes.twisted_polygon, (6, 100), 150),
+    ],
+    'medium': [
+        ('cylinder', meshes.cylinder, (512, 255), 1000),
+        ('sphere', meshes.uv_sphere, (512, 256), 1000),
+        ('twisted', meshes.twisted_polygon, (64, 2047), 1000),
+    ],
+    'large': [
+        ('cylinder', meshes.cylinder, (1024, 511), 5000),
+        ('sphere', meshes.uv_sphere, (1024, 512), 5000),
+        ('twisted', meshes.twisted_polygon, (128, 4095), 5000),
+    ],
+}
+STAGES = ('slice', 'spiralize', 'export')
+BASELINE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Differences below these are noise, whatever the tolerance
+MIN_DIFFERENCE = {'seconds': 0.01, 'peak_bytes': 1 << 16, 'gcode_size': 0}
+
+def case_mesh(generator, args, layer_count):
+    "Mesh of the case, scaled to be layer_count layers high"
+    cos, tris = generator(*args)
+    cos = cos * (layer_count * LAYER_HEIGHT / cos[:, 2].max())
+    return cos, tris
+
+def run_slice(cos, tris):
+    zs = slicer.layer_zs(cos[:, 2].min(), cos[:, 2].max(), LAYER_HEIGHT)
+    return zs, slicer.slice_layers(cos, tris, zs)
+
+def run_spiralize(zs, sliced):
+    points, point_layers, _, _, loop_idxs, loop_orders, loop_signs = sliced
+    layers = spiral.LayerIndex(point_layers, loop_idxs, loop_orders, loop_signs, len(zs))
+    return spiral.spiralize_layers(points.astype(np.float32), layers, 'CW', LAYER_HEIGHT, LAYER_HEIGHT)
+
+def run_export(spiralized, path):
+    vs, _, heights, widths, material_idxs, feedrate_factors = spiralized
+    moves, _ = gcode.toolpath_moves(vs.astype(np.float32), heights.astype(np.float32), widths.astype(np.float32),
+                                    material_idxs, feedrate_factors.astype(np.float32), 0.2, 40, 10)
+    with open(path, 'w') as stream:
+        gcode.write_gcode(stream, moves, 100, 40)
+    return os.path.getsize(path)
+
+def measure(run, repeat, memory):
+    "Result of run(), its best time of repeat runs and, with memory, its peak traced memory"
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = run()
+        seconds.append(time.perf_counter() - start)
+    peak = None
+    if memory:
+        tracemalloc.start()
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, min(seconds), peak
+
+def run_case(name, generator, args, layer_count, repeat, memory):
+    cos, tris = case_mesh(generator, args, layer_count)
+    result = {'faces': len(tris), 'vertices': len(cos)}
+    with tempfile.TemporaryDirectory() as directory:
+        gcode_path = os.path.join(directory, name + '.gcode')
+        (zs, sliced), *slice_measures = measure(lambda: run_slice(cos, tris), repeat, memory)
+        spiralized, *spiralize_measures = measure(lambda: run_spiralize(zs, sliced), repeat, memory)
+        file_size, *export_measures = measure(lambda: run_export(spiralized, gcode_path), repeat, memory)
+    result['layers'] = len(zs)
+    result['points'] = len(sliced[0])
+    result['spiral_points'] = len(spiralized[0])
+    result['gcode_size'] = file_size
+    for stage, (seconds, peak) in zip(STAGES, (slice_measures, spiralize_measures, export_measures)):
+        result[stage] = {'seconds': seconds, 'peak_bytes': peak}
+    return result
+
+def regressions(results, baseline, tolerance):
+    "Messages for every measure in results that is worse than its baseline by more than tolerance"
+    messages = []
+    for name, case in baseline['cases'].items():
+        if name not in results['cases']:
+            messages.append(f"{name}: missing")
+            continue
+        current = results['cases'][name]
+        measures = [(stage, key, case[stage][key], current[stage][key])
+                    for stage in STAGES for key in ('seconds', 'peak_bytes')]
+        measures.append(("", 'gcode_size', case['gcode_size'], current['gcode_size']))
+        for stage, key, old, new in measures:
+            if old is None or new is None:
+                continue
+            if new > old * (1 + tolerance) and new - old > MIN_DIFFERENCE[key]:
+                messages.append(f"{name} {stage} {key}: {new:.4g} > {old:.4g} (+{(new / old - 1) * 100:.0f}%)")
+    return messages
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog="spiralizer.benchmarks", description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument('--scale', choices=sorted(CASES), default='small', help="Size of the meshes")
+    parser.add_argument('--cases', nargs='*', help="Only run these cases")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per stage, the best time counts")
+    parser.add_argument('--no-memory', action='store_true', help="Skip the tracemalloc runs")
+    parser.add_argument('--output', help="JSON file for the results")
+    parser.add_argument('--baseline', help="Baseline JSON file, by default baseline_<scale>.json next to this file")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="Allowed slowdown/growth, 0.25 is 25%%")
+    parser.add_argument('--update-baseline', action='store_true', help="Store the results as the baseline")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    results = {
+        'scale': args.scale,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'cases': {},
+    }
+    for name, generator, mesh_args, layer_count in CASES[args.scale]:
+        if args.cases and name not in args.cases:
+            continue
+        case = run_case(name, generator, mesh_args, layer_count, max(1, args.repeat), not args.no_memory)
+        results['cases'][name] = case
+        print(f"{name}: {case['faces']} faces, {case['layers']} layers, " +
+              ", ".join(f"{stage} {case[stage]['seconds']:.3f}s" for stage in STAGES) +
+              f", {case['gcode_size']} bytes of g-code")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    baseline_path = args.baseline or os.path.join(BASELINE_DIR, f"baseline_{args.scale}.json")
+    if args.update_baseline:
+        with open(baseline_path, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline written to {baseline_path}")
+        return 0
+    if not os.path.exists(baseline_path):
+        print(f"No baseline at {baseline_path}, nothing to compare")
+        return 0
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    if args.cases:
+        baseline['cases'] = {name: case for name, case in baseline['cases'].items() if name in args.cases}
+    messages = regressions(results, baseline, args.tolerance)
+    for message in messages:
+        print("Regression:", message)
+    return 1 if messages else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,41 @@
+"""
+Parametric closed test meshes as vertex coordinate and triangle arrays, wound counter-clockwise seen from outside.
+"""
+import numpy as np
+
+def ring_strip(rings, segments):
+    "Triangles of the side of a tube with rings+1 rings of segments vertices each"
+    j, i = np.meshgrid(np.arange(rings), np.arange(segments), indexing='ij')
+    p = j*segments + i
+    q = j*segments + (i+1) % segments
+    return np.concatenate((np.stack((p, q, q+segments), axis=-1).reshape(-1, 3),
+                           np.stack((p, q+segments, p+segments), axis=-1).reshape(-1, 3)))
+
+def capped(cos, tris, rings, segments, bottom, top):
+    "Close the tube cos/tris with a fan to the bottom and the top center"
+    center_bottom, center_top = len(cos), len(cos) + 1
+    i = np.arange(segments)
+    last = rings*segments
+    caps = np.concatenate((np.stack((np.full(segments, center_bottom), (i+1) % segments, i), axis=1),
+                           np.stack((np.full(segments, center_top), last + i, last + (i+1) % segments), axis=1)))
+    return np.vstack((cos, [bottom, top])), np.concatenate((tris, caps))
+
+def cylinder(segments, rings, radius=20.0, height=50.0):
+    "Cylinder standing on z=0, 2*segments*(rings+1) triangles"
+    return twisted_polygon(segments, rings, radius, height, twist=0.0)
+
+def twisted_polygon(sides, rings, radius=20.0, height=50.0, twist=np.pi/2):
+    "Regular polygon extruded to height while turning by twist, 2*sides*(rings+1) triangles"
+    z = np.linspace(0, height, rings+1)
+    a = np.linspace(0, 2*np.pi, sides, endpoint=False)[None, :] + twist * z[:, None] / height
+    cos = np.stack((radius*np.cos(a), radius*np.sin(a), np.repeat(z[:, None], sides, axis=1)), axis=-1).reshape(-1, 3)
+    return capped(cos, ring_strip(rings, sides), rings, sides, (0, 0, 0), (0, 0, height))
+
+def uv_sphere(segments, rings, radius=20.0):
+    "UV sphere resting on z=0, 2*segments*(rings-1) triangles"
+    polar = np.linspace(0, np.pi, rings+1)[1:-1] # rings from the bottom up, without the poles
+    a = np.linspace(0, 2*np.pi, segments, endpoint=False)
+    s, c = np.sin(polar)[:, None], np.cos(polar)[:, None]
+    cos = np.stack((radius*s*np.cos(a), radius*s*np.sin(a), radius*(1 - np.repeat(c, segments, axis=1))),
+                   axis=-1).reshape(-1, 3)
+    return capped(cos, ring_strip(rings-2, segments), rings-2, segments, (0, 0, 0), (0, 0, 2*radius))
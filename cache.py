@@ -0,0 +1,88 @@
+"""
+On-disk cache of slice, spiral and move arrays, keyed by a hash of everything they are computed from.
+"""
+import hashlib
+import json
+import os
+import zipfile
+
+import numpy as np
+
+# Part of every key, bump when a cached stage produces different arrays
+CACHE_VERSION = 6
+
+def digest(*arrays, **params):
+    "Hex digest of the contents of arrays and the values of params"
+    h = hashlib.blake2b(digest_size=20)
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        h.update(f"{array.dtype.str}{array.shape}".encode())
+        h.update(array.data)
+    h.update(json.dumps(dict(params, cache_version=CACHE_VERSION), sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+def default_directory():
+    "Per-user cache directory"
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'spiralizer')
+
+class ArrayCache:
+    """
+    Dicts of arrays stored on disk, one .npz file per key.
+    Reading an entry marks it as used, the least recently used entries are evicted once the files
+    together take more than max_bytes.
+    """
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def get(self, key):
+        "Arrays stored under key, None if there are none"
+        path = self.path(key)
+        try:
+            with np.load(path) as data:
+                arrays = {name: data[name] for name in data.files}
+            os.utime(path)
+        except (OSError, ValueError, zipfile.BadZipFile):
+            return None
+        return arrays
+
+    def put(self, key, arrays):
+        "Store the dict of arrays under key"
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(key)
+        temp_path = f"{path}.{os.getpid()}.tmp" # other processes never see half written entries
+        with open(temp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(temp_path, path)
+        self.evict()
+
+    def evict(self):
+        "Delete least recently used entries until the cache fits into max_bytes"
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.npz'):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+def from_settings(props):
+    "ArrayCache configured by spiralizer_settings props, None if caching is off"
+    if not props.use_cache:
+        return None
+    return ArrayCache(props.cache_directory or default_directory(), props.cache_size * (1 << 20))
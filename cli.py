@@ -0,0 +1,343 @@
+"""
+Slice, spiralize and export many models without the UI.
+
+    python -m spiralizer.cli --settings settings.json --output out/ vase.stl bowl.obj
+    python -m spiralizer.cli --no-blender --settings settings.json --output out/ vase.stl
+    blender -b --factory-startup --python spiralizer/cli.py -- --settings settings.json --output out/ vase.stl
+
+Run as plain Python, every model is processed by a background Blender of its own, --jobs of them at a time.
+With --no-blender the bpy-free modules process STL models in a pool of Python processes instead.
+Run inside Blender, the models are processed one after the other in that Blender.
+The settings file is a JSON object with values for the spiralizer_settings properties, start, end and
+filament change g-code may also be given as paths of text files.
+The g-code goes to the output directory next to summary.json, which lists the result of every model.
+"""
+import argparse
+import importlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from functools import partial
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from types import SimpleNamespace
+
+import numpy as np
+
+try:
+    import bpy
+except ImportError:
+    bpy = None
+
+if __name__ == '__main__' and not __package__:
+    # Run as a script, e.g. by blender --python: import the add-on as a package
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, os.path.dirname(package_dir))
+    __package__ = os.path.basename(package_dir)
+    importlib.import_module(__package__)
+
+from . import defaults
+
+# spiralizer_settings that hold the name of a text block
+TEXT_SETTINGS = ('start_gcode', 'end_gcode', 'filament_change_gcode')
+
+# spiralizer_settings that only matter inside Blender
+BLENDER_SETTINGS = ('slice_processes', 'gcode_directory')
+
+# Defaults of the spiralizer_settings used without Blender, which only exports spiral meshes
+DEFAULT_SETTINGS = dict({name: value for name, value in defaults.SETTINGS.items() if name not in BLENDER_SETTINGS},
+                        toolpath_type='MESH')
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog="spiralizer", description="Slice, spiralize and export models to g-code")
+    parser.add_argument('models', nargs='+', help="Mesh files (.stl, .obj, .ply)")
+    parser.add_argument('--settings', help="JSON file with spiralizer_settings values")
+    parser.add_argument('--output', default='.', help="Directory for the g-code and summary.json")
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help="Models processed at the same time")
+    parser.add_argument('--no-blender', action='store_true', help="Process STL models without Blender")
+    parser.add_argument('--blender', default=os.environ.get('BLENDER', 'blender'), help="Blender executable")
+    parser.add_argument('--summary', help="Where to write the summary, default is summary.json in the output directory")
+    return parser.parse_args(argv)
+
+def check_toolpath_type(settings):
+    "Only spiral meshes can be exported, batch runs reject any other toolpath type"
+    if settings.get('toolpath_type', 'MESH') != 'MESH':
+        raise ValueError(f"toolpath_type {settings['toolpath_type']} cannot be exported, batch runs use MESH")
+
+def load_settings(path):
+    if path is None:
+        return {}
+    with open(path) as f:
+        settings = json.load(f)
+    if not isinstance(settings, dict):
+        raise ValueError(f"{path}: settings must be a JSON object")
+    # Text file paths are relative to the settings file
+    for name in TEXT_SETTINGS:
+        if name in settings:
+            text_path = os.path.join(os.path.dirname(os.path.abspath(path)), settings[name])
+            if os.path.isfile(text_path):
+                settings[name] = text_path
+    return settings
+
+def write_summary(path, results):
+    with open(path, 'w') as f:
+        json.dump({'models': results,
+                   'failed': sum(1 for result in results if result.get('error'))}, f, indent=2)
+
+# Inside Blender
+
+def apply_settings(props, settings):
+    "Set the spiralizer_settings props from the settings dict, loading text files into text blocks"
+    for name, value in settings.items():
+        if name not in props.bl_rna.properties:
+            raise KeyError(f"Unknown setting {name}")
+        if name in TEXT_SETTINGS and os.path.isfile(value):
+            value = bpy.data.texts.load(value).name
+        setattr(props, name, value)
+
+def import_model(path):
+    "Import the mesh file at path and return it as the one selected and active object"
+    extension = os.path.splitext(path)[1].lower()
+    importers = {'.stl': ('wm.stl_import', 'import_mesh.stl'),
+                 '.obj': ('wm.obj_import', 'import_scene.obj'),
+                 '.ply': ('wm.ply_import', 'import_mesh.ply')}
+    if extension not in importers:
+        raise ValueError(f"Unsupported model format {extension}")
+    for op_name in importers[extension]: # newer Blender versions first
+        module, name = op_name.split('.')
+        op = getattr(getattr(bpy.ops, module), name)
+        try:
+            op.get_rna_type()
+        except KeyError:
+            continue
+        op(filepath=path)
+        break
+    else:
+        raise RuntimeError(f"No importer for {extension} in this Blender")
+
+    context = bpy.context
+    selected = [o for o in context.view_layer.objects if o.select_get() and o.type == 'MESH']
+    if not selected:
+        raise RuntimeError(f"{path} contains no mesh")
+    context.view_layer.objects.active = selected[0]
+    if len(selected) > 1:
+        bpy.ops.object.join()
+    return context.view_layer.objects.active
+
+def clear_scene():
+    for ob in list(bpy.data.objects):
+        bpy.data.objects.remove(ob)
+    if 'Results' not in bpy.data.collections:
+        bpy.context.scene.collection.children.link(bpy.data.collections.new('Results'))
+
+def run_model(path, settings, output_dir):
+    "Slice, spiralize and export one model in this Blender. Returns its summary entry."
+    from . import export, profiling
+
+    result = {'model': path}
+    timings = {}
+    try:
+        clear_scene()
+        check_toolpath_type(settings)
+        props = bpy.context.scene.spiralizer_settings
+        apply_settings(props, settings)
+        props.toolpath_type = 'MESH'
+        props.gcode_directory = os.path.join(os.path.abspath(output_dir),
+                                             os.path.splitext(os.path.basename(path))[0])
+
+        start = time.perf_counter()
+        import_model(path)
+        timings['import'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        bpy.ops.spiralizer.slice()
+        timings['slice'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        bpy.ops.spiralizer.spiralize()
+        timings['spiralize'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        with profiling.profiled('export', props.use_cprofile):
+            result['gcode'], result['stats'] = export.export_with_settings(bpy.context, props)
+        timings['export'] = time.perf_counter() - start
+    except Exception as e:
+        result['error'] = f"{type(e).__name__}: {e}"
+    result['seconds'] = timings
+    result['profile'] = {operation: report for operation, report in profiling.last_reports.items()
+                         if operation in timings}
+    return result
+
+def run_in_blender(args):
+    package = sys.modules[__package__]
+    if not hasattr(bpy.types.Scene, 'spiralizer_settings'):
+        package.register()
+    settings = load_settings(args.settings)
+    results = []
+    for path in args.models:
+        print(f"Spiralizer: {path}")
+        results.append(run_model(os.path.abspath(path), settings, args.output))
+    return results
+
+# Plain Python
+
+def run_blender(args, path):
+    "Process the model at path in a background Blender. Returns its summary entry."
+    fd, summary_path = tempfile.mkstemp(suffix='.json', dir=args.output)
+    os.close(fd)
+    command = [args.blender, '-b', '--factory-startup', '--python', os.path.abspath(__file__), '--',
+               '--output', args.output, '--summary', summary_path, os.path.abspath(path)]
+    if args.settings:
+        command[-1:-1] = ['--settings', os.path.abspath(args.settings)]
+    start = time.perf_counter()
+    try:
+        process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        try:
+            with open(summary_path) as f:
+                result = json.load(f)['models'][0]
+        except (OSError, ValueError, IndexError):
+            result = {'model': path,
+                      'error': f"Blender exited with {process.returncode}: {process.stdout[-2000:]}"}
+    except OSError as e:
+        result = {'model': path, 'error': f"Cannot run {args.blender}: {e}"}
+    finally:
+        os.remove(summary_path)
+    result['wall_seconds'] = time.perf_counter() - start
+    return result
+
+def run_pool(args):
+    load_settings(args.settings) # fail early on a broken settings file
+    with ThreadPool(max(1, min(args.jobs, len(args.models)))) as pool: # every thread waits for its Blender
+        results = []
+        for result in pool.imap(lambda path: run_blender(args, path), args.models):
+            print(f"{result['model']}: {result.get('error') or result.get('gcode')}")
+            results.append(result)
+    return results
+
+# Without Blender
+
+def read_text_file(path):
+    "Lines of the text file at path, none if there is no such file"
+    if not os.path.isfile(path):
+        return []
+    with open(path) as f:
+        return f.read().splitlines()
+
+def run_model_arrays(path, settings, output_dir):
+    "Slice, spiralize and export one STL model with the bpy-free modules. Returns its summary entry."
+    from . import gcode, kinematics, profiling, slicer, spiral, stl, writers
+
+    result = {'model': path}
+    timings = {}
+    try:
+        unknown = set(settings) - set(DEFAULT_SETTINGS)
+        if unknown:
+            raise KeyError(f"Settings not supported without Blender: {', '.join(sorted(unknown))}")
+        check_toolpath_type(settings)
+        props = SimpleNamespace(**dict(DEFAULT_SETTINGS, **settings))
+        profiling.set_log_level(props.log_level)
+
+        start = time.perf_counter()
+        cos, tris = stl.read_stl(path)
+        timings['import'] = time.perf_counter() - start
+
+        with profiling.profiled('slice', props.use_cprofile) as profile:
+            layer_heights = None
+            if props.adaptive_layers:
+                zs = slicer.adaptive_layer_zs(cos, tris, props.min_extrusion_height,
+                                              props.max_extrusion_height, props.cusp_height)
+                layer_heights = spiral.layer_heights_from_zs(zs)
+            else:
+                zs = slicer.layer_zs(cos[:, 2].min(), cos[:, 2].max(), props.extrusion_height)
+            with profile.stage('slice'):
+                [points, point_layers, segments, point_data,
+                 loop_idxs, loop_orders, loop_signs] = slicer.slice_layers(cos, tris, zs)
+            profile.count('triangles', len(tris))
+            profile.count('layers', len(zs))
+            profile.count('points', len(points))
+        timings['slice'] = profile.seconds
+
+        # Blender keeps the points in single precision, so does this
+        with profiling.profiled('spiralize', props.use_cprofile) as profile:
+            layers = spiral.LayerIndex(point_layers, loop_idxs, loop_orders, loop_signs, len(zs))
+            with profile.stage('spiral'):
+                [vs, es, heights, widths, material_idxs,
+                 feedrate_factors] = spiral.spiralize_layers(points.astype(np.float32), layers,
+                                                             props.rotation_direction,
+                                                             props.extrusion_height, props.extrusion_width,
+                                                             spiral.parse_layer_list(props.filament_change_layers),
+                                                             None, props.interpolation_mode,
+                                                             props.decimate_tolerance,
+                                                             layer_heights=layer_heights)
+            profile.count('spiral_points', len(vs))
+        timings['spiralize'] = profile.seconds
+
+        with profiling.profiled('export', props.use_cprofile) as profile:
+            precision, arc_tolerance = gcode.settings_options(props)
+            with profile.stage('moves'):
+                moves, stats = gcode.toolpath_moves(vs.astype(np.float32), heights.astype(np.float32),
+                                                    widths.astype(np.float32), material_idxs,
+                                                    feedrate_factors.astype(np.float32), props.z_offset,
+                                                    props.extrusion_feed_rate_white, props.extrusion_feed_rate_black,
+                                                    arc_tolerance, props.max_segments_per_second)
+            profile.count('moves', len(moves['e']))
+            gcode_path = writers.with_extension(os.path.join(os.path.abspath(output_dir),
+                                                             os.path.splitext(os.path.basename(path))[0]),
+                                                props.gcode_format)
+            print_metadata = {'filament used [mm]': f"{float(moves['e'].sum()):.2f}"}
+            print_limits = kinematics.settings_limits(props)
+            if print_limits is not None:
+                with profile.stage('estimate'):
+                    _, report = kinematics.estimate(moves, float(np.median(heights)), *print_limits)
+                stats['print_time'] = report['print_time']
+                stats['peak_flow'] = report['peak_flow']
+                print_metadata['estimated printing time (normal mode)'] = kinematics.format_duration(report['print_time'])
+            with profile.stage('write'), writers.open_output(gcode_path, props.gcode_format,
+                                                             print_metadata) as stream:
+                stats['moves_size'] = gcode.write_gcode(stream, moves,
+                                                        props.travel_feed_rate, props.extrusion_feed_rate_white,
+                                                        read_text_file(props.start_gcode),
+                                                        read_text_file(props.filament_change_gcode),
+                                                        read_text_file(props.end_gcode), precision)
+            stats['file_size'] = os.path.getsize(gcode_path)
+            profile.count('bytes_written', stats['file_size'])
+            if print_limits is not None:
+                stats['print_report'] = kinematics.write_report(gcode_path, report)
+        timings['export'] = profile.seconds
+        result['gcode'], result['stats'] = gcode_path, stats
+    except Exception as e:
+        result['error'] = f"{type(e).__name__}: {e}"
+    result['seconds'] = timings
+    result['profile'] = {operation: report for operation, report in profiling.last_reports.items()
+                         if operation in timings}
+    return result
+
+def run_arrays_pool(args):
+    settings = load_settings(args.settings)
+    paths = [os.path.abspath(path) for path in args.models]
+    with Pool(max(1, min(args.jobs, len(paths)))) as pool:
+        results = []
+        for result in pool.imap(partial(run_model_arrays, settings=settings, output_dir=args.output), paths):
+            print(f"{result['model']}: {result.get('error') or result.get('gcode')}")
+            results.append(result)
+    return results
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[sys.argv.index('--') + 1:] if '--' in sys.argv else sys.argv[1:]
+    args = parse_args(argv)
+    os.makedirs(args.output, exist_ok=True)
+    if bpy is not None:
+        results = run_in_blender(args)
+    elif args.no_blender:
+        results = run_arrays_pool(args)
+    else:
+        results = run_pool(args)
+    write_summary(args.summary or os.path.join(args.output, 'summary.json'), results)
+    return 1 if any(result.get('error') for result in results) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,74 @@
+"""
+Drops toolpath points whose position and extrusion attributes the points around them interpolate within a tolerance.
+"""
+import numpy as np
+
+# Largest change of extrusion_feedrate_factor that may be interpolated away
+FEEDRATE_FACTOR_TOLERANCE = 0.01
+
+# Every this many points one is kept regardless. The farthest point of a long helix lies right next to an end
+# of its chord, which makes the splits unbalanced, so this bounds the recursion depth.
+KEEP_EVERY = 2048
+
+def douglas_peucker(points, tolerance, fixed=None):
+    """
+    Mask of the points kept by Douglas–Peucker simplification of the polyline points (n, d).
+    Every dropped point lies within tolerance of the segment between the kept points around it.
+    Points in the mask fixed are always kept. All open intervals of a recursion level are split at once.
+    """
+    point_count = len(points)
+    keep = np.zeros(point_count, dtype=bool) if fixed is None else fixed.copy()
+    if point_count == 0:
+        return keep
+    keep[0] = keep[-1] = True
+
+    kept = np.flatnonzero(keep)
+    starts, ends = kept[:-1], kept[1:]
+    while True:
+        inner = ends - starts - 1
+        starts, ends, inner = starts[inner > 0], ends[inner > 0], inner[inner > 0]
+        if len(starts) == 0:
+            return keep
+
+        # Distance of every inner point to the segment of its interval
+        interval = np.repeat(np.arange(len(starts)), inner)
+        first = np.cumsum(inner) - inner
+        idxs = starts[interval] + 1 + np.arange(len(interval)) - first[interval]
+        seg = points[ends] - points[starts]
+        seg_sq = np.einsum('ij,ij->i', seg, seg)
+        rel = points[idxs] - points[starts][interval]
+        along = np.einsum('ij,ij->i', rel, seg[interval]) / np.where(seg_sq > 0, seg_sq, 1)[interval]
+        along = np.clip(along, 0, 1)
+        off = rel - along[:, None] * seg[interval]
+        dist = np.sqrt(np.einsum('ij,ij->i', off, off))
+
+        # Split the intervals at their farthest point if it is out of tolerance
+        farthest = np.maximum.reduceat(dist, first)
+        is_farthest = dist == farthest[interval]
+        split_intervals, split_at = np.unique(interval[is_farthest], return_index=True)
+        split_idxs = idxs[is_farthest][split_at]
+        out = farthest[split_intervals] > tolerance
+        split_intervals, split_idxs = split_intervals[out], split_idxs[out]
+        keep[split_idxs] = True
+        starts, ends = (np.concatenate((starts[split_intervals], split_idxs)),
+                        np.concatenate((split_idxs, ends[split_intervals])))
+
+def decimate_toolpath(cos, extrusion_heights, extrusion_widths, extrusion_material_idxs, extrusion_feedrate_factors,
+                      tolerance):
+    """
+    Mask of the toolpath points to keep so that position, extrusion height and width (all in mm) stay within
+    tolerance and the feedrate factor within FEEDRATE_FACTOR_TOLERANCE.
+    Runs of different material are simplified separately, so nothing is merged across a filament change.
+    """
+    feedrate_scale = tolerance / FEEDRATE_FACTOR_TOLERANCE
+    points = np.column_stack((cos, extrusion_heights, extrusion_widths,
+                              np.asarray(extrusion_feedrate_factors) * feedrate_scale))
+
+    # Both sides of a material change are kept
+    fixed = np.zeros(len(points), dtype=bool)
+    material_idxs = np.asarray(extrusion_material_idxs)
+    changes = np.flatnonzero(material_idxs[1:] != material_idxs[:-1])
+    fixed[changes] = True
+    fixed[changes + 1] = True
+    fixed[::KEEP_EVERY] = True
+    return douglas_peucker(points, tolerance, fixed)
@@ -0,0 +1,48 @@
+"""
+Default values of the spiralizer_settings. ui.py declares the add-on properties with them and batch runs
+without Blender start from them, so both always agree.
+"""
+
+SETTINGS = {
+    'extrusion_height': 0.1,
+    'extrusion_width': 0.1,
+    'adaptive_layers': False,
+    'min_extrusion_height': 0.05,
+    'max_extrusion_height': 0.3,
+    'cusp_height': 0.02,
+    'slice_processes': 1,
+    'extrusion_feed_rate_black': 10,
+    'extrusion_feed_rate_white': 40,
+    'extrusion_feed_rate_map': "Feedrate",
+    'extrusion_width_black': 0.1,
+    'extrusion_width_map': "Width",
+    'travel_feed_rate': 100,
+    'rotation_direction': 'CW',
+    'interpolation_mode': 'CLOSEST',
+    'decimate_tolerance': 0.0,
+    'toolpath_type': 'CURVE',
+    'filament_change_layers': "",
+    'z_offset': 0.2,
+    'gcode_compact': False,
+    'gcode_precision_xy': 3,
+    'gcode_precision_z': 3,
+    'gcode_precision_e': 5,
+    'gcode_precision_f': 0,
+    'max_segments_per_second': 0,
+    'gcode_arcs': False,
+    'gcode_arc_tolerance': 0.01,
+    'estimate_print_time': False,
+    'acceleration': 1500,
+    'square_corner_velocity': 5,
+    'junction_deviation': 0,
+    'gcode_format': 'TEXT',
+    'use_cache': True,
+    'cache_size': 1024,
+    'cache_directory': "",
+    'log_level': 'WARNING',
+    'use_cprofile': False,
+    'gcode_directory': "",
+    'start_gcode': "",
+    'filament_change_gcode': "",
+    'end_gcode': "",
+}
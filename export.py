@@ -1,113 +1,145 @@
 import bpy
-import math
+import json
+import logging
 import os
-import mathutils
-
-def mms_to_mmmin(mms):
-    return int(mms*60.0)
-
-ARG_SORT = {
-    'F': 1,
-    'X': 2,
-    'Y': 3,
-    'Z': 4,
-    'E': 5,
-}
-def code(opcode, **kwargs):
-    """Generate a g-code line"""
-    if "co" in kwargs:
-        kwargs["x"] = kwargs["co"].x
-        kwargs["y"] = kwargs["co"].y
-        kwargs["z"] = kwargs["co"].z
-        del kwargs["co"]
-    args = sorted(kwargs.items(), key=lambda it: ARG_SORT[it[0].upper()])
-    arg_strs = []
-    for arg, val in args:
-        arg_strs.append(arg.upper() + "{:.6f}".format(val))
-    return " ".join([opcode.upper()] + arg_strs)
-
-def write_code(stream, opcode, **kwargs):
-    """Write a g-code line to stream ended by newline"""
-    stream.write(code(opcode, **kwargs) + "\n");
-
-def offset_z(co, dz):
-    return mathutils.Vector((co.x, co.y, co.z + dz))
-
-def write_code_from_block(stream, block):
+import numpy as np
+
+from . import cache, gcode, kinematics, profiling, ui, writers
+from .spiralize import evaluated_object
+
+log = logging.getLogger(__name__)
+
+def read_text_block(name):
+    "Lines of the text block name, none if there is no such block"
     try:
-        for line in bpy.data.texts[block].lines:
-            stream.write(line.body + '\n')
-    except:
-        pass
-    
-def export(context, gcode_directory,
-           start_gcode, filament_change_gcode, end_gcode,
-           travel_feed_rate, extrusion_feed_rate_white, extrusion_feed_rate_black, z_offset):
+        return [line.body for line in bpy.data.texts[name].lines]
+    except KeyError:
+        return []
+
+def read_spiral_arrays(me):
+    "Point coordinates and extrusion attributes of a spiral mesh, read in bulk"
+    cos = np.empty(len(me.vertices)*3, dtype=np.float32)
+    me.vertices.foreach_get("co", cos)
+    arrays = [cos.reshape(-1, 3)]
+    for name, dtype in (('extrusion_height', np.float32), ('extrusion_width', np.float32),
+                        ('extrusion_material_idx', np.int32), ('extrusion_feedrate_factor', np.float32)):
+        values = np.empty(len(me.vertices), dtype=dtype)
+        me.attributes[name].data.foreach_get("value", values)
+        arrays.append(values)
+    return arrays
+
+def cached_moves(array_cache, cos, heights, widths, material_idxs, feedrate_factors, z_offset,
+                 extrusion_feed_rate_white, extrusion_feed_rate_black, arc_tolerance, max_segments_per_second):
+    """
+    gcode.toolpath_moves, read from array_cache instead if the same spiral was turned into moves before.
+    Start and end g-code, format and precision only matter for writing, changing them keeps the moves.
+    """
+    args = (cos, heights, widths, material_idxs, feedrate_factors, z_offset,
+            extrusion_feed_rate_white, extrusion_feed_rate_black, arc_tolerance, max_segments_per_second)
+    if array_cache is None:
+        return gcode.toolpath_moves(*args)
+
+    key = cache.digest(cos, heights, widths, material_idxs, feedrate_factors, stage='moves',
+                       z_offset=z_offset, white=extrusion_feed_rate_white, black=extrusion_feed_rate_black,
+                       arc_tolerance=arc_tolerance, max_segments_per_second=max_segments_per_second)
+    arrays = array_cache.get(key)
+    if arrays is not None:
+        log.info("Moves read from cache")
+        profiling.count('cache_hits')
+        moves = {'first_co': tuple(arrays['first_co'].tolist()), 'z_offset': float(arrays['z_offset']),
+                 'xyz': arrays['xyz'], 'e': arrays['e'], 'f': arrays['f'], 'breaks': arrays['breaks'],
+                 'codes': arrays.get('codes'), 'ij': arrays.get('ij')}
+        return moves, json.loads(str(arrays['stats']))
+
+    moves, stats = gcode.toolpath_moves(*args)
+    arrays = {name: value for name, value in moves.items() if value is not None}
+    arrays['stats'] = json.dumps(stats)
+    array_cache.put(key, arrays)
+    return moves, stats
+
+# Color attributes of the spiral written by the print time estimation
+SPEED_ATTRIBUTE = "Achieved speed"
+FLOW_ATTRIBUTE = "Volumetric flow"
+
+def write_gray_attribute(me, name, values):
+    "Grayscale point color attribute name of me from values in 0..1, replacing an older one"
+    if name in me.color_attributes:
+        me.color_attributes.remove(me.color_attributes[name])
+    colors = np.ones((len(values), 4), dtype=np.float32)
+    colors[:, :3] = np.asarray(values)[:, None]
+    attr = me.color_attributes.new(name=name, type='FLOAT_COLOR', domain='POINT')
+    attr.data.foreach_set("color", colors.ravel())
+
+def output_path(gcode_directory, gcode_format):
+    "Absolute path of the g-code file, with the extension of gcode_format"
     if gcode_directory == '':
         directory = '//' + os.path.splitext(bpy.path.basename(bpy.context.blend_data.filepath))[0]
     else:
         directory = gcode_directory
-    if '.gcode' not in directory: directory += '.gcode'
-    path = bpy.path.abspath(directory)
-    with open(path, 'w') as export_file:
-        write_code_from_block(export_file, start_gcode)
+    return bpy.path.abspath(writers.with_extension(directory, gcode_format))
+
+def export(context, gcode_directory,
+           start_gcode, filament_change_gcode, end_gcode,
+           travel_feed_rate, extrusion_feed_rate_white, extrusion_feed_rate_black, z_offset,
+           precision=None, arc_tolerance=0, max_segments_per_second=0, gcode_format='TEXT', array_cache=None,
+           print_limits=None):
+    """
+    Write the selected spiral as g-code. precision (decimals per word letter) enables compact output,
+    a non-zero arc_tolerance replaces runs of moves by G2/G3 arcs and a non-zero max_segments_per_second
+    merges moves too short for the firmware's planner. gcode_format is one of writers.FORMAT_EXTENSIONS.
+    With an array_cache the moves of a spiral exported with the same parameters before are not computed again.
+    print_limits (acceleration, junction deviation) estimates the print time, see kinematics.estimate. Its report
+    is written next to the g-code, the achieved share of the commanded speed and the flow are kept as color
+    attributes of the spiral.
+    Returns the path written to and a dict of statistics about the written moves.
+    """
+    path = output_path(gcode_directory, gcode_format)
 
+    with profiling.stage('read'):
         # Get mesh from object
-        obj_orig = context.object
-        depsgraph = context.evaluated_depsgraph_get()
-        obj = obj_orig.evaluated_get(depsgraph) # eval in order to make geometry nodes happen
-        me = obj.data
-
-        # Go to first point
-        co = me.vertices[0].co
-        z0 = co.z
-        dz = z_offset - z0
-        write_code(export_file, "G0", co=offset_z(co, dz+0.1), f=mms_to_mmmin(travel_feed_rate))
-        write_code(export_file, "G1", z=z_offset, f=mms_to_mmmin(extrusion_feed_rate_white))
-
-        # Init export loop
-        v_last = me.vertices[0]
-        h_last = me.attributes['extrusion_height'].data[0].value
-        w_last = me.attributes['extrusion_width'].data[0].value
-        mi_last = me.attributes['extrusion_material_idx'].data[0].value
-        eff_last = me.attributes['extrusion_feedrate_factor'].data[0].value
-
-        e = 0 # Accumulate extrusion coordinate
-        for i in range(1, len(me.vertices)):
-            v = me.vertices[i]
-
-            # Extrusion params
-            h = me.attributes['extrusion_height'].data[i].value
-            w = me.attributes['extrusion_width'].data[i].value
-            mi = me.attributes['extrusion_material_idx'].data[i].value
-            eff = me.attributes['extrusion_feedrate_factor'].data[i].value
-
-            # Extrusion amount
-            l_out = (v.co - v_last.co).length # length of material going out
-            volume_out = l_out * h * w # volume going out
-            l_in = volume_out / (math.pi * (1.75/2)**2) # length of filamgent going in
-            e = e + l_in
-
-            # Feedrate
-            extrusion_feed_rate = extrusion_feed_rate_black + eff * (extrusion_feed_rate_white - extrusion_feed_rate_black)
-
-            # Write that line  F{mms_to_mmmin(extrusion_feed_rate)}
-            co = offset_z(v.co, dz)
-            write_code(export_file, "G1", co=co, e=l_in, f=mms_to_mmmin(extrusion_feed_rate))
-
-            if (mi_last != mi):
-                write_code_from_block(export_file, filament_change_gcode)
-            
-            l_last = v
-            h_last = h
-            w_last = w
-            v_last = v
-            mi_last = mi
-    
-        # Write end gcode
-        write_code_from_block(export_file, end_gcode)
-    return path
+        obj = evaluated_object(context)
+        cos, heights, widths, material_idxs, feedrate_factors = read_spiral_arrays(obj.data)
+
+    # All moves at once
+    with profiling.stage('moves'):
+        moves, stats = cached_moves(array_cache, cos, heights, widths, material_idxs, feedrate_factors, z_offset,
+                                    extrusion_feed_rate_white, extrusion_feed_rate_black,
+                                    arc_tolerance, max_segments_per_second)
+    profiling.count('moves', len(moves['e']))
+
+    print_metadata = {'filament used [mm]': f"{float(moves['e'].sum()):.2f}"}
+    plan = None
+    if print_limits is not None:
+        with profiling.stage('estimate'):
+            plan, report = kinematics.estimate(moves, float(np.median(heights)), *print_limits)
+        stats['print_time'] = report['print_time']
+        stats['peak_flow'] = report['peak_flow']
+        print_metadata['estimated printing time (normal mode)'] = kinematics.format_duration(report['print_time'])
+    with profiling.stage('write'), writers.open_output(path, gcode_format, print_metadata) as export_file:
+        stats['moves_size'] = gcode.write_gcode(export_file, moves, travel_feed_rate, extrusion_feed_rate_white,
+                                                read_text_block(start_gcode), read_text_block(filament_change_gcode),
+                                                read_text_block(end_gcode), precision)
+    stats['file_size'] = os.path.getsize(path)
+    if plan is not None:
+        stats['print_report'] = kinematics.write_report(path, report)
+        me = context.object.data
+        if len(me.vertices) == len(cos):
+            speeds, flows = kinematics.point_values(cos, plan)
+            write_gray_attribute(me, SPEED_ATTRIBUTE, speeds)
+            write_gray_attribute(me, FLOW_ATTRIBUTE, flows)
+    profiling.count('bytes_written', stats['file_size'])
+    log.info("Wrote %d bytes of g-code to %s", stats['file_size'], path)
+    return path, stats
     
+def export_with_settings(context, props):
+    "export() with the arguments taken from spiralizer_settings props"
+    precision, arc_tolerance = gcode.settings_options(props)
+    return export(context, props.gcode_directory,
+                  props.start_gcode, props.filament_change_gcode, props.end_gcode,
+                  props.travel_feed_rate, props.extrusion_feed_rate_white, props.extrusion_feed_rate_black,
+                  props.z_offset, precision, arc_tolerance, props.max_segments_per_second,
+                  props.gcode_format, cache.from_settings(props), kinematics.settings_limits(props))
+
 class GcodeExportOperator(bpy.types.Operator):
     bl_idname = "spiralizer.gcode_export"
     bl_label = "Export Gcode"
@@ -120,9 +152,23 @@ class GcodeExportOperator(bpy.types.Operator):
 
     def execute(self, context):
         props = context.scene.spiralizer_settings
-        path = export(context, props.gcode_directory,
-                      props.start_gcode, props.filament_change_gcode, props.end_gcode,
-                      props.travel_feed_rate, props.extrusion_feed_rate_white, props.extrusion_feed_rate_black,
-                      props.z_offset)
-        self.report({'INFO'}, f"Successfully wrote g-code to {path}.")
+        with ui.profiled(props, 'export'):
+            path, stats = export_with_settings(context, props)
+        message = f"Successfully wrote g-code to {path}."
+        if stats.get('rate_limited_z'):
+            ranges = ", ".join(f"{z_min:.1f}-{z_max:.1f}" for z_min, z_max in stats['rate_limited_z'][:3])
+            more = " ..." if len(stats['rate_limited_z']) > 3 else ""
+            message += (f" Segment rate merged {stats['rate_merged_moves']} and slowed {stats['rate_slowed_moves']}"
+                        f" moves at z {ranges}{more} mm, at most {stats['rate_max_deviation']:.3f} mm off the path.")
+        if 'arc_lines_removed' in stats:
+            message += f" Arc fitting removed {stats['arc_lines_removed']} lines."
+        if stats['moves_size'] != stats['verbose_moves_size']:
+            saved = 100 * (1 - stats['moves_size'] / max(stats['verbose_moves_size'], 1))
+            message += f" Moves take {stats['moves_size']} bytes, {saved:.1f}% less than verbose output."
+        if 'print_time' in stats:
+            message += (f" Estimated print time {kinematics.format_duration(stats['print_time'])},"
+                        f" peak flow {stats['peak_flow']:.1f} mm³/s.")
+        if props.gcode_format != 'TEXT':
+            message += f" File size {stats['file_size']} bytes."
+        self.report({'INFO'}, message)
         return {'FINISHED'}
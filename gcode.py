@@ -0,0 +1,341 @@
+"""
+Turns spiral toolpaths into g-code moves and writes them.
+Coordinates are single precision like the mesh they come from, so the default output is the text the original
+per-vertex export loop wrote.
+"""
+import math
+
+import numpy as np
+
+from . import arcs, profiling
+
+FILAMENT_DIAMETER = 1.75 # mm
+FILAMENT_AREA = math.pi * (FILAMENT_DIAMETER/2)**2
+
+# Decimals of every word when g-code is not compact
+VERBOSE_PRECISION = dict.fromkeys('FXYZIJE', 6)
+
+# Moves formatted per string operation, bounds the size of the temporary strings
+CHUNK_SIZE = 1 << 16
+
+# Rate limited moves closer than this in z (mm) are reported as one range
+RATE_LIMIT_Z_GAP = 1.0
+
+# Largest distance (mm) between a rate limited move and the points it replaces
+RATE_LIMIT_TOLERANCE = 0.01
+
+def mms_to_mmmin(mms):
+    return int(mms*60.0)
+
+ARG_SORT = {
+    'F': 1,
+    'X': 2,
+    'Y': 3,
+    'Z': 4,
+    'E': 5,
+}
+def code(opcode, **kwargs):
+    """Generate a g-code line"""
+    if "co" in kwargs:
+        kwargs["x"] = kwargs["co"].x
+        kwargs["y"] = kwargs["co"].y
+        kwargs["z"] = kwargs["co"].z
+        del kwargs["co"]
+    args = sorted(kwargs.items(), key=lambda it: ARG_SORT[it[0].upper()])
+    arg_strs = []
+    for arg, val in args:
+        arg_strs.append(arg.upper() + "{:.6f}".format(val))
+    return " ".join([opcode.upper()] + arg_strs)
+
+def write_code(stream, opcode, **kwargs):
+    """Write a g-code line to stream ended by newline"""
+    stream.write(code(opcode, **kwargs) + "\n");
+    profiling.count('gcode_lines')
+
+def write_lines(stream, lines):
+    "Write lines of g-code, e.g. the start g-code, each ended by newline"
+    for line in lines:
+        stream.write(line + '\n')
+    profiling.count('gcode_lines', len(lines))
+
+def segment_lengths(cos):
+    "Length of the segments between consecutive single precision points, computed like mathutils does"
+    d = np.diff(cos.astype(np.float32), axis=0)
+    sq = (d * d).astype(np.float64)
+    return np.sqrt(sq[:, 2] + sq[:, 1] + sq[:, 0])
+
+def extrusion_moves(cos, heights, widths, feedrate_factors, dz,
+                    extrusion_feed_rate_white, extrusion_feed_rate_black):
+    """
+    Moves from every point to the next one.
+    Returns the target positions shifted by dz, the filament length fed (E) and the feed rate in mm/min (F).
+    """
+    cos = np.asarray(cos, dtype=np.float32)
+    heights = np.asarray(heights, dtype=np.float64)[1:]
+    widths = np.asarray(widths, dtype=np.float64)[1:]
+    feedrate_factors = np.asarray(feedrate_factors, dtype=np.float64)[1:]
+
+    xyz = cos[1:].copy()
+    xyz[:, 2] = (cos[1:, 2].astype(np.float64) + dz).astype(np.float32)
+
+    volume_out = segment_lengths(cos) * heights * widths # volume going out
+    e = volume_out / FILAMENT_AREA # length of filament going in
+
+    extrusion_feed_rate = extrusion_feed_rate_black + feedrate_factors * (extrusion_feed_rate_white - extrusion_feed_rate_black)
+    f = np.trunc(extrusion_feed_rate * 60.0)
+
+    return xyz.astype(np.float64), e, f
+
+def material_changes(material_idxs):
+    "Indices of the moves after which the material changes"
+    material_idxs = np.asarray(material_idxs)
+    return np.flatnonzero(material_idxs[1:] != material_idxs[:-1])
+
+def format_moves(xyz, e, f):
+    "G1 lines for the moves, each ended by newline"
+    line = "G1 F{0} X{0} Y{0} Z{0} E{0}\n".format("%.6f")
+    values = np.column_stack((f, xyz, e)).ravel().tolist()
+    return (line * len(e)) % tuple(values)
+
+def format_column(values, precision, trim):
+    "values as array of strings with precision decimals, optionally without trailing zeros"
+    text = ("%.{}f\n".format(precision) * len(values)) % tuple(values.tolist())
+    strings = np.array(text.split("\n")[:-1])
+    if trim:
+        if precision > 0:
+            strings = np.char.rstrip(np.char.rstrip(strings, '0'), '.')
+        strings[strings == '-0'] = '0'
+    return strings
+
+def format_moves_compact(xyz, e, f, precision, last_words=None, codes=None, ij=None, compact=True):
+    """
+    G1 (or G2/G3 where codes says so, with arc centers ij) lines for the moves, leaving out F, X, Y and Z words
+    whose value did not change since the previous line. precision maps each word letter to its number of
+    decimals, trailing zeros are trimmed. Without compact every word is written in full.
+    last_words are the values in effect before the first move (None if unknown).
+    Returns the lines and the values in effect after the last move.
+    """
+    if codes is None:
+        lines = np.full(len(e), "G1")
+        columns = (('F', f), ('X', xyz[:, 0]), ('Y', xyz[:, 1]), ('Z', xyz[:, 2]), ('E', e))
+    else:
+        lines = np.array(["G0", "G1", "G2", "G3"])[codes]
+        columns = (('F', f), ('X', xyz[:, 0]), ('Y', xyz[:, 1]), ('Z', xyz[:, 2]),
+                   ('I', ij[:, 0]), ('J', ij[:, 1]), ('E', e))
+    new_last_words = {}
+    for letter, values in columns:
+        strings = format_column(values, precision[letter], compact)
+        words = np.char.add(" " + letter, strings)
+        if letter in 'IJ': # only arcs have a center
+            words = np.where(codes > 1, words, "")
+        if compact and letter in 'FXYZ': # E is relative and I, J are per arc, they are needed on every line
+            previous = np.empty_like(strings)
+            previous[1:] = strings[:-1]
+            previous[:1] = (last_words or {}).get(letter, "")
+            words = np.where(strings == previous, "", words)
+            new_last_words[letter] = strings[-1] if len(strings) else (last_words or {}).get(letter, "")
+        lines = np.char.add(lines, words)
+    if len(lines) == 0:
+        return "", last_words
+    return "\n".join(lines.tolist()) + "\n", new_last_words
+
+def verbose_size(xyz, e, f):
+    "Number of characters format_moves would produce for the moves"
+    size = len(e) * len("G1\n")
+    for values in (f, xyz[:, 0], xyz[:, 1], xyz[:, 2], e):
+        integer_part = np.floor(np.abs(values) + 5e-7)
+        digits = np.floor(np.log10(np.maximum(integer_part, 1))) + 1
+        size += int(np.sum(len(" F.") + 6 + digits + np.signbit(values)))
+    return size
+
+def write_moves(stream, xyz, e, f, breaks=(), write_break=None, precision=None, codes=None, ij=None,
+                chunk_size=CHUNK_SIZE):
+    """
+    Write the moves to stream in large chunks.
+    write_break(stream) is called after every move listed in breaks.
+    Without precision every word is written with six decimals, otherwise the lines are compact
+    (see format_moves_compact). codes and ij turn moves into arcs.
+    Returns the number of characters written for the moves.
+    """
+    breaks = {int(i) for i in breaks}
+    written = 0
+    last_words = None
+    start = 0
+    for end in sorted(breaks | {len(e) - 1}):
+        for lo in range(start, end + 1, chunk_size):
+            hi = min(lo + chunk_size, end + 1)
+            if precision is None and codes is None:
+                text = format_moves(xyz[lo:hi], e[lo:hi], f[lo:hi])
+            elif precision is None:
+                text, _ = format_moves_compact(xyz[lo:hi], e[lo:hi], f[lo:hi], VERBOSE_PRECISION, None,
+                                               codes[lo:hi], ij[lo:hi], compact=False)
+            else:
+                text, last_words = format_moves_compact(xyz[lo:hi], e[lo:hi], f[lo:hi], precision, last_words,
+                                                        None if codes is None else codes[lo:hi],
+                                                        None if ij is None else ij[lo:hi])
+            stream.write(text)
+            written += len(text)
+            profiling.count('gcode_lines', hi - lo)
+        if write_break is not None and end in breaks:
+            write_break(stream)
+            last_words = None # the inserted g-code may move the head or set another feed rate
+        start = end + 1
+    return written
+
+def chord_deviation(points, p, q):
+    "Largest distance of points[p+1:q] from the chord between points[p] and points[q]"
+    if q - p < 2:
+        return 0.0
+    chord = points[q] - points[p]
+    chord_sq = float(chord @ chord)
+    rel = points[p+1:q] - points[p]
+    along = np.clip(rel @ chord / (chord_sq if chord_sq > 0 else 1), 0, 1)
+    off = rel - along[:, None] * chord
+    return float(np.sqrt(np.einsum('ij,ij->i', off, off).max()))
+
+def limit_segment_rate(start, xyz, e, f, breaks, max_segments_per_second, tolerance=RATE_LIMIT_TOLERANCE):
+    """
+    Merge consecutive moves so that no move takes less than 1/max_segments_per_second at its feed rate,
+    as far as the merged move stays within tolerance of the points it replaces. Moves listed in breaks stay
+    the last move before the break. A merged move gets the summed E and the feed rate that keeps the
+    duration of the moves it replaces. Moves that are still too short, because the tolerance or a break
+    stopped the merge, are slowed down to take 1/max_segments_per_second (but not below 1 mm/min).
+    Returns the new targets, E, feed rates and break indices, the indices of the merged moves, the
+    indices of the slowed moves and the largest distance between a merged move and the points it replaces.
+    """
+    move_count = len(e)
+    min_duration = 1.0 / max_segments_per_second
+    points = np.concatenate((np.asarray(start, dtype=np.float64).reshape(1, 3), xyz))
+    lengths = np.linalg.norm(np.diff(points, axis=0), axis=1)
+    durations = lengths / (np.maximum(f, 1e-9) / 60.0)
+    time_cum = np.concatenate(([0.0], np.cumsum(durations)))
+
+    breaks = np.asarray(list(breaks), dtype=np.int64)
+    boundaries = np.union1d(breaks + 1, [move_count])
+
+    # Only runs of too short moves need merging, walk them greedily
+    keep = np.ones(move_count + 1, dtype=bool)
+    is_short = np.concatenate(([False], durations < min_duration, [False]))
+    run_starts = np.flatnonzero(is_short[1:] & ~is_short[:-1])
+    run_ends = np.flatnonzero(~is_short[1:] & is_short[:-1])
+    cursor = 0
+    max_deviation = 0.0
+    for a, b in zip(run_starts, run_ends):
+        p = max(a, cursor)
+        while p < b:
+            boundary = boundaries[np.searchsorted(boundaries, p, side='right')]
+            q = int(np.searchsorted(time_cum, time_cum[p] + min_duration))
+            q = max(min(q, boundary), p + 1)
+            # Merge fewer moves where the chord would cut the curve
+            deviation = chord_deviation(points, p, q)
+            while deviation > tolerance:
+                q = p + (q - p) // 2
+                deviation = chord_deviation(points, p, q)
+            max_deviation = max(max_deviation, deviation)
+            keep[p+1:q] = False
+            p = q
+        cursor = p
+
+    ends = np.flatnonzero(keep[1:]) + 1
+    starts = np.concatenate(([0], ends[:-1]))
+    merged = np.flatnonzero(ends - starts > 1)
+
+    e_cum = np.concatenate(([0.0], np.cumsum(e)))
+    new_f = f[ends - 1].astype(np.float64)
+    merged_time = time_cum[ends[merged]] - time_cum[starts[merged]]
+    chords = np.linalg.norm(points[ends[merged]] - points[starts[merged]], axis=1)
+    has_time = merged_time > 0
+    new_f[merged[has_time]] = np.trunc(60.0 * chords[has_time] / merged_time[has_time])
+
+    # Slow down the moves the tolerance or a break kept too short
+    new_lengths = np.linalg.norm(points[ends] - points[starts], axis=1)
+    max_f = np.maximum(np.trunc(60.0 * new_lengths * max_segments_per_second), 1)
+    slowed = np.flatnonzero(new_f > max_f)
+    new_f[slowed] = max_f[slowed]
+
+    new_breaks = np.flatnonzero(np.isin(ends - 1, breaks))
+    return points[ends], e_cum[ends] - e_cum[starts], new_f, new_breaks, merged, slowed, max_deviation
+
+def z_ranges(zs, gap):
+    "Sorted z values grouped into [z_min, z_max] ranges that are at most gap apart inside"
+    zs = np.sort(np.asarray(zs))
+    if len(zs) == 0:
+        return []
+    split = np.flatnonzero(np.diff(zs) > gap) + 1
+    return [[float(group[0]), float(group[-1])] for group in np.split(zs, split)]
+
+def settings_options(props):
+    "Word precision (None unless compact) and arc tolerance (0 without arcs) from spiralizer_settings props"
+    precision = None
+    if props.gcode_compact:
+        precision = {'F': props.gcode_precision_f,
+                     'X': props.gcode_precision_xy, 'Y': props.gcode_precision_xy,
+                     'I': props.gcode_precision_xy, 'J': props.gcode_precision_xy,
+                     'Z': props.gcode_precision_z,
+                     'E': props.gcode_precision_e}
+    arc_tolerance = props.gcode_arc_tolerance if props.gcode_arcs else 0
+    return precision, arc_tolerance
+
+def toolpath_moves(cos, heights, widths, material_idxs, feedrate_factors, z_offset,
+                   extrusion_feed_rate_white, extrusion_feed_rate_black,
+                   arc_tolerance=0, max_segments_per_second=0):
+    """
+    All moves of a spiral toolpath (single precision points cos and their extrusion attributes)
+    with its first point at height z_offset.
+    A non-zero max_segments_per_second merges moves too short for the firmware's planner and a
+    non-zero arc_tolerance replaces runs of moves by G2/G3 arcs.
+    Returns a dict of the move arrays for write_gcode and a dict of statistics about them.
+    """
+    cos = np.asarray(cos, dtype=np.float32)
+    dz = z_offset - float(cos[0, 2])
+    xyz, e, f = extrusion_moves(cos, heights, widths, feedrate_factors, dz,
+                                extrusion_feed_rate_white, extrusion_feed_rate_black)
+    breaks = material_changes(material_idxs)
+    stats = {'verbose_moves_size': verbose_size(xyz, e, f),
+             'lines': len(e)}
+
+    start = np.array((cos[0, 0], cos[0, 1], np.float32(cos[0, 2] + dz)))
+
+    # Optionally merge moves the planner cannot execute fast enough
+    if max_segments_per_second > 0:
+        xyz, e, f, breaks, merged, slowed, deviation = limit_segment_rate(start, xyz, e, f, breaks,
+                                                                          max_segments_per_second)
+        stats['rate_merged_moves'] = len(merged)
+        stats['rate_slowed_moves'] = len(slowed)
+        stats['rate_max_deviation'] = deviation
+        stats['rate_limited_z'] = z_ranges(xyz[np.union1d(merged, slowed), 2], RATE_LIMIT_Z_GAP)
+        stats['lines'] = len(e)
+
+    # Optionally merge moves into arcs
+    codes = ij = None
+    if arc_tolerance > 0:
+        codes, xyz, ij, e, f, breaks = arcs.fit_arcs(start, xyz, e, f, breaks, arc_tolerance)
+        stats['arc_lines_removed'] = stats['lines'] - len(e)
+        stats['lines'] = len(e)
+
+    # The travel move to the first point stays clear of the bed by 0.1 mm
+    first_co = (float(cos[0, 0]), float(cos[0, 1]), float(np.float32(float(cos[0, 2]) + (dz + 0.1))))
+    moves = {'first_co': first_co, 'z_offset': z_offset,
+             'xyz': xyz, 'e': e, 'f': f, 'breaks': breaks, 'codes': codes, 'ij': ij}
+    return moves, stats
+
+def write_gcode(stream, moves, travel_feed_rate, extrusion_feed_rate_white,
+                start_lines=(), filament_change_lines=(), end_lines=(), precision=None):
+    """
+    Write the start g-code, the travel to the first point, the moves of toolpath_moves and the end g-code.
+    filament_change_lines are written at every material change. precision enables compact moves
+    (see write_moves). Returns the number of characters written for the moves.
+    """
+    write_lines(stream, start_lines)
+
+    # Go to first point
+    x, y, z = moves['first_co']
+    write_code(stream, "G0", x=x, y=y, z=z, f=mms_to_mmmin(travel_feed_rate))
+    write_code(stream, "G1", z=moves['z_offset'], f=mms_to_mmmin(extrusion_feed_rate_white))
+
+    moves_size = write_moves(stream, moves['xyz'], moves['e'], moves['f'], moves['breaks'],
+                             lambda stream: write_lines(stream, filament_change_lines),
+                             precision, moves['codes'], moves['ij'])
+
+    write_lines(stream, end_lines)
+    return moves_size
@@ -0,0 +1,188 @@
+"""
+Estimates how long g-code moves take to print and where they are slower than commanded.
+
+The moves are planned the way firmware plans them: trapezoidal speed profiles with constant acceleration,
+junction speeds limited by junction deviation and a stop at the start, the end and every material change.
+Both passes of the planner are cumulative minima over the whole toolpath, no loop runs per move.
+"""
+import json
+import math
+
+import numpy as np
+
+from . import arcs, gcode
+
+# Moves shorter than this (mm) take no time and do not limit the junction they are part of
+MIN_LENGTH = 1e-6
+
+# Written next to the g-code, e.g. vase.gcode.print.json
+REPORT_SUFFIX = '.print.json'
+
+def square_corner_deviation(acceleration, square_corner_velocity):
+    "Junction deviation that takes a 90 degree corner at square_corner_velocity, as Klipper derives it"
+    return square_corner_velocity**2 * (math.sqrt(2) - 1) / acceleration
+
+def settings_limits(props):
+    """
+    Acceleration and junction deviation from spiralizer_settings props, None without print time estimation.
+    A junction deviation of 0 is derived from the square corner velocity.
+    """
+    if not props.estimate_print_time:
+        return None
+    deviation = props.junction_deviation or square_corner_deviation(props.acceleration, props.square_corner_velocity)
+    return props.acceleration, deviation
+
+def move_geometry(start, xyz, codes=None, ij=None):
+    """
+    Length of every move from start through the targets xyz and its unit directions at the start and the end.
+    Arcs (codes G2/G3 with centers ij relative to the move start) are measured along the helix.
+    """
+    points = np.concatenate((np.asarray(start, dtype=np.float64).reshape(1, 3), xyz))
+    d = np.diff(points, axis=0)
+    lengths = np.linalg.norm(d, axis=1)
+    start_dirs = d / np.maximum(lengths, MIN_LENGTH)[:, None]
+    end_dirs = start_dirs.copy()
+    if codes is None:
+        return lengths, start_dirs, end_dirs
+
+    arc = np.flatnonzero(codes != arcs.G1)
+    sign = np.where(codes[arc] == arcs.G3, 1.0, -1.0) # counter-clockwise turns left
+    r0 = -ij[arc]
+    r1 = points[arc + 1, :2] - (points[arc, :2] + ij[arc])
+    radii = np.linalg.norm(r0, axis=1)
+    sweep = (sign * (np.arctan2(r1[:, 1], r1[:, 0]) - np.arctan2(r0[:, 1], r0[:, 0]))) % (2 * math.pi)
+    horizontal = radii * sweep
+    lengths[arc] = np.hypot(horizontal, d[arc, 2])
+    arc_lengths = np.maximum(lengths[arc], MIN_LENGTH)
+    for r, dirs in ((r0, start_dirs), (r1, end_dirs)):
+        tangents = sign[:, None] * np.column_stack((-r[:, 1], r[:, 0])) / np.maximum(radii, MIN_LENGTH)[:, None]
+        dirs[arc, :2] = tangents * (horizontal / arc_lengths)[:, None]
+        dirs[arc, 2] = d[arc, 2] / arc_lengths
+    return lengths, start_dirs, end_dirs
+
+def plan_moves(moves, acceleration, junction_deviation):
+    """
+    Trapezoidal speed profiles of the moves of gcode.toolpath_moves.
+    Returns per-move arrays: 'length' (mm), 'time' (s), 'commanded' and 'peak' speed (mm/s).
+    """
+    x, y, _ = moves['first_co']
+    lengths, start_dirs, end_dirs = move_geometry((x, y, moves['z_offset']), moves['xyz'],
+                                                  moves['codes'], moves['ij'])
+    commanded = np.asarray(moves['f'], dtype=np.float64) / 60.0
+
+    # Plan the moves that go somewhere, nodes are the junctions before, between and after them
+    kept = np.flatnonzero(lengths > MIN_LENGTH)
+    length = lengths[kept]
+    cruise_sq = np.maximum(commanded[kept], MIN_LENGTH)**2
+    move_count = len(kept)
+
+    # Junction speed from the deviation of a circle touching both moves, like Klipper and Marlin
+    cos_theta = -np.einsum('ij,ij->i', end_dirs[kept[:-1]], start_dirs[kept[1:]]).clip(-1, 1)
+    sin_half = np.sqrt(0.5 * (1 - cos_theta))
+    straight = sin_half > 1 - 1e-9
+    radius = junction_deviation * sin_half / np.where(straight, 1, 1 - sin_half)
+    limit_sq = np.empty(move_count + 1)
+    limit_sq[1:-1] = np.where(straight, np.inf, acceleration * radius)
+    limit_sq[1:-1] = np.minimum(limit_sq[1:-1], np.minimum(cruise_sq[:-1], cruise_sq[1:]))
+    limit_sq[[0, -1]] = 0
+    breaks = np.asarray(list(moves['breaks']), dtype=np.int64)
+    limit_sq[np.searchsorted(kept, breaks, side='right')] = 0
+
+    # Backward pass (decelerate in time) and forward pass (accelerate in time) in squared speeds:
+    # v[k]^2 = min over j after k of v[j]^2 + 2 a (s[j] - s[k]), and the same looking back
+    distance = 2 * acceleration * np.concatenate(([0.0], np.cumsum(length)))
+    backward = np.minimum.accumulate((limit_sq + distance)[::-1])[::-1] - distance
+    node_sq = np.maximum(np.minimum.accumulate(backward - distance) + distance, 0)
+
+    # Time of every trapezoid, a triangle if the move is too short to reach its speed
+    entry_sq, exit_sq = node_sq[:-1], node_sq[1:]
+    peak_sq = np.minimum(cruise_sq, (2 * acceleration * length + entry_sq + exit_sq) / 2)
+    peak = np.sqrt(peak_sq)
+    ramps = (2 * peak - np.sqrt(entry_sq) - np.sqrt(exit_sq)) / acceleration
+    ramp_length = (2 * peak_sq - entry_sq - exit_sq) / (2 * acceleration)
+    times = np.zeros(len(lengths))
+    times[kept] = ramps + np.maximum(length - ramp_length, 0) / peak
+    peaks = np.zeros(len(lengths))
+    peaks[kept] = peak
+    return {'length': lengths, 'time': times, 'commanded': commanded, 'peak': peaks}
+
+def estimate(moves, layer_height, acceleration, junction_deviation):
+    """
+    Plan the moves and summarize the print: total time, time at the commanded feed rates, volumetric
+    flow peaks and, per band of layer_height in z, the achieved and commanded speed and the peak flow.
+    Returns the plan (see plan_moves, with the per-move 'flow' at peak speed in mm^3/s) and the report.
+    """
+    plan = plan_moves(moves, acceleration, junction_deviation)
+    lengths, times, commanded = plan['length'], plan['time'], plan['commanded']
+    section = np.asarray(moves['e']) * gcode.FILAMENT_AREA / np.maximum(lengths, MIN_LENGTH)
+    plan['flow'] = section * plan['peak']
+    commanded_times = np.where(lengths > MIN_LENGTH, lengths / np.maximum(commanded, MIN_LENGTH), 0)
+
+    zs = np.asarray(moves['xyz'])[:, 2]
+    z_min = float(zs.min()) if len(zs) else 0.0
+    bands = ((zs - z_min) / layer_height).astype(np.int64)
+    band_count = int(bands.max()) + 1 if len(bands) else 0
+    band_lengths = np.bincount(bands, lengths, band_count)
+    band_times = np.bincount(bands, times, band_count)
+    band_commanded = np.bincount(bands, commanded_times, band_count)
+    band_flow = np.zeros(band_count)
+    np.maximum.at(band_flow, bands, plan['flow'])
+    used = np.flatnonzero(band_times > 0)
+
+    peak = int(np.argmax(plan['flow'])) if len(zs) else None
+    report = {
+        'print_time': float(times.sum()),
+        'commanded_time': float(commanded_times.sum()),
+        'moves': len(lengths),
+        'length': float(lengths.sum()),
+        'acceleration': acceleration,
+        'junction_deviation': junction_deviation,
+        'peak_flow': float(plan['flow'][peak]) if peak is not None else 0.0,
+        'peak_flow_z': float(zs[peak]) if peak is not None else None,
+        'layer_height': layer_height,
+        # One entry per band in every list
+        'layers': {
+            'z': (z_min + used * layer_height).tolist(),
+            'time': band_times[used].tolist(),
+            'achieved_speed': (band_lengths[used] / band_times[used]).tolist(),
+            'commanded_speed': (band_lengths[used] / np.maximum(band_commanded[used], MIN_LENGTH)).tolist(),
+            'peak_flow': band_flow[used].tolist(),
+        },
+    }
+    return plan, report
+
+def point_values(cos, plan):
+    """
+    Achieved share of the commanded speed and share of the peak flow of the moves through the toolpath
+    points cos, both 0..1. Points are matched to moves by their distance along the path,
+    so merged moves and arcs color all points they replace.
+    """
+    if len(plan['length']) == 0:
+        return np.zeros(len(cos)), np.zeros(len(cos))
+    achieved = np.where(plan['time'] > 0, plan['length'] / np.maximum(plan['time'], MIN_LENGTH), 0)
+    ratios = np.clip(achieved / np.maximum(plan['commanded'], MIN_LENGTH), 0, 1)
+    flows = plan['flow'] / max(float(plan['flow'].max()), MIN_LENGTH)
+
+    point_distance = np.concatenate(([0.0], np.cumsum(gcode.segment_lengths(np.asarray(cos)))))
+    middles = np.concatenate(([0.0], (point_distance[:-1] + point_distance[1:]) / 2))
+    move_ends = np.cumsum(plan['length'])
+    idxs = np.minimum(np.searchsorted(move_ends, middles * (move_ends[-1] / max(point_distance[-1], MIN_LENGTH))),
+                      len(move_ends) - 1)
+    return ratios[idxs], flows[idxs]
+
+def format_duration(seconds):
+    "seconds like slicers show print times, e.g. 1h 2m 3s"
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    days, hours = divmod(hours, 24)
+    words = [f"{value}{unit}" for value, unit in ((days, 'd'), (hours, 'h'), (minutes, 'm'), (seconds, 's'))]
+    while len(words) > 1 and words[0][0] == '0':
+        words.pop(0)
+    return " ".join(words)
+
+def write_report(gcode_path, report):
+    "Write report as JSON next to the g-code at gcode_path, returns the path written to"
+    path = gcode_path + REPORT_SUFFIX
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=1)
+    return path
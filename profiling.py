@@ -0,0 +1,159 @@
+"""
+Logging, stage timers and counters for slicing, spiralizing and export.
+
+All modules log through logging.getLogger(__name__), below the logger of the package.
+Timers and counters go to the active Profile. profiled() makes a Profile active while one
+operation runs. Without an active Profile, timing and counting does nothing.
+"""
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import tempfile
+import time
+from contextlib import contextmanager, nullcontext
+
+log = logging.getLogger(__package__)
+
+LOG_LEVELS = ('WARNING', 'INFO', 'DEBUG')
+
+# Functions listed in the report of a run with cProfile
+CPROFILE_LINES = 30
+
+def set_log_level(level):
+    "Print log records of level and above of the whole package to stderr"
+    if not log.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(name)s %(levelname)s: %(message)s"))
+        log.addHandler(handler)
+        log.propagate = False
+    log.setLevel(level)
+
+class Profile:
+    "Stage timings, counters and distributions of observed values of one run of operation"
+    def __init__(self, operation):
+        self.operation = operation
+        self.seconds = 0.0
+        self.stages = {}
+        self.counters = {}
+        self.values = {} # name: [count, total, min, max]
+        self.cprofile = None
+        self.profiler = None
+        self.paused = 0.0 # seconds spent paused
+        self.paused_at = None
+
+    def pause(self):
+        "Stop the clock (and cProfile), e.g. while a modal operator waits for its next tick"
+        self.paused_at = time.perf_counter()
+        if self.profiler is not None:
+            self.profiler.disable()
+
+    def resume(self):
+        if self.paused_at is not None:
+            self.paused += time.perf_counter() - self.paused_at
+            self.paused_at = None
+        if self.profiler is not None:
+            self.profiler.enable()
+
+    @contextmanager
+    def stage(self, name):
+        "Time the with block, adding up the time of stages of the same name. Paused time does not count."
+        start, paused = time.perf_counter(), self.paused
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start - (self.paused - paused)
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, value):
+        "Add value to the distribution name"
+        if name in self.values:
+            stat = self.values[name]
+            stat[0] += 1
+            stat[1] += value
+            stat[2] = min(stat[2], value)
+            stat[3] = max(stat[3], value)
+        else:
+            self.values[name] = [1, value, value, value]
+
+    def report(self):
+        "The profile as a JSON serialisable dict"
+        report = {
+            'operation': self.operation,
+            'seconds': self.seconds,
+            'stages': self.stages,
+            'counters': self.counters,
+            'distributions': {name: {'count': count, 'mean': total / count, 'min': low, 'max': high}
+                              for name, (count, total, low, high) in self.values.items()},
+        }
+        if self.cprofile is not None:
+            report['cprofile'] = self.cprofile
+        return report
+
+# The Profile of the operation that is running, None if none is
+active = None
+
+# Report of the last run of every operation
+last_reports = {}
+
+def stage(name):
+    "Time the with block as stage name of the active Profile"
+    return nullcontext() if active is None else active.stage(name)
+
+def count(name, n=1):
+    if active is not None:
+        active.count(name, n)
+
+def observe(name, value):
+    if active is not None:
+        active.observe(name, value)
+
+def cprofile_summary(profiler, operation):
+    "Stats of profiler: the file they are dumped to and the functions taking the most cumulative time"
+    path = os.path.join(tempfile.gettempdir(), f"spiralizer_{operation}.prof")
+    profiler.dump_stats(path)
+    text = io.StringIO()
+    pstats.Stats(profiler, stream=text).sort_stats('cumulative').print_stats(CPROFILE_LINES)
+    return {'path': path, 'top': text.getvalue()}
+
+@contextmanager
+def profiled(operation, use_cprofile=False):
+    """
+    Make a new Profile of operation active in the with block, optionally running cProfile as well.
+    Afterwards its report is logged and kept in last_reports.
+    """
+    global active
+    profile = Profile(operation)
+    previous, active = active, profile
+    profiler = profile.profiler = cProfile.Profile() if use_cprofile else None
+    start = time.perf_counter()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield profile
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profile.cprofile = cprofile_summary(profiler, operation)
+        profile.seconds = time.perf_counter() - start - profile.paused
+        active = previous
+        report = profile.report()
+        last_reports[operation] = report
+        log.info("%s took %.3f s %s", operation, profile.seconds,
+                 json.dumps({key: report[key] for key in ('stages', 'counters')}))
+
+def summary_lines(report):
+    "Short lines describing report, for the panel"
+    stages = ", ".join(f"{name} {seconds:.2f}" for name, seconds in report['stages'].items())
+    lines = [f"{report['operation'].capitalize()}: {report['seconds']:.2f} s ({stages})"]
+    counters = [f"{name.replace('_', ' ')} {value}" for name, value in report['counters'].items()]
+    counters += [f"{name.replace('_', ' ')} {stat['min']}-{stat['max']}"
+                 for name, stat in report['distributions'].items()]
+    for i in range(0, len(counters), 2):
+        lines.append(", ".join(counters[i:i+2]))
+    return lines
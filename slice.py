@@ -1,94 +1,248 @@
+import logging
+import os
+
 import bpy
-import math
+import numpy as np
+
+from . import cache, profiling, slicer, ui
+
+log = logging.getLogger(__name__)
+
+def read_mesh_arrays(ob):
+    "World space vertex coordinates and loop triangles of mesh object ob"
+    me = ob.data
+    cos = np.empty(len(me.vertices)*3, dtype=np.float64)
+    me.vertices.foreach_get("co", cos)
+    cos = cos.reshape(-1, 3)
+    mat = np.array(ob.matrix_world)
+    cos = cos @ mat[:3, :3].T + mat[:3, 3]
+
+    me.calc_loop_triangles()
+    tris = np.empty(len(me.loop_triangles)*3, dtype=np.int32)
+    me.loop_triangles.foreach_get("vertices", tris)
+    return cos, tris.reshape(-1, 3)
+
+def read_vertex_colors(me):
+    "All color attributes of me as per-vertex RGBA arrays. Face corner colors are averaged per vertex."
+    colors = {}
+    for attr in me.color_attributes:
+        data = np.empty(len(attr.data)*4, dtype=np.float64)
+        attr.data.foreach_get("color", data)
+        data = data.reshape(-1, 4)
+        if attr.domain == 'CORNER':
+            loop_verts = np.empty(len(me.loops), dtype=np.int64)
+            me.loops.foreach_get("vertex_index", loop_verts)
+            counts = np.maximum(np.bincount(loop_verts, minlength=len(me.vertices)), 1)
+            data = np.stack([np.bincount(loop_verts, weights=data[:, k], minlength=len(me.vertices))
+                             for k in range(4)], axis=1) / counts[:, None]
+        elif attr.domain != 'POINT':
+            continue
+        colors[attr.name] = data
+    return colors
+
+def write_slices_mesh(mesh, points, point_layers, segments, point_colors,
+                      loop_idxs, loop_orders, loop_signs):
+    "Fill the empty mesh with the sliced points, segments and their loop order"
+    mesh.vertices.add(len(points))
+    mesh.vertices.foreach_set("co", points.astype(np.float32).ravel())
+    mesh.edges.add(len(segments))
+    mesh.edges.foreach_set("vertices", segments.astype(np.int32).ravel())
+
+    slice_idx_attr = mesh.attributes.new(name="slice_idx", type="INT", domain="POINT")
+    slice_idx_attr.data.foreach_set("value", point_layers.astype(np.int32))
+
+    # Loops are stored in walking order, spiralize reads them without walking edges
+    for name, values in (("loop_idx", loop_idxs), ("loop_order", loop_orders), ("loop_sign", loop_signs)):
+        attr = mesh.attributes.new(name=name, type="INT", domain="POINT")
+        attr.data.foreach_set("value", values.astype(np.int32))
+
+    for name, colors in point_colors.items():
+        color_attr = mesh.color_attributes.new(name=name, type="FLOAT_COLOR", domain="POINT")
+        color_attr.data.foreach_set("color", colors.astype(np.float32).ravel())
+
+    mesh.update()
+
+def write_layer_zs(mesh, zs, adaptive_heights):
+    "Keep the planes of adaptive slicing on the slices mesh, spiralize takes the layer heights from them"
+    if adaptive_heights is not None:
+        mesh['spiralizer_layer_z'] = zs.tolist()
+
+# Layers sliced per step by the modal slice operator
+SLICE_LAYERS_PER_STEP = 50
+
+def sliced_layers(array_cache, cos, tris, zs, colors, processes, layers_per_step=None):
+    """
+    Generator returning the result of slicer.slice_layers_parallel, read from array_cache instead if
+    the same mesh was sliced the same way before. With layers_per_step the planes are sliced in bands
+    of about that many layers, yielding the layers sliced and the number of planes after every band.
+    """
+    if array_cache is not None:
+        names = sorted(colors)
+        key = cache.digest(cos, tris, zs, *(colors[name] for name in names), stage='slice', color_names=names)
+        arrays = array_cache.get(key)
+        if arrays is not None:
+            log.info("Slices read from cache")
+            profiling.count('cache_hits')
+            return [arrays['points'], arrays['point_layers'], arrays['segments'],
+                    dict(zip(names, arrays['colors'])),
+                    arrays['loop_idxs'], arrays['loop_orders'], arrays['loop_signs']]
+
+    if layers_per_step is None:
+        result = slicer.slice_layers_parallel(cos, tris, zs, colors, processes)
+    else:
+        processes = processes or os.cpu_count() or 1
+        band_count = max(4 * processes, -(-len(zs) // layers_per_step))
+        result = yield from slicer.slice_bands(cos, tris, zs, colors, processes, band_count)
+    if array_cache is None:
+        return result
 
-def slice(context, dz):
-    """Cuts a mesh in slices of dz height"""
+    [points, point_layers, segments, point_colors, loop_idxs, loop_orders, loop_signs] = result
+    colors = np.array([point_colors[name] for name in names]).reshape(len(names), len(points), 4)
+    array_cache.put(key, {'points': points, 'point_layers': point_layers, 'segments': segments,
+                          'colors': colors,
+                          'loop_idxs': loop_idxs, 'loop_orders': loop_orders, 'loop_signs': loop_signs})
+    return result
+
+# Per sliced object, most recent last: its mesh arrays, the planes, the slices and the name of the slices object
+last_slices = {}
+LAST_SLICES_SIZE = 8
+
+def remember_slices(name, cos, tris, colors, zs, sliced, result_name):
+    "Keep the slicing of object name for previous_slices, forgetting removed objects and the oldest ones"
+    last_slices.pop(name, None)
+    for old_name in [old_name for old_name in last_slices if old_name not in bpy.data.objects]:
+        del last_slices[old_name]
+    while len(last_slices) >= LAST_SLICES_SIZE:
+        del last_slices[next(iter(last_slices))]
+    last_slices[name] = [cos, tris, colors, zs, sliced, result_name]
+
+def previous_slices(name, cos, tris, colors, zs):
+    """
+    The slices object of the last slicing of object name and the ranges of layers that changed since,
+    (None, None) if there is nothing to update. Different planes zs, after an edit that changed the z
+    extent of the mesh or its adaptive layer heights, need a full slicing.
+    """
+    if name not in last_slices:
+        return None, None
+    old_cos, old_tris, old_colors, old_zs, sliced, result_name = last_slices[name]
+    result_ob = bpy.data.objects.get(result_name)
+    if (result_ob is None or result_ob.name not in bpy.context.view_layer.objects or
+            not np.array_equal(old_zs, zs) or
+            len(result_ob.data.vertices) != len(sliced[0]) or
+            result_ob.data.get('spiralizer_slice_count') != len(zs)):
+        return None, None
+    ranges = slicer.changed_layers(old_cos, old_tris, old_colors, cos, tris, colors, zs)
+    if ranges is None:
+        return None, None
+    return result_ob, ranges
+
+def slice(context, dz, processes=1, array_cache=None, adaptive_heights=None):
+    """
+    Cuts a mesh in slices of dz height, using processes worker processes (None for all cores).
+    adaptive_heights (min height, max height, cusp height) varies the slice heights with the surface
+    slope instead, see slicer.adaptive_layer_zs. Their z values are kept on the slices object.
+    Slicing the same object again only slices the layers touched by the vertices moved since, inside
+    the existing slices object, unless the planes changed. With an array_cache a mesh that was sliced
+    before in another object or session is read from the cache.
+    """
+    for _ in slice_steps(context, dz, processes, array_cache, adaptive_heights):
+        pass
+
+def slice_steps(context, dz, processes=1, array_cache=None, adaptive_heights=None, layers_per_step=None):
+    """
+    Generator doing the work of slice(), in bands of layers_per_step layers if given (see sliced_layers).
+    The slices object is only created or changed in the last step, closing the generator early leaves
+    no trace of the slicing. Everything needed from context is read before the first step.
+    """
     ob = context.object
+    view_layer = context.view_layer
+    collection = view_layer.active_layer_collection.collection
     original_name = ob.name
     original_ob = bpy.data.objects[original_name]
 
-    # Apply all transforms to be able to read the correct data
-    bpy.ops.object.transform_apply(location=True, rotation=True, scale=True)
-    
+    with profiling.stage('read'):
+        # Apply all transforms to be able to read the correct data
+        bpy.ops.object.transform_apply(location=True, rotation=True, scale=True)
+
+        # Read the whole mesh once
+        cos, tris = read_mesh_arrays(original_ob)
+        colors = read_vertex_colors(original_ob.data)
+
     # Get extent in Z direction
-    z_min = math.inf
-    z_max = -math.inf
-    for v in original_ob.data.vertices:
-        v_world = original_ob.matrix_world @ v.co
-        if v_world.z > z_max:
-            z_max = v_world.z
-        if v_world.z < z_min:
-            z_min = v_world.z
-
-    N = math.ceil((z_max - z_min) / dz)
-    
-    # Prepare empty mesh to put result vertices
-    mesh_data = bpy.data.meshes.new(name="spiralizer_result")
-    result_ob = bpy.data.objects.new(name=f"{original_name}_slices", object_data=mesh_data)
-    result_ob.data['spiralizer_object_type'] = 'SLICES'
-    result_ob.data['spiralizer_slice_count'] = N
-    
-    # prerequisit for selection
-    context.view_layer.active_layer_collection.collection.objects.link(result_ob)    
-
-    # progress display
-    wm = bpy.context.window_manager
-    wm.progress_begin(0, N)
-    
-    for i in range(N):
-        print(f"Slicing {i}/{N}")
-        wm.progress_update(i)
-        
-        # Select original object
-        for o in bpy.context.scene.collection.objects:
-            o.select_set(False)
-        original_ob.select_set(True)
-        context.view_layer.objects.active = original_ob
-
-        # Create working copy of object
-        if bpy.ops.object.duplicate.poll():
-            bpy.ops.object.duplicate()    
-        context.object.name = 'slicer_working_copy'
-        working_copy_ob = bpy.data.objects['slicer_working_copy']
-    
-        # Go into edit mode
-        if bpy.ops.object.mode_set.poll():
-            bpy.ops.object.mode_set(mode='EDIT')
-
-        # all verts must be selected
-        bpy.ops.mesh.select_all(action='SELECT')
-
-        # Bisect to keep only one slice of slicer_working_copy    
-        if bpy.ops.mesh.bisect.poll():
-            z = z_min + i*dz
-            bpy.ops.mesh.bisect(plane_co=(0, 0, z), plane_no=(0, 0, 1), 
-                                use_fill=True, clear_inner=True, clear_outer=True)
-        
-        if bpy.ops.object.mode_set.poll():
-            bpy.ops.object.mode_set(mode='OBJECT')
-        
-        # Needs to be done in object mode    
-        # create slice_idx attr and set to current slice index
-        mesh = working_copy_ob.data
-        slice_idx_attr = mesh.attributes.new(name="slice_idx", type="INT", domain="POINT")
-        attr_values = [i for idx in range(len(mesh.vertices))]
-        slice_idx_attr.data.foreach_set("value", attr_values)    
-
-        # Select working copy and result
-        working_copy_ob.select_set(True)
-        result_ob.select_set(True)
-        context.view_layer.objects.active = result_ob
-    
-        # Join working copy data into result
-        if bpy.ops.object.join.poll():
-            bpy.ops.object.join()
-
-    wm.progress_end()
-
-class SliceOperator(bpy.types.Operator):
+    if adaptive_heights is None:
+        zs = slicer.layer_zs(cos[:, 2].min(), cos[:, 2].max(), dz)
+    else:
+        zs = slicer.adaptive_layer_zs(cos, tris, *adaptive_heights)
+    N = len(zs)
+    profiling.count('triangles', len(tris))
+    profiling.count('layers', N)
+
+    result_ob, ranges = previous_slices(original_name, cos, tris, colors, zs)
+    if result_ob is not None:
+        log.info("Slicing layers %s of %d again", ranges, N)
+        resliced = sum(end - first for first, end in ranges)
+        profiling.count('layers_resliced', resliced)
+        profiling.count('layers_skipped', N - resliced)
+        with profiling.stage('slice'):
+            sliced = slicer.reslice_layers(last_slices[original_name][4], cos, tris, zs, ranges, colors)
+        if ranges:
+            # Swap in a new mesh, the old one has the wrong number of points
+            old_mesh = result_ob.data
+            mesh_data = bpy.data.meshes.new(name="spiralizer_result")
+            with profiling.stage('write'):
+                write_slices_mesh(mesh_data, *sliced)
+            mesh_data['spiralizer_object_type'] = 'SLICES'
+            mesh_data['spiralizer_slice_count'] = N
+            write_layer_zs(mesh_data, zs, adaptive_heights)
+            result_ob.data = mesh_data
+            if old_mesh.users == 0:
+                bpy.data.meshes.remove(old_mesh)
+    else:
+        log.info("Slicing %d triangles into %d layers", len(tris), N)
+        # Cut and order the points of every layer along their loops
+        with profiling.stage('slice'):
+            sliced = yield from sliced_layers(array_cache, cos, tris, zs, colors, processes, layers_per_step)
+
+        # Put all layers into one new mesh
+        mesh_data = bpy.data.meshes.new(name="spiralizer_result")
+        with profiling.stage('write'):
+            write_slices_mesh(mesh_data, *sliced)
+        result_ob = bpy.data.objects.new(name=f"{original_name}_slices", object_data=mesh_data)
+        result_ob.data['spiralizer_object_type'] = 'SLICES'
+        result_ob.data['spiralizer_slice_count'] = N
+        write_layer_zs(result_ob.data, zs, adaptive_heights)
+
+        # prerequisit for selection
+        collection.objects.link(result_ob)
+
+    profiling.count('points', len(sliced[0]))
+    remember_slices(original_name, cos, tris, colors, zs, sliced, result_ob.name)
+
+    # Leave the result selected and active
+    for o in view_layer.objects:
+        o.select_set(False)
+    result_ob.select_set(True)
+    view_layer.objects.active = result_ob
+
+def settings_adaptive_heights(props):
+    "adaptive_heights argument of slice() from spiralizer_settings props, None for slices of equal height"
+    if not props.adaptive_layers:
+        return None
+    return props.min_extrusion_height, props.max_extrusion_height, props.cusp_height
+
+def operator_steps(context, interactive):
+    "slice_steps with the settings of the scene, in bands when the operator runs interactive"
+    props = context.scene.spiralizer_settings
+    with ui.profiled(props, 'slice'):
+        yield from slice_steps(context, props.extrusion_height, props.slice_processes or None,
+                               cache.from_settings(props), settings_adaptive_heights(props),
+                               SLICE_LAYERS_PER_STEP if interactive else None)
+
+class SliceOperator(ui.StepsOperator, bpy.types.Operator):
     """Slices the selected model along the z-axis"""
     bl_idname = "spiralizer.slice"
     bl_label = "Slice object"
+    step_function = staticmethod(operator_steps)
 
     @classmethod
     def poll(cls, context):
@@ -96,11 +250,3 @@ class SliceOperator(bpy.types.Operator):
             context.mode in {'OBJECT'} and \
             hasattr(context.active_object, 'data') and \
             context.active_object.data.get('spiralizer_object_type', None) == None
-    
-#    def invoke(self, context, event):
-#        return context.window_manager.invoke_props_dialog(self)
-    
-    def execute(self, context):
-        props = context.scene.spiralizer_settings
-        slice(context, props.extrusion_height)
-        return {'FINISHED'}
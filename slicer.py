@@ -0,0 +1,452 @@
+"""
+Cuts a mesh with horizontal planes and chains the cut points of every layer into ordered, oriented loops,
+optionally in z-bands by worker processes. slice.py reads the mesh in bulk and writes the layers back,
+so the workers import this module without Blender.
+"""
+import logging
+import multiprocessing
+import os
+from multiprocessing import shared_memory
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+def layer_zs(z_min, z_max, dz):
+    "Heights of the cutting planes for slices of dz height between z_min and z_max"
+    N = int(np.ceil((z_max - z_min) / dz))
+    return z_min + np.arange(N) * dz
+
+def adaptive_layer_zs(cos, tris, min_dz, max_dz, cusp_height):
+    """
+    Heights of the cutting planes from the bottom to the top of mesh cos/tris, spaced so that the steps
+    of every layer stand at most cusp_height off the surface. A facet tilted with normal n allows slices
+    of cusp_height / |n.z|, limited to min_dz..max_dz: vertical walls get max_dz, flat and strongly
+    curved regions thin layers. Every layer takes the smallest height the facets it reaches into allow.
+    """
+    z_min, z_max = cos[:, 2].min(), cos[:, 2].max()
+    corners = cos[tris]
+    normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    lengths = np.linalg.norm(normals, axis=1)
+    slopes = np.abs(normals[:, 2]) / np.where(lengths > 0, lengths, 1)
+    allowed = np.clip(cusp_height / np.maximum(slopes, 1e-12), min_dz, max_dz)
+
+    # Smallest allowed height per cell of the z range, only facets that limit the height matter
+    cell = min_dz / 2
+    cell_count = int((z_max - z_min) / cell) + 1
+    profile = np.full(cell_count, float(max_dz))
+    limiting = (allowed < max_dz) & (lengths > 0)
+    tri_zs = corners[limiting][:, :, 2]
+    first = ((tri_zs.min(axis=1) - z_min) / cell).astype(np.int64)
+    spans = ((tri_zs.max(axis=1) - z_min) / cell).astype(np.int64) - first + 1
+    offsets = np.arange(spans.sum()) - np.repeat(np.cumsum(spans) - spans, spans)
+    np.minimum.at(profile, np.repeat(first, spans) + offsets, np.repeat(allowed[limiting], spans))
+
+    zs = []
+    z = z_min
+    while z < z_max:
+        zs.append(z)
+        # Shrinking the layer can only drop limiting facets, stop once the height is stable
+        first_cell = int((z - z_min) / cell)
+        dz = max_dz
+        while True:
+            last_cell = min(int((z + dz - z_min) / cell), cell_count - 1)
+            limited = profile[first_cell:last_cell + 1].min()
+            if limited >= dz:
+                break
+            dz = limited
+        z += dz
+    return np.array(zs)
+
+def mesh_edges(tris, vert_count):
+    """
+    Unique undirected edges of triangles tris.
+    Returns the edges as (va, vb) with va < vb and for every triangle corner j the id of edge (j, j+1).
+    """
+    a = tris
+    b = np.roll(tris, -1, axis=1)
+    codes = np.minimum(a, b).astype(np.int64) * vert_count + np.maximum(a, b)
+    unique_codes, tri_edge_ids = np.unique(codes.ravel(), return_inverse=True)
+    edges = np.stack((unique_codes // vert_count, unique_codes % vert_count), axis=1)
+    return edges, tri_edge_ids.reshape(-1, 3)
+
+def slice_triangles(cos, tris, zs, vertex_data=None):
+    """
+    Intersect triangles with the horizontal planes at the sorted heights zs.
+
+    A vertex counts as above a plane if its z is > the plane's, so every triangle spanning a plane is cut
+    along exactly two of its edges. Cut points on shared edges are shared between triangles, cuts through
+    a vertex on the plane are one point for all its edges. Segments of no length and the points left
+    without a segment by them are dropped.
+
+    Returns point coordinates, the layer index of every point, the segments as pairs of point indices
+    and vertex_data (dict of per-vertex arrays) interpolated to the points. Points are ordered by layer.
+    """
+    cos = np.asarray(cos, dtype=np.float64)
+    tris = np.asarray(tris, dtype=np.int64).reshape(-1, 3)
+    zs = np.asarray(zs, dtype=np.float64)
+    layer_count = len(zs)
+    vertex_data = vertex_data or {}
+
+    # Triangles sorted by z-extent, each one only meets the planes in [z_min, z_max)
+    tri_zs = cos[:, 2][tris]
+    first_layer = np.searchsorted(zs, tri_zs.min(axis=1))
+    end_layer = np.searchsorted(zs, tri_zs.max(axis=1))
+    order = np.argsort(first_layer, kind='stable')
+    tris = tris[order]
+    tri_zs = tri_zs[order]
+    first_layer = first_layer[order]
+    span = (end_layer[order] - first_layer)
+
+    edges, tri_edge_ids = mesh_edges(tris, len(cos))
+
+    # One row per (triangle, plane) pair
+    pair_tri = np.repeat(np.arange(len(tris)), span)
+    pair_start = np.repeat(np.cumsum(span) - span, span)
+    pair_layer = np.repeat(first_layer, span) + np.arange(len(pair_tri)) - pair_start
+
+    # The lone corner is the one on the other side of the plane than the remaining two
+    above = tri_zs[pair_tri] > zs[pair_layer][:, None]
+    lone_above = above.sum(axis=1) == 1
+    lone = np.argmax(above == lone_above[:, None], axis=1)
+
+    # Cut edges are (lone, lone+1) and (lone+2, lone). Flipping the segment when the lone corner is above
+    # makes all segments of a consistently wound mesh run in the same direction around their loop.
+    edge_ids = tri_edge_ids[pair_tri]
+    rows = np.arange(len(pair_tri))
+    cut_a = np.where(lone_above, edge_ids[rows, (lone + 2) % 3], edge_ids[rows, lone])
+    cut_b = np.where(lone_above, edge_ids[rows, lone], edge_ids[rows, (lone + 2) % 3])
+
+    # Every cut edge per plane becomes one point
+    keys = np.concatenate((cut_a, cut_b)) * layer_count + np.concatenate((pair_layer, pair_layer))
+    unique_keys, point_ids = np.unique(keys, return_inverse=True)
+    point_edges = edges[unique_keys // layer_count]
+    point_layers = unique_keys % layer_count
+
+    # Cuts through a vertex on the plane become one point for all edges of that vertex, with va == vb
+    va, vb = point_edges[:, 0], point_edges[:, 1]
+    va = np.where(cos[vb, 2] == zs[point_layers], vb, va)
+    vb = np.where(cos[va, 2] == zs[point_layers], va, vb)
+    at_vertex = va == vb
+    if at_vertex.any():
+        merged_keys = np.where(at_vertex, -1 - (va * layer_count + point_layers), unique_keys)
+        _, first, merged = np.unique(merged_keys, return_index=True, return_inverse=True)
+        point_ids = merged[point_ids]
+        va, vb, point_layers, at_vertex = va[first], vb[first], point_layers[first], at_vertex[first]
+
+    # Interpolate along the (va < vb) edge so shared points are bit-identical
+    t = (zs[point_layers] - cos[va, 2]) / np.where(at_vertex, 1, cos[vb, 2] - cos[va, 2])
+    points = cos[va] + (cos[vb] - cos[va]) * t[:, None]
+    point_data = {}
+    for name, data in vertex_data.items():
+        data = np.asarray(data, dtype=np.float64)
+        point_data[name] = data[va] + (data[vb] - data[va]) * t.reshape((-1,) + (1,) * (data.ndim - 1))
+
+    # Drop segments between two cuts through the same vertex, then group the points left by layer
+    segments = point_ids.reshape(2, -1).T
+    segments = segments[segments[:, 0] != segments[:, 1]]
+    used = np.bincount(segments.ravel(), minlength=len(points)) > 0
+    by_layer = np.flatnonzero(used)[np.argsort(point_layers[used], kind='stable')]
+    remap = np.empty(len(points), dtype=np.int64)
+    remap[by_layer] = np.arange(len(by_layer))
+    segments = remap[segments]
+    for name in point_data:
+        point_data[name] = point_data[name][by_layer]
+
+    return points[by_layer], point_layers[by_layer], segments, point_data
+
+def chain_directed(segments, point_count):
+    """
+    Chain segments where every point has exactly one outgoing and one incoming segment.
+    Uses pointer jumping, so it needs log2(longest loop) array passes instead of one Python step per point.
+    Returns the loop label (smallest point index of the loop) and position in the loop of every point.
+    """
+    succ = np.empty(point_count, dtype=np.int64)
+    succ[segments[:, 0]] = segments[:, 1]
+    passes = int(np.ceil(np.log2(max(point_count, 2)))) + 1
+
+    labels = np.arange(point_count)
+    jump = succ.copy()
+    for _ in range(passes):
+        labels = np.minimum(labels, labels[jump])
+        jump = jump[jump]
+
+    # Steps to the last point of the loop, the one whose successor is the loop's first point
+    is_last = labels[succ] == succ
+    steps = np.where(is_last, 0, 1)
+    jump = np.where(is_last, np.arange(point_count), succ)
+    for _ in range(passes):
+        steps = steps + steps[jump]
+        jump = jump[jump]
+
+    loop_lengths = np.bincount(labels, minlength=point_count)
+    return labels, loop_lengths[labels] - 1 - steps
+
+def chain_undirected(segments, point_count):
+    """
+    Chain segments by walking an endpoint map, for meshes whose segments are not consistently oriented.
+    Open chains are walked from one of their ends.
+    Returns the loop label and position in the loop of every point.
+    """
+    neighbors = [[] for _ in range(point_count)]
+    for a, b in segments.tolist():
+        if a != b:
+            neighbors[a].append(b)
+            neighbors[b].append(a)
+
+    labels = [-1] * point_count
+    positions = [0] * point_count
+    ends = [p for p in range(point_count) if len(neighbors[p]) == 1]
+    for start in ends + list(range(point_count)):
+        if labels[start] >= 0:
+            continue
+        prev, cur, pos = -1, start, 0
+        while cur >= 0:
+            labels[cur] = start
+            positions[cur] = pos
+            pos += 1
+            nxt = -1
+            for q in neighbors[cur]:
+                if q != prev and labels[q] < 0:
+                    nxt = q
+                    break
+            prev, cur = cur, nxt
+    return np.array(labels, dtype=np.int64), np.array(positions, dtype=np.int64)
+
+def chain_loops(points, point_layers, segments):
+    """
+    Chain the segments of all layers into ordered loops.
+
+    Returns a point order that puts every layer's loops one after another, each in walking order, and for
+    the reordered points the index of their loop within the layer (0 is the longest), their position in the
+    loop and the orientation of the loop (>0 clockwise, <0 counter-clockwise when walked in order).
+    """
+    point_count = len(points)
+    outgoing = np.bincount(segments[:, 0], minlength=point_count)
+    incoming = np.bincount(segments[:, 1], minlength=point_count)
+    if len(segments) == point_count and (outgoing == 1).all() and (incoming == 1).all():
+        labels, positions = chain_directed(segments, point_count)
+    else:
+        labels, positions = chain_undirected(segments, point_count)
+
+    # Number the loops of each layer by decreasing length
+    loop_labels, point_loops, loop_lengths = np.unique(labels, return_inverse=True, return_counts=True)
+    loop_layers = point_layers[loop_labels]
+    by_layer = np.lexsort((-loop_lengths, loop_layers))
+    loop_ranks = np.empty(len(loop_labels), dtype=np.int64)
+    first_of_layer = np.searchsorted(loop_layers[by_layer], loop_layers[by_layer])
+    loop_ranks[by_layer] = np.arange(len(loop_labels)) - first_of_layer
+
+    loop_idxs = loop_ranks[point_loops]
+    order = np.lexsort((positions, loop_idxs, point_layers))
+
+    # Orientation of every loop in walking order
+    # https://stackoverflow.com/questions/1165647/how-to-determine-if-a-list-of-polygon-points-are-in-clockwise-order
+    ordered_loops = point_loops[order]
+    ordered_positions = positions[order]
+    loop_starts = np.flatnonzero(ordered_positions == 0)
+    nxt = np.arange(1, point_count + 1)
+    loop_ends = np.append(loop_starts[1:], point_count) - 1
+    nxt[loop_ends] = loop_starts
+    co = points[order]
+    area_terms = (co[nxt, 0] - co[:, 0]) * (co[nxt, 1] + co[:, 1])
+    loop_areas = np.bincount(ordered_loops, weights=area_terms, minlength=len(loop_labels))
+    loop_signs = np.where(loop_areas < 0, -1, 1)
+
+    return order, loop_idxs[order], ordered_positions, loop_signs[ordered_loops]
+
+def reorder_segments(order, segments):
+    "Segments referring to points that have been reordered by order"
+    remap = np.empty_like(order)
+    remap[order] = np.arange(len(order))
+    return remap[segments]
+
+def slice_layers(cos, tris, zs, vertex_data=None):
+    """
+    Slice and chain in one go.
+    Returns points, their layers, segments and vertex_data of the points, all in loop order,
+    followed by the loop_idx, loop_order and loop_sign of every point.
+    """
+    points, point_layers, segments, point_data = slice_triangles(cos, tris, zs, vertex_data)
+    order, loop_idxs, loop_orders, loop_signs = chain_loops(points, point_layers, segments)
+    return [points[order], point_layers[order], reorder_segments(order, segments),
+            {name: data[order] for name, data in point_data.items()},
+            loop_idxs, loop_orders, loop_signs]
+
+def slice_band(cos, tris, zs, vertex_data=None):
+    "slice_layers for the consecutive planes zs, only looking at the triangles reaching into them"
+    tri_zs = cos[:, 2][tris]
+    in_band = (tri_zs.max(axis=1) > zs[0]) & (tri_zs.min(axis=1) <= zs[-1])
+    return slice_layers(cos, tris[in_band], zs, vertex_data)
+
+def changed_layers(old_cos, old_tris, old_vertex_data, cos, tris, vertex_data, zs):
+    """
+    Ranges (first, end) of the layers of planes zs whose cuts differ between the old and the new mesh,
+    found from the triangles with a vertex that moved or changed its vertex_data.
+    No ranges if nothing changed, None if the meshes are not made of the same triangles.
+    """
+    if old_cos.shape != cos.shape or not np.array_equal(old_tris, tris) or set(old_vertex_data) != set(vertex_data):
+        return None
+    changed = (old_cos != cos).any(axis=1)
+    for name, data in vertex_data.items():
+        changed |= (np.asarray(old_vertex_data[name]) != np.asarray(data)).reshape(len(cos), -1).any(axis=1)
+    changed_tris = tris[changed[tris].any(axis=1)]
+
+    # A triangle is cut by the planes in [z_min, z_max), before and after the change
+    tri_zs = np.concatenate((old_cos[:, 2][changed_tris], cos[:, 2][changed_tris]), axis=1)
+    first = np.searchsorted(zs, tri_zs.min(axis=1))
+    end = np.searchsorted(zs, tri_zs.max(axis=1))
+    touched = np.cumsum(np.bincount(first, minlength=len(zs)+1) - np.bincount(end, minlength=len(zs)+1))[:len(zs)] > 0
+    edges = np.diff(np.concatenate(([0], touched.astype(np.int8), [0])))
+    return list(zip(np.flatnonzero(edges == 1).tolist(), np.flatnonzero(edges == -1).tolist()))
+
+def reslice_layers(sliced, cos, tris, zs, ranges, vertex_data=None):
+    "sliced, a result of slice_layers, with the layers in ranges (from changed_layers) sliced again"
+    tri_zs = cos[:, 2][tris]
+    tri_z_min, tri_z_max = tri_zs.min(axis=1), tri_zs.max(axis=1)
+    for first, end in sorted(ranges, reverse=True): # top down, so lower layers keep their point indices
+        band_zs = zs[first:end]
+        in_band = (tri_z_max > band_zs[0]) & (tri_z_min <= band_zs[-1])
+        sliced = splice_layers(sliced, slice_layers(cos, tris[in_band], band_zs, vertex_data), first, end)
+    return sliced
+
+def splice_layers(sliced, band, first, end):
+    """
+    Replace the layers first to end (exclusive) of sliced, a result of slice_layers, by band,
+    the result of slicing only the planes of those layers.
+    """
+    points, point_layers, segments, point_data, loop_idxs, loop_orders, loop_signs = sliced
+    a, b = np.searchsorted(point_layers, [first, end])
+    shift = len(band[0]) - (b - a)
+
+    # Segments never leave their layer
+    before = segments[segments[:, 0] < a]
+    after = segments[segments[:, 0] >= b] + shift
+    return [np.concatenate((points[:a], band[0], points[b:])),
+            np.concatenate((point_layers[:a], band[1] + first, point_layers[b:])),
+            np.concatenate((before, band[2] + a, after)),
+            {name: np.concatenate((data[:a], band[3][name], data[b:])) for name, data in point_data.items()},
+            np.concatenate((loop_idxs[:a], band[4], loop_idxs[b:])),
+            np.concatenate((loop_orders[:a], band[5], loop_orders[b:])),
+            np.concatenate((loop_signs[:a], band[6], loop_signs[b:]))]
+
+def band_bounds(cos, tris, zs, band_count):
+    "Split the planes zs into band_count bands with about the same number of triangle/plane cuts"
+    tri_zs = cos[:, 2][tris]
+    first_layer = np.searchsorted(zs, tri_zs.min(axis=1))
+    end_layer = np.searchsorted(zs, tri_zs.max(axis=1))
+    cuts = np.cumsum(np.bincount(first_layer, minlength=len(zs)+1) - np.bincount(end_layer, minlength=len(zs)+1))
+    work = np.cumsum(cuts[:len(zs)])
+    bounds = np.searchsorted(work, np.linspace(0, work[-1], band_count+1)[1:-1])
+    return np.unique(np.concatenate(([0], bounds, [len(zs)])))
+
+def share_array(array):
+    "Copy array into a new shared memory block. Returns the block and a picklable description of the array."
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+    return block, (block.name, array.shape, array.dtype.str)
+
+def _attach_array(description):
+    name, shape, dtype = description
+    block = shared_memory.SharedMemory(name=name)
+    return block, np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+def _slice_band(job):
+    "Worker: slice the planes of one band from the shared mesh arrays"
+    cos_description, tris_description, data_descriptions, zs = job
+    blocks = []
+    try:
+        block, cos = _attach_array(cos_description)
+        blocks.append(block)
+        block, tris = _attach_array(tris_description)
+        blocks.append(block)
+        vertex_data = {}
+        for name, description in data_descriptions.items():
+            block, vertex_data[name] = _attach_array(description)
+            blocks.append(block)
+
+        return slice_band(cos, tris, zs, vertex_data)
+    finally:
+        del cos, tris, vertex_data
+        for block in blocks:
+            block.close()
+
+def merge_bands(bands, bounds, names):
+    "One result of slice_layers from the results of slicing the bands of planes between bounds"
+    # Bands hold consecutive planes, so concatenating keeps points ordered by layer
+    point_offsets = np.cumsum([0] + [len(band[0]) for band in bands])
+    return [np.concatenate([band[0] for band in bands]),
+            np.concatenate([band[1] + lo for band, lo in zip(bands, bounds)]),
+            np.concatenate([band[2] + offset for band, offset in zip(bands, point_offsets)]),
+            {name: np.concatenate([band[3][name] for band in bands]) for name in names},
+            np.concatenate([band[4] for band in bands]),
+            np.concatenate([band[5] for band in bands]),
+            np.concatenate([band[6] for band in bands])]
+
+def slice_bands(cos, tris, zs, vertex_data=None, processes=1, band_count=None):
+    """
+    Generator slicing the planes zs in band_count z-bands, by worker processes that read a shared,
+    read-only copy of the mesh arrays unless processes is 1.
+    Yields the number of layers sliced and the number of planes after every band,
+    returns the merged result of slice_layers. Closing it early stops the workers.
+    If the workers fail, e.g. because they cannot be started, the remaining bands are sliced in this process.
+    """
+    cos = np.ascontiguousarray(cos, dtype=np.float64)
+    tris = np.ascontiguousarray(tris, dtype=np.int64).reshape(-1, 3)
+    zs = np.asarray(zs, dtype=np.float64)
+    vertex_data = vertex_data or {}
+    bounds = band_bounds(cos, tris, zs, band_count or 4 * processes)
+    bands = []
+    if processes == 1:
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            bands.append(slice_band(cos, tris, zs[lo:hi], vertex_data))
+            yield int(hi), len(zs)
+        return merge_bands(bands, bounds, vertex_data)
+
+    blocks = []
+    try:
+        block, cos_description = share_array(cos)
+        blocks.append(block)
+        block, tris_description = share_array(tris)
+        blocks.append(block)
+        data_descriptions = {}
+        for name, data in vertex_data.items():
+            block, data_descriptions[name] = share_array(np.ascontiguousarray(data, dtype=np.float64))
+            blocks.append(block)
+
+        jobs = [(cos_description, tris_description, data_descriptions, zs[lo:hi])
+                for lo, hi in zip(bounds[:-1], bounds[1:])]
+        try:
+            with multiprocessing.get_context('spawn').Pool(processes) as pool:
+                for band, hi in zip(pool.imap(_slice_band, jobs), bounds[1:]):
+                    bands.append(band)
+                    yield int(hi), len(zs)
+        except Exception as e:
+            log.warning("Slicing worker processes failed, slicing in this process: %s", e)
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    for lo, hi in zip(bounds[len(bands):-1], bounds[len(bands)+1:]):
+        bands.append(slice_band(cos, tris, zs[lo:hi], vertex_data))
+        yield int(hi), len(zs)
+    return merge_bands(bands, bounds, vertex_data)
+
+def slice_layers_parallel(cos, tris, zs, vertex_data=None, processes=None):
+    """
+    Same as slice_layers, but the planes are split into z-bands that worker processes slice
+    from a shared, read-only copy of the mesh arrays. The bands are merged in layer order.
+    """
+    processes = processes or os.cpu_count() or 1
+    if processes == 1 or len(zs) < 2 * processes:
+        return slice_layers(np.ascontiguousarray(cos, dtype=np.float64),
+                            np.ascontiguousarray(tris, dtype=np.int64).reshape(-1, 3),
+                            np.asarray(zs, dtype=np.float64), vertex_data or {})
+
+    bands = slice_bands(cos, tris, zs, vertex_data, processes)
+    while True:
+        try:
+            next(bands)
+        except StopIteration as done:
+            return done.value
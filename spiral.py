@@ -0,0 +1,589 @@
+"""
+Turns the loops of sliced layers into one toolpath that climbs from every layer's loop to the one above it,
+with the extrusion height, width, material and feed rate of every point.
+mathutils provides the KD-tree when it is there, so this also runs without Blender.
+"""
+import logging
+
+import numpy as np
+
+from . import decimate, profiling
+
+log = logging.getLogger(__name__)
+
+try:
+    from mathutils import kdtree
+except ImportError:
+    kdtree = None
+
+class LayerIndex:
+    """
+    Spiral loops of the slices grouped by layer, from the per-point layer, loop, loop order and loop sign
+    arrays the slicer produces. Only the longest loop of every layer is indexed, in the walking order
+    stored by the slicer. Afterwards the verts of a layer are a slice of one ordered array.
+    """
+    def __init__(self, slice_idxs, loop_idxs, loop_orders, loop_signs, layer_count):
+        self.loop_orders = np.asarray(loop_orders)
+        slice_idxs = np.asarray(slice_idxs)
+        loop_idxs = np.asarray(loop_idxs)
+        loop_signs = np.asarray(loop_signs)
+
+        main_loop = np.flatnonzero(loop_idxs == 0)
+        self.layer_count = layer_count
+        self.order = main_loop[np.lexsort((self.loop_orders[main_loop], slice_idxs[main_loop]))]
+        counts = np.bincount(slice_idxs[main_loop], minlength=layer_count)[:layer_count]
+        self.offsets = np.zeros(layer_count+1, dtype=np.int64)
+        np.cumsum(counts, out=self.offsets[1:])
+        self.nonempty = np.flatnonzero(counts)
+        self.signs = np.ones(layer_count, dtype=np.int32)
+        self.signs[slice_idxs[main_loop]] = loop_signs[main_loop]
+        self.slice_idxs = slice_idxs
+
+    def count(self, layer_idx):
+        "Number of verts in layer layer_idx"
+        if layer_idx < 0 or layer_idx >= self.layer_count:
+            return 0
+        return int(self.offsets[layer_idx+1] - self.offsets[layer_idx])
+
+    def verts(self, layer_idx):
+        "Returns indices of all verts belonging to layer layer_idx"
+        if layer_idx < 0 or layer_idx >= self.layer_count:
+            return self.order[:0]
+        return self.order[self.offsets[layer_idx]:self.offsets[layer_idx+1]]
+
+    def oriented_loop(self, layer_idx, start_idx, wanted_rotation_direction):
+        "Verts of the loop of layer layer_idx, starting at vert start_idx and rotating in wanted_rotation_direction"
+        idxs = self.verts(layer_idx)
+        start = self.loop_orders[start_idx]
+        if self.signs[layer_idx] * wanted_rotation_direction > 0: # stored order rotates in wanted direction
+            return np.roll(idxs, -start)
+        else:
+            return np.roll(idxs[::-1], start + 1 - len(idxs))
+
+    def loop_key(self, cos, layer_idx):
+        "Hashable content of the loop of layer layer_idx at the points cos: its points in order and its orientation"
+        if layer_idx < 0 or layer_idx >= self.layer_count:
+            return None
+        idxs = self.verts(layer_idx)
+        return cos[idxs].tobytes(), self.loop_orders[idxs].tobytes(), int(self.signs[layer_idx])
+
+    def relative(self, idxs, layer_idx):
+        "Positions of verts of layer layer_idx and the layers above, counted from the first vert of layer_idx"
+        return self.loop_orders[idxs] + self.offsets[self.slice_idxs[idxs]] - self.offsets[layer_idx]
+
+    def absolute(self, positions, layer_idx):
+        "Verts at positions counted from the first vert of layer layer_idx, the inverse of relative"
+        return self.order[positions + self.offsets[layer_idx]]
+
+    def next_nonempty(self, layer_idx):
+        "First layer >= layer_idx that contains verts, None if there is none"
+        i = np.searchsorted(self.nonempty, layer_idx)
+        if i == len(self.nonempty):
+            return None
+        return int(self.nonempty[i])
+
+# Above this many query/layer point pairs find_batch uses the KD-tree instead of brute force (if there is mathutils)
+BATCH_PAIR_LIMIT = 1 << 22
+
+class LayerKDTrees:
+    """
+    One KD-tree per layer, built on first use and dropped once the spiral has moved past the layer.
+    Lookups only see the points of the queried layer, so no filter callback is needed.
+    Without mathutils (outside Blender) all lookups are brute force.
+    """
+    def __init__(self, layers, cos):
+        self.layers = layers
+        self.cos = cos
+        self.trees = {}
+
+    def get(self, layer_idx):
+        "Returns KD-tree of layer layer_idx and the vertex indices its items refer to"
+        if layer_idx not in self.trees:
+            idxs = self.layers.verts(layer_idx)
+            kd = kdtree.KDTree(len(idxs))
+            for i, co in enumerate(self.cos[idxs].tolist()):
+                kd.insert(co, i)
+            kd.balance()
+            self.trees[layer_idx] = (kd, idxs)
+        return self.trees[layer_idx]
+
+    def evict_below(self, layer_idx):
+        "Drop the trees of all layers below layer_idx"
+        for i in [i for i in self.trees if i < layer_idx]:
+            del self.trees[i]
+
+    def find_batch(self, layer_idx, query_cos):
+        """
+        Closest verts in layer layer_idx for every row of query_cos.
+        Returns coordinate and vertex index arrays, (None, None) if the layer is empty.
+        """
+        idxs = self.layers.verts(layer_idx)
+        if len(idxs) == 0:
+            return None, None
+        layer_cos = self.cos[idxs].astype(np.float64)
+        query_cos = np.asarray(query_cos, dtype=np.float64)
+        profiling.count('kd_queries', len(query_cos))
+
+        if len(query_cos) * len(idxs) > BATCH_PAIR_LIMIT and kdtree is not None:
+            # Too many pairs for brute force, let the tree prune
+            kd, _ = self.get(layer_idx)
+            local = np.fromiter((kd.find(co)[1] for co in query_cos.tolist()),
+                                dtype=np.int64, count=len(query_cos))
+        else:
+            # |q-p|^2 = |q|^2 - 2 q.p + |p|^2, the |q|^2 term does not change the argmin.
+            # Queries are taken in chunks of at most BATCH_PAIR_LIMIT pairs.
+            layer_sq = (layer_cos*layer_cos).sum(axis=1)
+            chunk = max(1, BATCH_PAIR_LIMIT // len(idxs))
+            local = np.concatenate([np.argmin(layer_sq[None, :] - 2*(query_cos[i:i+chunk] @ layer_cos.T), axis=1)
+                                    for i in range(0, len(query_cos), chunk)] or [np.empty(0, dtype=np.int64)])
+        return layer_cos[local], idxs[local]
+
+def find_closest_v(kds, layer_idx, co):
+    "Find vert in layer closes to co"
+    if kdtree is None:
+        cos, idxs = kds.find_batch(layer_idx, [co])
+        if cos is None:
+            return None, None
+        return cos[0], int(idxs[0])
+    kd, idxs = kds.get(layer_idx)
+    profiling.count('kd_queries')
+    co, i, dist = kd.find(co)
+    if i is None:
+        return None, None
+    return co, int(idxs[i])
+
+def loop_params(loop_cos):
+    """
+    Normalised arc length of every point of the closed loop loop_cos, measured from its first point.
+    The loop's first point is appended at the end with parameter 1.
+    """
+    closed = np.concatenate((loop_cos, loop_cos[:1]))
+    s = np.concatenate(([0.0], np.cumsum(np.linalg.norm(np.diff(closed, axis=0), axis=1))))
+    if s[-1] == 0:
+        return closed, np.linspace(0, 1, len(closed))
+    return closed, s / s[-1]
+
+def resample_loop(closed, params, t):
+    "Points at normalised arc lengths t along a loop as returned by loop_params"
+    return np.stack([np.interp(t, params, closed[:, k]) for k in range(3)], axis=1)
+
+def loop_sources(loop_cos, loop_idxs, t):
+    """
+    The two vertices of the closed loop loop_idxs (at loop_cos) around every normalised arc length t,
+    and their weights in the point at t. Returns index and weight arrays of shape (len(t), 2).
+    """
+    _, params = loop_params(loop_cos)
+    j = np.clip(np.searchsorted(params, t, side='right') - 1, 0, len(loop_idxs) - 1)
+    span = params[j+1] - params[j]
+    frac = np.where(span > 0, (t - params[j]) / np.where(span > 0, span, 1), 0.0)
+    return (np.stack((loop_idxs[j], loop_idxs[(j+1) % len(loop_idxs)]), axis=1),
+            np.stack((1 - frac, frac), axis=1))
+
+def sample_points(values, sources):
+    "Per-vertex values at the points made of the weighted source vertices sources, as mk_outline_layer returns them"
+    idxs, weights = sources
+    return (np.asarray(values)[idxs] * weights).sum(axis=1)
+
+def arc_length_correspondence(lower_cos, higher_cos):
+    """
+    Points of the higher loop at the normalised arc lengths of the points of the lower loop, both starting
+    at their aligned seams. A turn keeps one point per lower vertex, like CLOSEST does.
+    Returns the higher points and the lower points' parameters in [0, 1).
+    """
+    _, lower_params = loop_params(lower_cos)
+    higher_closed, higher_params = loop_params(higher_cos)
+    t = lower_params[:-1]
+    return resample_loop(higher_closed, higher_params, t), t
+
+def mk_outline_layer(kds, lower_idxs, next_layer_idx, next_loop_idxs,
+                     ramp_mode, thickness_mode, interpolation_mode,
+                     default_extrusion_height):
+    """
+    Points of one turn from the loop lower_idxs towards layer next_layer_idx, their extrusion heights
+    and their sources: the slice vertices every point is interpolated from and their weights
+    (see sample_points). next_loop_idxs is the loop of the next layer, needed for ARC_LENGTH.
+    Empty arrays if the next layer has no points.
+    """
+    verts_in_layer = len(lower_idxs)
+    lower_cos = kds.cos[lower_idxs].astype(np.float64)
+
+    if interpolation_mode == 'CLOSEST':
+        # Find corresponding points in next_layer, all at once
+        higher_cos, higher_idxs = kds.find_batch(next_layer_idx, lower_cos)
+        alpha = np.arange(verts_in_layer) / verts_in_layer # 0 at beginning of layer, 1 at end
+        lower_sources = (lower_idxs[:, None], np.ones((verts_in_layer, 1)))
+        higher_sources = (higher_idxs[:, None], np.ones((verts_in_layer, 1))) if higher_idxs is not None else None
+    elif interpolation_mode == 'ARC_LENGTH':
+        # Walk both loops at the same normalised arc length
+        if next_loop_idxs is None or len(next_loop_idxs) == 0:
+            higher_cos = None
+        else:
+            next_loop_cos = kds.cos[next_loop_idxs].astype(np.float64)
+            higher_cos, alpha = arc_length_correspondence(lower_cos, next_loop_cos)
+            lower_sources = (lower_idxs[:, None], np.ones((verts_in_layer, 1)))
+            higher_sources = loop_sources(next_loop_cos, next_loop_idxs, alpha)
+    else:
+        raise RuntimeError("Bug: unknown interpolation_mode")
+
+    if higher_cos is None:
+        return [np.empty((0, 3)), np.empty(0), (np.empty((0, 2), dtype=np.int64), np.empty((0, 2)))]
+    point_count = len(alpha)
+
+    # How to interpolate between this and next layer?
+    if ramp_mode == 'FLAT':
+        lerp_factor = np.zeros(point_count) # Use bottom
+    elif ramp_mode == 'SPIRAL':
+        lerp_factor = alpha
+    else:
+        raise RuntimeError("Bug: unknown ramp_mode")
+
+    # Toolhead position
+    interp_vs = lower_cos + (higher_cos - lower_cos) * lerp_factor[:, None]
+    sources = (np.concatenate((lower_sources[0], higher_sources[0]), axis=1),
+               np.concatenate((lower_sources[1] * (1 - lerp_factor[:, None]),
+                               higher_sources[1] * lerp_factor[:, None]), axis=1))
+
+    # Extrusion amount control
+    if thickness_mode == 'UP':
+        extr_heights = alpha * default_extrusion_height
+    elif thickness_mode == 'DOWN':
+        extr_heights = (1-alpha) * default_extrusion_height
+    elif thickness_mode == 'CONSTANT':
+        extr_heights = np.full(point_count, default_extrusion_height)
+    else:
+        raise RuntimeError("Bug: unknown thickness_mode")
+
+    return [interp_vs, extr_heights, sources]
+
+def splice_turn(interp_vs, sources, vert_idx, extrusion_width, extrusion_material_idx,
+                feedrate_colors=None, width_colors=None, extrusion_width_black=0):
+    """
+    Edges, widths, material indices and feedrate factors of the turn points interp_vs placed at output
+    index vert_idx. Feedrate factors and widths are sampled from the per-vertex grayscale feedrate_colors
+    and width_colors at the points' sources, black giving extrusion_width_black and white extrusion_width.
+    Returns them and the output index after the turn.
+    """
+    point_count = len(interp_vs)
+    out_idxs = np.arange(vert_idx, vert_idx+point_count)
+    interp_es = np.stack((out_idxs, out_idxs+1), axis=1)
+
+    # Feedrate
+    if feedrate_colors is not None:
+        extr_feedrate_facts = sample_points(feedrate_colors, sources)
+    else:
+        extr_feedrate_facts = np.ones(point_count)
+
+    if width_colors is not None:
+        extr_widths = extrusion_width_black + sample_points(width_colors, sources) * (extrusion_width - extrusion_width_black)
+    else:
+        extr_widths = np.full(point_count, extrusion_width)
+    extr_mat_idxs = np.full(point_count, extrusion_material_idx, dtype=np.int32)
+
+    return [interp_es, extr_widths, extr_mat_idxs, extr_feedrate_facts,
+            vert_idx + point_count]
+
+class TurnMemo:
+    """
+    Turns of the last spiral, kept to build the next one with the same parameters.
+    A turn is keyed by the loops of its layer and the next one, its layer delta, subphase, extrusion height and
+    start vertex, and keeps its vertex indices counted from the first vertex of its layer. Material index,
+    output indices, feedrate and width maps are only applied when the turns are spliced together, so changing
+    the filament change layers or the slices of some layers only recomputes the turns around the layers that
+    changed. Only the turns of the last spiral are kept.
+    """
+    def __init__(self):
+        self.key = None
+        self.turns = {}
+
+    def use(self, key):
+        "Forget all turns unless they were computed for key"
+        if key != self.key:
+            self.key = key
+            self.turns = {}
+
+def parse_layer_list(text):
+    "Layer indices in the comma separated text, entries that are no integers are ignored"
+    layer_idxs = []
+    for item in text.split(","):
+        try:
+            layer_idxs.append(int(item.strip()))
+        except ValueError:
+            pass
+    return layer_idxs
+
+def layer_heights_from_zs(zs):
+    "Height of every layer up to the plane of the next one, the top layer as high as the one below it"
+    heights = np.diff(zs)
+    return np.append(heights, heights[-1:])
+
+def spiralize_layers(cos, layers, rotation_direction,
+                     default_extrusion_height, default_extrusion_width,
+                     filament_change_layers=(), feedrate_colors=None,
+                     interpolation_mode='CLOSEST', decimate_tolerance=0, progress=None, turn_memo=None,
+                     width_colors=None, extrusion_width_black=0, layer_heights=None):
+    """
+    Spiral toolpath through the loops of layers (a LayerIndex) of the slice points cos.
+    feedrate_colors and width_colors are per-point grayscale values of the feedrate and width maps,
+    a width map scales the width between extrusion_width_black and default_extrusion_width.
+    layer_heights (see layer_heights_from_zs) replace default_extrusion_height for slices of varying height.
+    progress(layer_idx) is called after every turn. Turns found in turn_memo (a TurnMemo) are reused,
+    new ones are added to it.
+    Returns the points and edges of the path and its per-point extrusion heights, widths, material
+    indices and feedrate factors.
+    """
+    turns = spiral_turns(cos, layers, rotation_direction, default_extrusion_height, default_extrusion_width,
+                         filament_change_layers, feedrate_colors, interpolation_mode, decimate_tolerance, turn_memo,
+                         width_colors, extrusion_width_black, layer_heights)
+    while True:
+        try:
+            layer_idx, _ = next(turns)
+        except StopIteration as done:
+            return done.value
+        if progress is not None:
+            progress(layer_idx)
+
+def spiral_turns(cos, layers, rotation_direction,
+                 default_extrusion_height, default_extrusion_width,
+                 filament_change_layers=(), feedrate_colors=None,
+                 interpolation_mode='CLOSEST', decimate_tolerance=0, turn_memo=None,
+                 width_colors=None, extrusion_width_black=0, layer_heights=None):
+    """
+    Generator doing the work of spiralize_layers one turn at a time. Yields the layer index of the turn
+    and the layer count after every turn, returns the result of spiralize_layers.
+    turn_memo only changes once the spiral is complete, closing the generator early leaves it as it was.
+    """
+    kds = LayerKDTrees(layers, np.asarray(cos, dtype=np.float32))
+
+    # Find first layer with geometry in it and start on the one above
+    read_layer_idx = layers.next_nonempty(1)
+    if read_layer_idx is not None:
+        read_layer_idx = layers.next_nonempty(read_layer_idx + 1)
+    if read_layer_idx is None:
+        raise RuntimeError("Slices contain less than two layers with geometry")
+
+    # Start-vertex in this layer
+    v_start_layer = int(layers.verts(read_layer_idx)[0]) # random vertex on starting layer
+
+    # loops are walked in this direction
+    wanted_rotation_direction = 1 if rotation_direction == 'CW' else -1
+
+    # Work
+    output_vs = [] # interpolated vertices, one array per layer
+    output_es = [] # interpolated edges
+    extrusion_heights = []
+    extrusion_widths = []
+    extrusion_material_idxs = []
+    extrusion_feedrate_factors = []
+
+    used_turns = {}
+
+    vert_idx = 0
+    spiral_turn_idx = 0
+    ramp_mode = None
+    thickness_mode = None
+    print_phase = None
+    print_subphase = None
+    read_layer_idx_delta = None
+    extrusion_material_idx = 0
+    extrusion_height = default_extrusion_height
+    extrusion_width = default_extrusion_width
+
+    # TODO: Inset by half extrusion_width.
+    # TODO: maybe loop until layers.layer_count instead.
+    while True:
+        # print_phase  print_subphase
+        # ---------------------------
+        # BOTTOM       FLAT                |
+        # BOTTOM       RAMP_UP             | up
+        # SPIRAL       SPIRAL              |
+        # ...                              v
+        # SPIRAL       SPIRAL
+        # FILAMENT_CH. RAMP_DOWN
+        # FILAMENT_CH. RAMP_UP
+        # SPIRAL       SPIRAL
+        # ...
+        # SPIRAL       SPIRAL
+        # TOP          RAMP_DOWN
+        if spiral_turn_idx == 0:
+            print_phase = 'BOTTOM'
+            print_subphase = 'FLAT'
+            read_layer_idx_delta = 0
+        elif print_phase == 'BOTTOM' and print_subphase == 'FLAT':
+            print_subphase = 'RAMP_UP'
+            read_layer_idx_delta = 1
+        elif print_phase == 'BOTTOM' and print_subphase == 'RAMP_UP':
+            print_phase = 'SPIRAL'
+            print_subphase = 'SPIRAL'
+            read_layer_idx_delta = 1
+        elif read_layer_idx in filament_change_layers and ramp_mode == 'SPIRAL':
+            print_phase = 'FILAMENT_CHANGE'
+            print_subphase = 'RAMP_DOWN'
+            read_layer_idx_delta = 0
+        elif print_phase == 'FILAMENT_CHANGE' and print_subphase == 'RAMP_DOWN':
+            print_subphase = 'RAMP_UP'
+            read_layer_idx_delta = 1
+            extrusion_material_idx = extrusion_material_idx + 1
+        elif print_phase == 'FILAMENT_CHANGE' and print_subphase == 'RAMP_UP':
+            print_phase = 'SPIRAL'
+            print_subphase = 'SPIRAL'
+            read_layer_idx_delta = 1
+        elif read_layer_idx == layers.layer_count-1 and read_layer_idx_delta == 1:
+            print_phase = 'TOP'
+            print_subphase = 'RAMP_DOWN'
+            read_layer_idx_delta = 0
+        elif read_layer_idx == layers.layer_count-1 and read_layer_idx_delta == 0:
+            break
+            
+        # Determine process params
+        if print_subphase == 'FLAT':
+            ramp_mode = 'FLAT'
+            thickness_mode = 'CONSTANT'
+        elif print_subphase == 'RAMP_UP':
+            ramp_mode = 'SPIRAL'
+            thickness_mode = 'UP'
+        elif print_subphase == 'RAMP_DOWN':
+            ramp_mode = 'FLAT'
+            thickness_mode = 'DOWN'
+        elif print_subphase == 'SPIRAL':
+            ramp_mode = 'SPIRAL'
+            thickness_mode = 'CONSTANT'
+        else:
+            raise RuntimeError("Bug: Unknown subphase")
+
+        verts_in_layer = layers.count(read_layer_idx)
+        if verts_in_layer == 0:
+            # Skip straight to the next layer with geometry
+            profiling.count('layers_skipped')
+            read_layer_idx = layers.next_nonempty(read_layer_idx)
+            if read_layer_idx is None:
+                break
+            _, v_start_layer = find_closest_v(kds, read_layer_idx, kds.cos[v_start_layer].tolist())
+            continue
+
+        next_layer_idx = read_layer_idx + read_layer_idx_delta
+        if layer_heights is not None:
+            extrusion_height = float(layer_heights[read_layer_idx])
+
+        log.debug("Turn %d on layer %d (+%d): %s %s, ramp %s, thickness %s, %d verts",
+                  spiral_turn_idx, read_layer_idx, read_layer_idx_delta, print_phase, print_subphase,
+                  ramp_mode, thickness_mode, verts_in_layer)
+        profiling.observe('layer_vertices', verts_in_layer)
+
+        turn = None
+        if turn_memo is not None:
+            turn_key = (layers.loop_key(kds.cos, read_layer_idx), layers.loop_key(kds.cos, next_layer_idx),
+                        read_layer_idx_delta, print_subphase, extrusion_height,
+                        int(layers.relative(v_start_layer, read_layer_idx)))
+            turn = turn_memo.turns.get(turn_key)
+        if turn is None:
+            lower_idxs = layers.oriented_loop(read_layer_idx, v_start_layer, wanted_rotation_direction)
+
+            next_idxs = None
+            if interpolation_mode == 'ARC_LENGTH':
+                # Next layer's loop in the same direction, starting at the seam aligned with the start vertex
+                _, next_v_idx = find_closest_v(kds, next_layer_idx, kds.cos[v_start_layer].tolist())
+                if next_v_idx is not None:
+                    next_idxs = layers.oriented_loop(next_layer_idx, next_v_idx, wanted_rotation_direction)
+
+            [output_vs_layer, extrusion_heights_layer,
+             sources] = mk_outline_layer(kds, lower_idxs, next_layer_idx, next_idxs,
+                                         ramp_mode, thickness_mode, interpolation_mode,
+                                         extrusion_height)
+
+            # Find the corresponding v on next_layer to use as new start
+            try:
+                _, next_v_start = find_closest_v(kds, next_layer_idx, kds.cos[v_start_layer].tolist())
+            except (IndexError, AttributeError):
+                next_v_start = None
+            # Vertex indices relative to the layer stay valid when the slices of other layers change
+            if next_v_start is not None:
+                next_v_start = int(layers.relative(next_v_start, read_layer_idx))
+            turn = (output_vs_layer, extrusion_heights_layer,
+                    (layers.relative(sources[0], read_layer_idx), sources[1]), next_v_start)
+            profiling.count('turns')
+        else:
+            profiling.count('turns_reused')
+        if turn_memo is not None:
+            used_turns[turn_key] = turn
+        output_vs_layer, extrusion_heights_layer, (source_positions, source_weights), next_v_start = turn
+        sources = (layers.absolute(source_positions, read_layer_idx), source_weights)
+        if next_v_start is not None:
+            next_v_start = int(layers.absolute(next_v_start, read_layer_idx))
+
+        [output_es_layer,
+         extrusion_widths_layer, extrusion_material_idxs_layer, extrusion_feedrate_factors_layer,
+         vert_idx] = splice_turn(output_vs_layer, sources, vert_idx, extrusion_width, extrusion_material_idx,
+                                 feedrate_colors, width_colors, extrusion_width_black)
+
+        output_vs.append(output_vs_layer)
+        output_es.append(output_es_layer)
+        extrusion_heights.append(extrusion_heights_layer)
+        extrusion_widths.append(extrusion_widths_layer)
+        extrusion_material_idxs.append(extrusion_material_idxs_layer)
+        extrusion_feedrate_factors.append(extrusion_feedrate_factors_layer)
+
+        yield read_layer_idx, layers.layer_count
+
+        # Progress to next layer
+        v_start_layer = next_v_start
+        if v_start_layer is None: # vertex where we start to iterate
+            break
+
+        spiral_turn_idx = spiral_turn_idx + 1
+        read_layer_idx = read_layer_idx + read_layer_idx_delta
+        kds.evict_below(read_layer_idx)
+
+    if turn_memo is not None:
+        turn_memo.turns = used_turns
+
+    output_vs = np.concatenate(output_vs)
+    output_es = np.concatenate(output_es)
+    extrusion_heights = np.concatenate(extrusion_heights)
+    extrusion_widths = np.concatenate(extrusion_widths)
+    extrusion_material_idxs = np.concatenate(extrusion_material_idxs)
+    extrusion_feedrate_factors = np.concatenate(extrusion_feedrate_factors)
+
+    # Drop points that do not change the path or the extrusion by more than the tolerance
+    if decimate_tolerance > 0:
+        keep = decimate.decimate_toolpath(output_vs, extrusion_heights, extrusion_widths,
+                                          extrusion_material_idxs, extrusion_feedrate_factors,
+                                          decimate_tolerance)
+        log.info("Decimation kept %d of %d points", keep.sum(), len(keep))
+        profiling.count('points_decimated', int(len(keep) - keep.sum()))
+        output_vs = output_vs[keep]
+        extrusion_heights = extrusion_heights[keep]
+        extrusion_widths = extrusion_widths[keep]
+        extrusion_material_idxs = extrusion_material_idxs[keep]
+        extrusion_feedrate_factors = extrusion_feedrate_factors[keep]
+        out_idxs = np.arange(len(output_vs))
+        output_es = np.stack((out_idxs, out_idxs+1), axis=1)
+
+    return [output_vs, output_es,
+            extrusion_heights, extrusion_widths, extrusion_material_idxs, extrusion_feedrate_factors]
+
+def mesh_arrays(vs, es):
+    "Flat vertex coordinates and edge vertex indices of the path points vs and edges es, for foreach_set"
+    es = es[:-1] # Else there is one too many edges goint to nowhere
+    return (np.ascontiguousarray(vs, dtype=np.float32).ravel(),
+            np.ascontiguousarray(es, dtype=np.int32).ravel())
+
+def nozzleboss_arrays(vs, extrusion_heights):
+    """
+    Flat vertex coordinates, loop vertex indices and loop starts of a quad strip hanging from the path
+    points vs down by the extrusion heights, for foreach_set
+    """
+    v_count = len(vs)
+    top = np.asarray(vs, dtype=np.float32)
+    bottom = top.copy()
+    bottom[:, 2] -= np.asarray(extrusion_heights, dtype=np.float32)
+
+    # One quad between every two consecutive points and the points below them
+    i = np.arange(v_count - 1, dtype=np.int32)
+    faces = np.stack((i, i+1, v_count+i+1, v_count+i), axis=1)
+    return np.concatenate((top, bottom)).ravel(), faces.ravel(), np.arange(0, faces.size, 4, dtype=np.int32)
+
+def curve_arrays(vs, extrusion_heights):
+    "Flat homogeneous point coordinates and radii of a poly spline through the path points vs, for foreach_set"
+    cos = np.ones((len(vs), 4), dtype=np.float32) # spline points are homogeneous, w = 1
+    cos[:, :3] = vs
+    return cos.ravel(), np.asarray(extrusion_heights, dtype=np.float32) / 2
@@ -0,0 +1,31 @@
+"""
+Reading STL files into vertex and triangle arrays, for slicing without Blender.
+"""
+import os
+
+import numpy as np
+
+# Binary STL: 80 byte header, triangle count, then per triangle a normal, three corners and two attribute bytes
+STL_TRIANGLE = np.dtype([('normal', '<f4', 3), ('corners', '<f4', (3, 3)), ('attribute', '<u2')])
+
+def read_corners(path):
+    "Corner coordinates (n, 3, 3) of all triangles in the binary or ASCII STL file at path"
+    with open(path, 'rb') as f:
+        header = f.read(84)
+        if len(header) == 84:
+            count = int(np.frombuffer(header, dtype='<u4', offset=80)[0])
+            # ASCII files may start with "solid" as well, the size tells them apart
+            if os.path.getsize(path) == 84 + count * STL_TRIANGLE.itemsize:
+                return np.fromfile(f, dtype=STL_TRIANGLE, count=count)['corners']
+    with open(path) as f:
+        values = [line.split()[1:4] for line in f if line.lstrip().startswith('vertex')]
+    return np.array(values, dtype=np.float32).reshape(-1, 3, 3)
+
+def read_stl(path):
+    """
+    Vertex coordinates and triangles of the STL file at path.
+    Corners at the same position become one vertex, so that the triangles share their edges.
+    """
+    corners = read_corners(path)
+    cos, tris = np.unique(corners.reshape(-1, 3), axis=0, return_inverse=True)
+    return cos.astype(np.float64), tris.reshape(-1, 3)
@@ -0,0 +1,66 @@
+import math
+
+import numpy as np
+import pytest
+
+from .. import arcs
+
+def helix(direction, turns=3, sides=128, radius=20.0, pitch=0.2):
+    """
+    Spiral around (1, 2) through the corners of a regular polygon and a point near the start of every
+    side, like the cuts of the vertical and the diagonal edges of a sliced cylinder, direction 1 turning
+    counter-clockwise, -1 clockwise. Runs of a few points lie on a straight side, only longer ones on a circle.
+    """
+    a = np.arange(turns * sides + 1) * (2 * math.pi / sides)
+    corners = np.column_stack((1 + radius * np.cos(a), 2 + direction * radius * np.sin(a), pitch * a / (2 * math.pi)))
+    points = np.empty((2 * len(corners) - 1, 3))
+    points[0::2] = corners
+    points[1::2] = 0.95 * corners[:-1] + 0.05 * corners[1:]
+    return points.astype(np.float32).astype(np.float64)
+
+def fitted(points, breaks=(), f=None):
+    e = np.linalg.norm(np.diff(points, axis=0), axis=1) * 0.05
+    f = np.full(len(e), 1200.0) if f is None else f
+    return e, arcs.fit_arcs(points[0], points[1:], e, f, breaks, tolerance=0.01)
+
+@pytest.mark.parametrize('direction, code', [(1, arcs.G3), (-1, arcs.G2)])
+def test_helix_becomes_few_arcs_turning_its_way(direction, code):
+    points = helix(direction)
+    e, (codes, xyz, ij, new_e, new_f, new_breaks) = fitted(points)
+    assert len(codes) < len(e) / 50
+    assert np.all(codes == code)
+    assert new_e.sum() == pytest.approx(e.sum())
+    assert np.array_equal(xyz[-1], points[-1])
+
+    # I/J point from the start of every arc to the center of the helix
+    starts = np.concatenate((points[:1], xyz[:-1]))
+    assert np.abs(np.hypot(*(starts[:, :2] + ij - (1, 2)).T)).max() < 0.01
+
+def test_arcs_pass_the_points_they_replace_within_tolerance():
+    points = helix(1)
+    _, (codes, xyz, ij, _, _, _) = fitted(points)
+    ends = np.flatnonzero((points[:, None, :] == xyz[None, :, :]).all(axis=2).any(axis=1))
+    assert len(ends) == len(xyz)
+    for start, end, (i, j) in zip(np.concatenate(([0], ends[:-1])), ends, ij):
+        run = points[start:end+1]
+        center = run[0, :2] + (i, j)
+        radii = np.hypot(*(run[:, :2] - center).T)
+        assert np.abs(radii - radii[0]).max() <= 0.01
+        angles = np.unwrap(np.arctan2(*(run[:, :2] - center).T[::-1]))
+        z_helix = run[0, 2] + (run[-1, 2] - run[0, 2]) * (angles - angles[0]) / (angles[-1] - angles[0])
+        assert np.abs(run[:, 2] - z_helix).max() <= 0.01
+
+def test_arcs_stop_at_breaks_and_feed_rate_changes():
+    points = helix(1, turns=2)
+    f = np.full(len(points) - 1, 1200.0)
+    f[300:] = 600
+    e, (codes, xyz, ij, new_e, new_f, new_breaks) = fitted(points, breaks=[99], f=f)
+    assert points[100].tolist() in xyz.tolist() and points[300].tolist() in xyz.tolist()
+    assert xyz[new_breaks].tolist() == [points[100].tolist()]
+    assert new_e.sum() == pytest.approx(e.sum())
+    assert sorted(set(new_f)) == [600, 1200]
+
+def test_straight_lines_stay_g1():
+    points = np.column_stack((np.linspace(0, 10, 21), np.zeros(21), np.linspace(0, 1, 21)))
+    e, (codes, xyz, ij, new_e, _, _) = fitted(points)
+    assert np.all(codes == arcs.G1) and np.array_equal(xyz, points[1:]) and np.allclose(new_e, e)
@@ -0,0 +1,40 @@
+import os
+
+import numpy as np
+
+from .. import cache
+
+def test_digest_changes_with_arrays_and_params():
+    a = np.arange(10, dtype=np.float32)
+    key = cache.digest(a, stage='spiral', height=0.2)
+    assert cache.digest(a.copy(), stage='spiral', height=0.2) == key
+    changed = a.copy()
+    changed[3] += 1e-6
+    assert cache.digest(changed, stage='spiral', height=0.2) != key
+    assert cache.digest(a.astype(np.float64), stage='spiral', height=0.2) != key
+    assert cache.digest(a.reshape(2, 5), stage='spiral', height=0.2) != key
+    assert cache.digest(a, stage='spiral', height=0.3) != key
+    assert cache.digest(a, stage='moves', height=0.2) != key
+
+def test_version_bump_misses_old_entries(tmp_path, monkeypatch):
+    array_cache = cache.ArrayCache(str(tmp_path), 1 << 20)
+    a = np.arange(10)
+    array_cache.put(cache.digest(a, stage='spiral'), {'a': a})
+    assert np.array_equal(array_cache.get(cache.digest(a, stage='spiral'))['a'], a)
+    monkeypatch.setattr(cache, 'CACHE_VERSION', cache.CACHE_VERSION + 1)
+    assert array_cache.get(cache.digest(a, stage='spiral')) is None
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    arrays = {'a': np.zeros(1000)}
+    array_cache = cache.ArrayCache(str(tmp_path), 1 << 20)
+    for i, key in enumerate("abc"):
+        array_cache.put(key, arrays)
+        os.utime(array_cache.path(key), (1000 + i, 1000 + i))
+    entry_size = os.path.getsize(array_cache.path('a'))
+
+    # Reading "a" makes "b" the oldest entry, only three entries fit
+    assert array_cache.get('a') is not None
+    array_cache.max_bytes = 3 * entry_size
+    array_cache.put('d', arrays)
+    assert sorted(name for name in os.listdir(tmp_path)) == ['a.npz', 'c.npz', 'd.npz']
+    assert array_cache.get('b') is None
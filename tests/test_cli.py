@@ -0,0 +1,40 @@
+import json
+
+import numpy as np
+
+from .. import cli, stl
+from ..benchmarks import meshes
+
+def write_stl(path, cos, tris):
+    "Binary STL of the triangles tris of the vertices cos"
+    triangles = np.zeros(len(tris), dtype=stl.STL_TRIANGLE)
+    triangles['corners'] = cos[tris]
+    with open(path, 'wb') as f:
+        f.write(b"\0" * 80 + np.uint32(len(tris)).tobytes())
+        triangles.tofile(f)
+
+def test_no_blender_batch_writes_gcode_and_summary(tmp_path):
+    write_stl(tmp_path / "vase.stl", *meshes.cylinder(32, 4, 10, 5))
+    (tmp_path / "start.gcode").write_text("G28\nM83\n")
+    (tmp_path / "settings.json").write_text(json.dumps({'extrusion_height': 0.2, 'gcode_compact': True,
+                                                        'start_gcode': "start.gcode"}))
+    output = tmp_path / "out"
+    assert cli.main(['--no-blender', '--jobs', '1', '--settings', str(tmp_path / "settings.json"),
+                     '--output', str(output), str(tmp_path / "vase.stl")]) == 0
+
+    summary = json.loads((output / "summary.json").read_text())
+    assert summary['failed'] == 0
+    result, = summary['models']
+    lines = (output / "vase.gcode").read_text().splitlines()
+    assert result['gcode'] == str(output / "vase.gcode")
+    assert lines[:2] == ["G28", "M83"]
+    assert sum(line.startswith("G1 ") for line in lines) == result['stats']['lines'] + 1
+
+def test_no_blender_batch_reports_unsupported_settings(tmp_path):
+    write_stl(tmp_path / "vase.stl", *meshes.cylinder(32, 4, 10, 5))
+    (tmp_path / "settings.json").write_text(json.dumps({'slice_processes': 4}))
+    assert cli.main(['--no-blender', '--jobs', '1', '--settings', str(tmp_path / "settings.json"),
+                     '--output', str(tmp_path), str(tmp_path / "vase.stl")]) == 1
+    summary = json.loads((tmp_path / "summary.json").read_text())
+    assert summary['failed'] == 1
+    assert "slice_processes" in summary['models'][0]['error']
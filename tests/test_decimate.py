@@ -0,0 +1,45 @@
+import numpy as np
+
+from .. import decimate
+
+def helix(count, turns=3, radius=10.0, pitch=0.4):
+    a = np.linspace(0, 2 * np.pi * turns, count)
+    return np.column_stack((radius * np.cos(a), radius * np.sin(a), pitch * a / (2 * np.pi)))
+
+def segment_distances(points, keep):
+    "Distance of every point to the segment between the kept points around it"
+    kept = np.flatnonzero(keep)
+    ends = kept[np.minimum(np.searchsorted(kept, np.arange(len(points)), side='right'), len(kept) - 1)]
+    starts = kept[np.searchsorted(kept, np.arange(len(points)), side='right') - 1]
+    seg = points[ends] - points[starts]
+    rel = points - points[starts]
+    along = np.clip(np.einsum('ij,ij->i', rel, seg) / np.maximum(np.einsum('ij,ij->i', seg, seg), 1e-300), 0, 1)
+    return np.linalg.norm(rel - along[:, None] * seg, axis=1)
+
+def test_dropped_points_stay_within_tolerance():
+    points = helix(5000)
+    fixed = np.zeros(len(points), dtype=bool)
+    fixed[[100, 2500]] = True
+    keep = decimate.douglas_peucker(points, 0.01, fixed)
+    assert keep[0] and keep[-1] and keep[100] and keep[2500]
+    assert keep.sum() < len(points) / 4
+    assert segment_distances(points, keep).max() <= 0.01
+
+def test_a_straight_line_keeps_its_ends():
+    points = np.column_stack((np.linspace(0, 10, 50), np.zeros(50), np.zeros(50)))
+    assert np.flatnonzero(decimate.douglas_peucker(points, 1e-6)).tolist() == [0, 49]
+
+def test_attributes_and_material_changes_are_kept():
+    cos = helix(3000)
+    heights = np.full(len(cos), 0.2)
+    widths = np.linspace(0.4, 0.8, len(cos))**2 # not linear, so dropping points must respect it
+    materials = np.repeat([0, 1, 0], 1000)
+    feedrates = np.ones(len(cos))
+    feedrates[1500:] = 0.5
+    keep = decimate.decimate_toolpath(cos, heights, widths, materials, feedrates, 0.01)
+    assert keep[[999, 1000, 1999, 2000]].all()
+    assert keep[1499] and keep[1500]
+    assert keep[::decimate.KEEP_EVERY].all()
+    assert segment_distances(cos, keep).max() <= 0.01
+    assert segment_distances(widths[:, None], keep).max() <= 0.01
+    assert keep.sum() < len(cos) / 4
@@ -0,0 +1,166 @@
+import io
+import math
+
+import numpy as np
+
+from .. import gcode, slicer, spiral
+from ..benchmarks import meshes
+
+def circle_moves(point_count=2000, radius=5.0, turns=2, feed_rate=40):
+    t = np.linspace(0, 2 * np.pi * turns, point_count)
+    cos = np.column_stack((radius * np.cos(t), radius * np.sin(t), t / (2 * np.pi) * 0.2)).astype(np.float32)
+    ones = np.ones(point_count)
+    return cos, gcode.extrusion_moves(cos, ones * 0.2, ones * 0.4, ones, 0.0, feed_rate, feed_rate)
+
+def distances_to_polyline(points, polyline):
+    "Distance of every point to the nearest segment of polyline"
+    a, b = polyline[:-1], polyline[1:]
+    seg = b - a
+    seg_sq = np.maximum(np.einsum('ij,ij->i', seg, seg), 1e-12)
+    rel = points[:, None, :] - a[None]
+    along = np.clip(np.einsum('pij,ij->pi', rel, seg) / seg_sq, 0, 1)
+    off = rel - along[..., None] * seg[None]
+    return np.sqrt(np.einsum('pij,pij->pi', off, off)).min(axis=1)
+
+def test_rate_limit_stays_within_tolerance():
+    cos, (xyz, e, f) = circle_moves()
+    start = cos[0].astype(np.float64)
+    new_xyz, new_e, new_f, _, merged, _, deviation = gcode.limit_segment_rate(start, xyz, e, f, [], 50, 0.01)
+    assert len(merged) > 0
+    assert deviation <= 0.01
+    path = np.concatenate((start[None], new_xyz))
+    assert distances_to_polyline(xyz, path).max() <= 0.01 + 1e-9
+    assert np.isclose(new_e.sum(), e.sum())
+
+def test_rate_limit_keeps_duration_with_truncated_feed_rates():
+    cos, (xyz, e, f) = circle_moves()
+    start = cos[0].astype(np.float64)
+    new_xyz, _, new_f, _, _, slowed, _ = gcode.limit_segment_rate(start, xyz, e, f, [], 50, 0.1)
+    assert np.array_equal(new_f, np.trunc(new_f))
+
+    def durations(start, xyz, f):
+        points = np.concatenate((start[None], xyz))
+        return np.linalg.norm(np.diff(points, axis=0), axis=1) / (f / 60)
+    # Every move not slowed down takes as long as the moves it replaces, truncating F can only make
+    # it slower by less than 1 mm/min
+    ends = np.flatnonzero((xyz[:, None] == new_xyz[None]).all(axis=2).any(axis=1)) + 1
+    time_cum = np.concatenate(([0.0], np.cumsum(durations(start, xyz, f))))
+    replaced = np.diff(time_cum[np.concatenate(([0], ends))])
+    kept = np.setdiff1d(np.arange(len(new_f)), slowed)
+    new_durations = durations(start, new_xyz, new_f)[kept]
+    assert np.all(replaced[kept] <= new_durations + 1e-12)
+    assert np.all(new_durations <= replaced[kept] * 1.001)
+
+def test_rate_limit_meets_the_budget_where_merging_stops():
+    # 0.01 mm allows merging only about half of the moves needed at 50 moves/s
+    cos, (xyz, e, f) = circle_moves()
+    start = cos[0].astype(np.float64)
+    new_xyz, _, new_f, _, _, slowed, _ = gcode.limit_segment_rate(start, xyz, e, f, [700], 50, 0.01)
+    assert len(slowed) > 0
+    points = np.concatenate((start[None], new_xyz))
+    durations = np.linalg.norm(np.diff(points, axis=0), axis=1) / (new_f / 60)
+    assert durations.min() >= 1 / 50
+
+def test_rate_limit_keeps_breaks():
+    cos, (xyz, e, f) = circle_moves()
+    start = cos[0].astype(np.float64)
+    new_xyz, _, _, new_breaks, _, _, _ = gcode.limit_segment_rate(start, xyz, e, f, [700], 50, 0.01)
+    assert np.allclose(new_xyz[new_breaks[0]], xyz[700])
+
+def reference_gcode(cos, heights, widths, material_idxs, feedrate_factors, z_offset,
+                    travel_feed_rate, extrusion_feed_rate_white, extrusion_feed_rate_black,
+                    start_lines, filament_change_lines, end_lines):
+    "The per-vertex export loop the moves were first written with, mathutils' single precision vectors emulated"
+    f32 = np.float32
+    def code(opcode, **kwargs):
+        args = sorted(kwargs.items(), key=lambda it: gcode.ARG_SORT[it[0].upper()])
+        return " ".join([opcode] + [arg.upper() + "{:.6f}".format(val) for arg, val in args]) + "\n"
+    def length(a, b):
+        # mathutils sums the single precision squares in double precision, last component first
+        d = [f32(p) - f32(q) for p, q in zip(a, b)]
+        return math.sqrt(sum(float(c * c) for c in reversed(d)))
+
+    out = "".join(line + "\n" for line in start_lines)
+    co = cos[0]
+    dz = z_offset - float(co[2])
+    out += code("G0", x=float(co[0]), y=float(co[1]), z=float(f32(float(co[2]) + (dz + 0.1))),
+                f=int(travel_feed_rate * 60.0))
+    out += code("G1", z=z_offset, f=int(extrusion_feed_rate_white * 60.0))
+    for i in range(1, len(cos)):
+        l_in = length(cos[i], cos[i-1]) * float(heights[i]) * float(widths[i]) / (math.pi * (1.75/2)**2)
+        rate = extrusion_feed_rate_black + float(feedrate_factors[i]) * (extrusion_feed_rate_white - extrusion_feed_rate_black)
+        out += code("G1", x=float(cos[i][0]), y=float(cos[i][1]), z=float(f32(float(cos[i][2]) + dz)),
+                    e=l_in, f=int(rate * 60.0))
+        if material_idxs[i-1] != material_idxs[i]:
+            out += "".join(line + "\n" for line in filament_change_lines)
+    return out + "".join(line + "\n" for line in end_lines)
+
+def test_moves_match_the_per_vertex_export():
+    cos, tris = meshes.uv_sphere(32, 16, 10)
+    zs = slicer.layer_zs(cos[:, 2].min(), cos[:, 2].max(), 0.2)
+    points, point_layers, _, _, loop_idxs, loop_orders, loop_signs = slicer.slice_layers(cos, tris, zs)
+    layers = spiral.LayerIndex(point_layers, loop_idxs, loop_orders, loop_signs, len(zs))
+    colors = (points[:, 0] / 20 + 0.5).astype(np.float32)
+    vs, _, heights, widths, material_idxs, feedrate_factors = spiral.spiralize_layers(
+        points.astype(np.float32), layers, 'CW', 0.2, 0.4, filament_change_layers=[30, 60], feedrate_colors=colors)
+    arrays = [vs.astype(np.float32), heights.astype(np.float32), widths.astype(np.float32),
+              material_idxs.astype(np.int32), feedrate_factors.astype(np.float32)]
+    z_offset, travel, white, black = 0.3, 100, 37.5, 12.3
+    lines = (["M140 S60"], ["M600"], ["M84"])
+
+    moves, _ = gcode.toolpath_moves(*arrays, z_offset, white, black)
+    stream = io.StringIO()
+    gcode.write_gcode(stream, moves, travel, white, *lines)
+    expected = reference_gcode(*arrays, z_offset, travel, white, black, *lines)
+    # Filament changes break the moves, feed rates between white and black are truncated
+    assert expected.count("M600") == 2
+    assert len(np.unique(moves['f'])) > 10
+    assert stream.getvalue() == expected
+
+    # Chunks ending between breaks give the same lines
+    chunked = io.StringIO()
+    gcode.write_moves(chunked, moves['xyz'], moves['e'], moves['f'], moves['breaks'],
+                      lambda stream: stream.write("M600\n"), chunk_size=1000)
+    assert chunked.getvalue() in expected
+
+def parse_words(line):
+    "Letter to value of the words of a g-code line"
+    return {word[0]: float(word[1:]) for word in line.split()[1:]}
+
+def test_trimmed_numbers_parse_back():
+    values = np.array([0.0, -0.0, 1.5, -2.25, 10.0, 0.1234567, -0.0000004, 123.4])
+    for precision in (0, 3, 6):
+        strings = gcode.format_column(values, precision, True)
+        assert not any(s.endswith('.') or (precision > 0 and '.' in s and s.endswith('0')) for s in strings)
+        assert '-0' not in strings
+        assert np.array_equal([float(s) for s in strings], [float("%.*f" % (precision, v)) for v in values])
+
+def test_compact_moves_leave_out_unchanged_words():
+    cos, (xyz, e, f) = circle_moves(200)
+    xyz[50:100, 2] = xyz[50, 2] # a flat stretch keeps Z
+    f[120:] = 1800
+    text, last_words = gcode.format_moves_compact(xyz, e, f, dict.fromkeys('FXYZE', 3))
+    lines = text.splitlines()
+    state = {}
+    for line, move in zip(lines, np.column_stack((f, xyz, e))):
+        words = parse_words(line)
+        assert 'E' in words
+        # Every word left out keeps the value of the line before
+        for letter, value in zip('FXYZ', move[:4]):
+            if letter not in words:
+                assert letter in state and float("%.3f" % value) == state[letter]
+        state.update(words)
+    assert 'Z' not in lines[75] and 'F' not in lines[75]
+    assert 'F' in lines[120] and 'F' not in lines[121]
+    assert last_words['F'] == '1800'
+
+def test_compact_moves_repeat_every_word_after_a_break():
+    cos, (xyz, e, f) = circle_moves(200)
+    xyz[:, 2] = 0.2
+    stream = io.StringIO()
+    gcode.write_moves(stream, xyz, e, f, [99], lambda stream: stream.write("T1\nG92 E0\n"),
+                      dict.fromkeys('FXYZE', 3))
+    lines = stream.getvalue().splitlines()
+    assert lines[100:102] == ["T1", "G92 E0"]
+    assert 'F' not in lines[99] and 'Z' not in lines[99]
+    assert set(parse_words(lines[102])) == {'F', 'X', 'Y', 'Z', 'E'}
@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+
+from .. import arcs, kinematics
+
+def line_moves(xy, feedrate, breaks=()):
+    "Moves of gcode.toolpath_moves through the points xy at z 0, starting at the first"
+    xyz = np.column_stack((xy[1:], np.zeros(len(xy) - 1)))
+    return {'first_co': (xy[0][0], xy[0][1], 0.0), 'z_offset': 0.0, 'xyz': xyz,
+            'codes': np.full(len(xyz), arcs.G1), 'ij': np.zeros((len(xyz), 2)),
+            'f': np.full(len(xyz), feedrate * 60.0), 'e': np.full(len(xyz), 0.01), 'breaks': breaks}
+
+def test_straight_line_accelerates_cruises_and_stops():
+    # 100 mm at 50 mm/s with 1000 mm/s^2: 2 s cruising plus 2 * 0.05 s ramps at half speed
+    for count in (2, 101):
+        xy = np.column_stack((np.linspace(0, 100, count), np.zeros(count)))
+        plan = kinematics.plan_moves(line_moves(xy, 50), 1000, 0.05)
+        assert plan['time'].sum() == pytest.approx(2.05)
+        assert plan['peak'].max() == pytest.approx(50)
+
+def test_breaks_and_corners_slow_down():
+    xy = np.column_stack((np.linspace(0, 100, 101), np.zeros(101)))
+    stop = kinematics.plan_moves(line_moves(xy, 50, breaks=[50]), 1000, 0.05)
+    assert stop['time'].sum() == pytest.approx(2 * 1.05)
+
+    # A square corner at the junction deviation of 5 mm/s square corner velocity is taken at 5 mm/s
+    deviation = kinematics.square_corner_deviation(1000, 5)
+    corner = kinematics.plan_moves(line_moves(np.array([(0, 0), (100, 0), (100, 100)]), 50), 1000, deviation)
+    leg = 0.05 + 0.045 + (100 - 1.25 - 1.2375) / 50
+    assert corner['time'].sum() == pytest.approx(2 * leg)
+
+def test_report_sums_the_plan():
+    xy = np.column_stack((np.linspace(0, 100, 101), np.zeros(101)))
+    plan, report = kinematics.estimate(line_moves(xy, 50), 0.2, 1000, 0.05)
+    assert report['print_time'] == pytest.approx(2.05)
+    assert report['commanded_time'] == pytest.approx(2.0)
+    assert report['layers']['time'] == pytest.approx([2.05])
+    assert kinematics.format_duration(3723) == "1h 2m 3s"
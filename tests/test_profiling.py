@@ -0,0 +1,21 @@
+import time
+
+from .. import profiling
+
+def test_paused_time_is_not_counted():
+    with profiling.profiled('test', use_cprofile=True) as profile:
+        with profiling.stage('work'):
+            profile.pause()
+            time.sleep(0.05)
+            profile.resume()
+    assert profile.seconds < 0.04
+    assert profile.stages['work'] < 0.04
+
+def test_counting_without_active_profile_does_nothing():
+    with profiling.profiled('test') as profile:
+        profiling.count('inside')
+        outer, profiling.active = profiling.active, None
+        profiling.count('outside')
+        profiling.active = outer
+    assert profile.counters == {'inside': 1}
+    assert profiling.active is None
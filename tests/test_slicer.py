@@ -0,0 +1,156 @@
+import numpy as np
+import pytest
+
+from .. import slicer
+from ..benchmarks import meshes
+
+def drain(steps):
+    while True:
+        try:
+            next(steps)
+        except StopIteration as done:
+            return done.value
+
+def sorted_points(result):
+    points, point_layers = result[0], result[1]
+    order = np.lexsort((points[:, 1], points[:, 0], point_layers))
+    return point_layers[order], points[order]
+
+@pytest.fixture
+def twisted():
+    cos, tris = meshes.cylinder(48, 40)
+    cos[:, :2] *= (1 - cos[:, 2] / 100)[:, None] # narrowing towards the top, so no two layers are alike
+    return cos, tris, slicer.layer_zs(0.1, 50, 0.25)
+
+def test_points_lie_on_their_planes_and_the_surface():
+    cos, tris = meshes.cylinder(32, 5)
+    zs = slicer.layer_zs(0.1, 50, 0.5)
+    points, point_layers, segments, _ = slicer.slice_triangles(cos, tris, zs)
+    assert np.array_equal(np.unique(point_layers), np.arange(len(zs)))
+    assert np.allclose(points[:, 2], zs[point_layers])
+    radii = np.hypot(points[:, 0], points[:, 1])
+    assert np.all(radii <= 20 + 1e-9) and np.all(radii >= 20 * np.cos(np.pi / 32) - 1e-9)
+
+def test_every_point_of_a_closed_mesh_joins_two_segments_of_its_layer():
+    cos, tris = meshes.cylinder(7, 3)
+    zs = slicer.layer_zs(0.1, 50, 0.5)
+    points, point_layers, segments, _ = slicer.slice_triangles(cos, tris, zs)
+    assert np.array_equal(point_layers[segments[:, 0]], point_layers[segments[:, 1]])
+    assert np.array_equal(np.bincount(segments.ravel(), minlength=len(points)), np.full(len(points), 2))
+    assert len(points) == 2 * 7 * len(zs) # the vertical and the diagonal edge of every side quad
+
+def test_planes_through_vertices_cut_each_vertex_once():
+    # Rings at z 0, 12.5, 25 and 37.5 lie on planes, including the bottom one
+    cos, tris = meshes.cylinder(16, 4)
+    zs = slicer.layer_zs(0, 50, 0.5)
+    points, point_layers, segments, _ = slicer.slice_triangles(cos, tris, zs)
+    counts = np.bincount(point_layers, minlength=len(zs))
+    on_rings = np.isin(zs, [0, 12.5, 25, 37.5])
+    assert np.all(counts[on_rings] == 16) and np.all(counts[~on_rings] == 32)
+    assert np.all(np.linalg.norm(points[segments[:, 0]] - points[segments[:, 1]], axis=1) > 0)
+    assert len(np.unique(np.column_stack((point_layers, points)), axis=0)) == len(points)
+    assert np.array_equal(np.bincount(segments[:, 0], minlength=len(points)), np.ones(len(points)))
+    assert np.array_equal(np.bincount(segments[:, 1], minlength=len(points)), np.ones(len(points)))
+
+    # A pole on a plane leaves no point behind
+    points, point_layers, segments, _ = slicer.slice_triangles(*meshes.uv_sphere(16, 8, 10), zs)
+    assert point_layers.min() > 0 and np.all(np.bincount(segments.ravel()) == 2)
+
+def test_vertex_data_is_interpolated_to_the_points():
+    cos, tris = meshes.cylinder(16, 2)
+    zs = slicer.layer_zs(0.1, 50, 0.5)
+    points, _, _, point_data = slicer.slice_triangles(cos, tris, zs, {'z': cos[:, 2], 'xy': cos[:, :2]})
+    assert np.allclose(point_data['z'], points[:, 2])
+    assert np.allclose(point_data['xy'], points[:, :2])
+
+def test_layers_of_a_closed_mesh_chain_into_closed_loops():
+    cos, tris = meshes.cylinder(32, 5)
+    # A second, smaller cylinder inside, so layers have two loops
+    inner_cos, inner_tris = meshes.cylinder(5, 2, 5.0, 30.0)
+    cos, tris = np.vstack((cos, inner_cos)), np.concatenate((tris, inner_tris + len(cos)))
+    zs = slicer.layer_zs(0.1, 50, 0.5)
+    points, point_layers, segments, _ = slicer.slice_triangles(cos, tris, zs)
+    order, loop_idxs, loop_orders, loop_signs = slicer.chain_loops(points, point_layers, segments)
+    points, point_layers, segments = points[order], point_layers[order], slicer.reorder_segments(order, segments)
+    assert np.array_equal(np.bincount(segments[:, 0], minlength=len(points)), np.ones(len(points)))
+    assert np.array_equal(np.bincount(segments[:, 1], minlength=len(points)), np.ones(len(points)))
+
+    # Loops are stored one after another in walking order, consecutive points are joined by a segment
+    starts = np.flatnonzero(loop_orders == 0)
+    lengths = np.diff(np.append(starts, len(points)))
+    assert np.array_equal(loop_orders, np.arange(len(points)) - np.repeat(starts, lengths))
+    nxt = np.arange(1, len(points) + 1)
+    nxt[starts + lengths - 1] = starts
+    joined = {tuple(sorted(segment)) for segment in segments.tolist()}
+    assert all(tuple(sorted(pair)) in joined for pair in zip(range(len(points)), nxt.tolist()))
+
+    # Loop 0 is the longest of its layer, both cylinders wind the same way
+    first_loops = loop_idxs[starts] == 0
+    assert np.all(lengths[first_loops] == 64) and np.all(lengths[~first_loops] == 10)
+    assert np.count_nonzero(~first_loops) == np.count_nonzero(zs < 30)
+    assert np.all(loop_signs == loop_signs[0])
+
+def test_workers_match_the_serial_slice(twisted, caplog):
+    cos, tris, zs = twisted
+    parallel = slicer.slice_layers_parallel(cos, tris, zs, processes=2)
+    serial = slicer.slice_layers(cos, tris, zs)
+    assert np.array_equal(parallel[1], serial[1])
+    for a, b in zip(sorted_points(parallel), sorted_points(serial)):
+        assert np.array_equal(a, b)
+    assert not caplog.records # the workers did the slicing
+
+def test_bands_step_through_the_layers_and_match_the_serial_slice(twisted):
+    cos, tris, zs = twisted
+    steps = slicer.slice_bands(cos, tris, zs, band_count=7)
+    progress = []
+    while True:
+        try:
+            progress.append(next(steps))
+        except StopIteration as done:
+            banded = done.value
+            break
+    assert len(progress) == 7 and progress[-1] == (len(zs), len(zs))
+    assert all(a[0] < b[0] for a, b in zip(progress, progress[1:]))
+    for a, b in zip(sorted_points(banded), sorted_points(slicer.slice_layers(cos, tris, zs))):
+        assert np.array_equal(a, b)
+
+def test_failing_workers_fall_back_to_this_process(twisted, monkeypatch):
+    cos, tris, zs = twisted
+    def no_processes(method):
+        raise OSError("cannot start workers")
+    monkeypatch.setattr(slicer.multiprocessing, 'get_context', no_processes)
+    serial = slicer.slice_layers(cos, tris, zs)
+    for sliced in (slicer.slice_layers_parallel(cos, tris, zs, processes=2),
+                   drain(slicer.slice_bands(cos, tris, zs, processes=2, band_count=8))):
+        for a, b in zip(sorted_points(sliced), sorted_points(serial)):
+            assert np.array_equal(a, b)
+
+def test_reslicing_changed_layers_matches_a_full_slice(twisted):
+    cos, tris, zs = twisted
+    sliced = slicer.slice_layers(cos, tris, zs)
+    assert slicer.changed_layers(cos, tris, {}, cos, tris, {}, zs) == []
+    assert slicer.changed_layers(cos, tris, {}, cos, tris[1:], {}, zs) is None
+
+    moved = cos.copy()
+    top = moved[:, 2] > 30
+    moved[top, :2] *= 0.8
+    ranges = slicer.changed_layers(cos, tris, {}, moved, tris, {}, zs)
+    assert len(ranges) == 1 and 0 < ranges[0][0] and ranges[0][1] == len(zs)
+    resliced = slicer.reslice_layers(sliced, moved, tris, zs, ranges)
+    full = slicer.slice_layers(moved, tris, zs)
+    for a, b in zip(resliced[:3] + resliced[4:], full[:3] + full[4:]):
+        assert np.array_equal(a, b)
+
+def test_adaptive_layers_stay_within_their_limits():
+    cos, tris = meshes.uv_sphere(48, 24, 10)
+    zs = slicer.adaptive_layer_zs(cos, tris, 0.05, 0.3, 0.02)
+    dzs = np.diff(zs)
+    assert zs[0] == cos[:, 2].min() and zs[-1] < cos[:, 2].max()
+    assert np.all(dzs >= 0.05 - 1e-9) and np.all(dzs <= 0.3 + 1e-9)
+    assert dzs[0] < dzs[len(dzs) // 2] # flat at the pole, steep at the equator
+
+    cos, tris = meshes.cylinder(32, 5)
+    zs = slicer.adaptive_layer_zs(cos, tris, 0.05, 0.3, 0.02)
+    dzs = np.diff(zs)
+    wall = (zs[:-1] > 0) & (zs[1:] + 0.3 < 50) # layers not reaching into the flat caps
+    assert np.isclose(dzs[0], 0.05) and np.allclose(dzs[wall], 0.3)
@@ -0,0 +1,176 @@
+import numpy as np
+import pytest
+
+from .. import slicer, spiral
+from ..benchmarks import meshes
+
+def sliced_layers(cos, tris, dz=0.1):
+    zs = slicer.layer_zs(cos[:, 2].min(), cos[:, 2].max(), dz)
+    points, point_layers, _, _, loop_idxs, loop_orders, loop_signs = slicer.slice_layers(cos, tris, zs)
+    return points.astype(np.float32), spiral.LayerIndex(point_layers, loop_idxs, loop_orders, loop_signs, len(zs))
+
+def two_cylinders():
+    "A cylinder with a smaller one inside up to half its height, so the lower layers have two loops"
+    cos, tris = meshes.cylinder(32, 5)
+    inner_cos, inner_tris = meshes.cylinder(5, 2, 5.0, 25.0)
+    return np.vstack((cos, inner_cos)), np.concatenate((tris, inner_tris + len(cos)))
+
+def test_layer_index_keeps_the_first_loop_of_every_layer():
+    cos, tris = two_cylinders()
+    zs = slicer.layer_zs(0.1, 50, 0.5)
+    points, point_layers, _, _, loop_idxs, loop_orders, loop_signs = slicer.slice_layers(cos, tris, zs)
+    assert np.any(loop_idxs == 1)
+    layers = spiral.LayerIndex(point_layers, loop_idxs, loop_orders, loop_signs, len(zs))
+    for layer_idx in range(len(zs)):
+        first_loop = np.flatnonzero((point_layers == layer_idx) & (loop_idxs == 0))
+        verts = layers.verts(layer_idx)
+        assert layers.count(layer_idx) == len(first_loop)
+        assert np.array_equal(verts, first_loop[np.argsort(loop_orders[first_loop])])
+        # The first loop is the outer cylinder's, the longest of the layer
+        assert np.allclose(np.hypot(points[verts, 0], points[verts, 1]).max(), 20, atol=1e-3)
+
+@pytest.mark.parametrize('mesh', [meshes.uv_sphere(32, 16, 10), meshes.twisted_polygon(6, 40, 10, 5)])
+def test_arc_length_keeps_one_point_per_vertex(mesh):
+    points, layers = sliced_layers(*mesh)
+    closest = spiral.spiralize_layers(points, layers, 'CW', 0.1, 0.4, interpolation_mode='CLOSEST')
+    arc_length = spiral.spiralize_layers(points, layers, 'CW', 0.1, 0.4, interpolation_mode='ARC_LENGTH')
+    assert len(arc_length[0]) == len(closest[0])
+
+@pytest.mark.parametrize('mode', ['CLOSEST', 'ARC_LENGTH'])
+def test_feedrate_map_follows_the_path(mode):
+    points, layers = sliced_layers(*meshes.uv_sphere(32, 16, 10))
+    colors = points[:, 0].astype(np.float64) / 20 + 0.5
+    vs, _, _, _, _, feedrate_factors = spiral.spiralize_layers(points, layers, 'CW', 0.1, 0.4,
+                                                               feedrate_colors=colors, interpolation_mode=mode)
+    assert np.allclose(feedrate_factors, vs[:, 0] / 20 + 0.5, atol=1e-6)
+
+def test_spiral_rises_monotonically():
+    points, layers = sliced_layers(*meshes.cylinder(64, 4, 10, 5))
+    vs = spiral.spiralize_layers(points, layers, 'CW', 0.1, 0.4)[0]
+    assert np.all(np.diff(vs[:, 2]) >= -1e-6)
+    assert vs[:, 2].max() - vs[:, 2].min() > 4.5
+
+def test_turn_memo_reuses_the_turns_of_unchanged_layers():
+    cos, tris = meshes.uv_sphere(32, 16, 10)
+    zs = slicer.layer_zs(cos[:, 2].min(), cos[:, 2].max(), 0.1)
+    sliced = slicer.slice_layers(cos, tris, zs)
+    # Moving a vertex across planes changes the point count of its layers and shifts all points above
+    moved = cos.copy()
+    moved[200, 2] += 0.25
+    ranges = slicer.changed_layers(cos, tris, {}, moved, tris, {}, zs)
+    resliced = slicer.reslice_layers(sliced, moved, tris, zs, ranges)
+    assert len(resliced[0]) != len(sliced[0])
+
+    def spiralize(sliced, memo):
+        points, point_layers, _, _, loop_idxs, loop_orders, loop_signs = sliced
+        layers = spiral.LayerIndex(point_layers, loop_idxs, loop_orders, loop_signs, len(zs))
+        colors = points[:, 0] / 20 + 0.5
+        return spiral.spiralize_layers(points.astype(np.float32), layers, 'CW', 0.1, 0.4,
+                                       feedrate_colors=colors, turn_memo=memo)
+
+    memo = spiral.TurnMemo()
+    spiralize(sliced, memo)
+    first_turns = memo.turns
+    reused = spiralize(resliced, memo)
+    fresh = spiralize(resliced, None)
+    assert all(a.tobytes() == b.tobytes() for a, b in zip(reused, fresh))
+
+    # Turns over unchanged loops are the ones of the first spiral, only those of the changed layers are new
+    kept = [key for key in memo.turns if key in first_turns]
+    assert all(memo.turns[key] is first_turns[key] for key in kept)
+    changed_layer_count = sum(end - first for first, end in ranges)
+    assert len(memo.turns) - len(kept) <= changed_layer_count + 2
+
+def scan_closest(cos, candidates, co):
+    "The vertex of candidates closest to co, found one vertex at a time like the filtered KD-tree query did"
+    best, best_dist = None, None
+    for idx in candidates.tolist():
+        dist = sum((float(a) - b) ** 2 for a, b in zip(cos[idx], co))
+        if best_dist is None or dist < best_dist:
+            best, best_dist = idx, dist
+    return best
+
+@pytest.fixture
+def two_cylinder_layers():
+    cos, tris = two_cylinders()
+    zs = slicer.layer_zs(0.1, 50, 0.5)
+    points, point_layers, _, _, loop_idxs, loop_orders, loop_signs = slicer.slice_layers(cos, tris, zs)
+    layers = spiral.LayerIndex(point_layers, loop_idxs, loop_orders, loop_signs, len(zs))
+    return points.astype(np.float32), layers
+
+def test_closest_vertex_matches_the_per_vertex_scan(two_cylinder_layers):
+    cos, layers = two_cylinder_layers
+    kds = spiral.LayerKDTrees(layers, cos)
+    queries = np.random.default_rng(0).uniform((-25, -25, 0), (25, 25, 50), (20, 3)).tolist()
+    for layer_idx in (10, 60):
+        for co in queries:
+            _, idx = spiral.find_closest_v(kds, layer_idx, co)
+            assert idx == scan_closest(cos, layers.verts(layer_idx), co)
+    assert spiral.find_closest_v(kds, -1, queries[0]) == (None, None)
+
+@pytest.mark.parametrize('pair_limit', [spiral.BATCH_PAIR_LIMIT, 1])
+def test_batched_correspondence_matches_the_per_vertex_scan(two_cylinder_layers, monkeypatch, pair_limit):
+    # A limit of one pair queries the KD-tree if there is mathutils, else brute force one query at a time
+    monkeypatch.setattr(spiral, 'BATCH_PAIR_LIMIT', pair_limit)
+    cos, layers = two_cylinder_layers
+    kds = spiral.LayerKDTrees(layers, cos)
+    for layer_idx in (10, 60):
+        # Every point of the layer below, both loops included
+        below = np.flatnonzero(layers.slice_idxs == layer_idx - 1)
+        found_cos, found_idxs = kds.find_batch(layer_idx, cos[below])
+        expected = [scan_closest(cos, layers.verts(layer_idx), co) for co in cos[below].tolist()]
+        assert np.array_equal(found_idxs, expected)
+        assert np.array_equal(found_cos, cos[expected])
+    assert kds.find_batch(-1, cos[:3]) == (None, None)
+
+def circle_layers(counts, radius=10.0, dz=0.2):
+    "Points and LayerIndex of one circle per layer with counts[i] points, each starting at another angle"
+    phases = np.random.default_rng(1).uniform(0, 2 * np.pi, len(counts))
+    t = np.concatenate([phase + 2 * np.pi * np.arange(n) / n for phase, n in zip(phases, counts)])
+    point_layers = np.repeat(np.arange(len(counts)), counts)
+    points = np.column_stack((radius * np.cos(t), radius * np.sin(t), point_layers * dz)).astype(np.float32)
+    loop_orders = np.concatenate([np.arange(n) for n in counts])
+    layers = spiral.LayerIndex(point_layers, np.zeros(len(t), dtype=np.int32), loop_orders,
+                               np.ones(len(t), dtype=np.int32), len(counts))
+    return points, layers
+
+@pytest.mark.parametrize('mode', ['CLOSEST', 'ARC_LENGTH'])
+def test_color_maps_follow_the_source_vertices_of_resampled_turns(mode):
+    # Every layer has another number of points, so turns are resampled from both loops
+    points, layers = circle_layers([40, 57, 33, 64, 45, 71, 38, 50])
+    # Maps linear in the coordinates have the same value at a point as the vertices it is interpolated from
+    feedrate_colors = 0.5 + points[:, 0] / 40 + points[:, 1] / 80
+    width_colors = 0.5 - points[:, 1] / 40 + points[:, 2]
+    vs, _, _, widths, _, feedrate_factors = spiral.spiralize_layers(
+        points, layers, 'CCW', 0.2, 0.4, feedrate_colors=feedrate_colors, interpolation_mode=mode,
+        width_colors=width_colors, extrusion_width_black=0.2)
+    assert np.allclose(feedrate_factors, 0.5 + vs[:, 0] / 40 + vs[:, 1] / 80, atol=1e-5)
+    assert np.allclose(widths, 0.2 + (0.5 - vs[:, 1] / 40 + vs[:, 2]) * 0.2, atol=1e-5)
+
+def test_geometry_arrays_match_the_spiral():
+    points, layers = sliced_layers(*meshes.cylinder(64, 4, 10, 5))
+    vs, es, heights = spiral.spiralize_layers(points, layers, 'CW', 0.1, 0.4)[:3]
+
+    # One vertex per point, one edge between every two consecutive points
+    cos, edge_vertices = spiral.mesh_arrays(vs, es)
+    assert np.array_equal(cos.reshape(-1, 3), vs.astype(np.float32))
+    edges = edge_vertices.reshape(-1, 2)
+    assert len(edges) == len(vs) - 1
+    assert np.array_equal(edges, np.column_stack((np.arange(len(vs) - 1), np.arange(1, len(vs)))))
+
+    cos, radii = spiral.curve_arrays(vs, heights)
+    assert np.array_equal(cos.reshape(-1, 4)[:, :3], vs.astype(np.float32))
+    assert np.all(cos.reshape(-1, 4)[:, 3] == 1)
+    assert np.allclose(radii, heights / 2)
+
+    # A quad below every segment, its lower edge the extrusion height below the path
+    cos, loop_vertices, loop_starts = spiral.nozzleboss_arrays(vs, heights)
+    cos = cos.reshape(-1, 3)
+    quads = loop_vertices.reshape(-1, 4)
+    assert len(cos) == 2 * len(vs) and len(quads) == len(vs) - 1
+    assert np.array_equal(loop_starts, 4 * np.arange(len(quads)))
+    assert np.array_equal(cos[quads[:, 0]], vs[:-1].astype(np.float32))
+    assert np.array_equal(cos[quads[:, 1]], vs[1:].astype(np.float32))
+    for upper, lower in ((0, 3), (1, 2)):
+        assert np.array_equal(cos[quads[:, lower], :2], cos[quads[:, upper], :2])
+    assert np.allclose(cos[quads[:, 0], 2] - cos[quads[:, 3], 2], heights[:-1], atol=1e-5)
@@ -0,0 +1,120 @@
+import gzip
+import struct
+import zlib
+
+from .. import writers
+
+# Lines of even and odd length, MeatPack pads the odd ones
+GCODE = "G1 X1.5 Y2\nG1 X3 Y4 E0.1\nG1 F1200 X5\nM104 S200\nG1 X-2.25 Y7 Z0.3 E1.5\n" * 50
+
+def unmeatpack(data):
+    "Decode a MeatPack stream the way Marlin does, dropping the character paired after a newline"
+    out = bytearray()
+    active = False
+    command_bytes = 0
+    command_next = False
+    literals = 0
+    second = None
+    for c in data:
+        if c == 0xff and not literals:
+            if command_bytes:
+                command_next, command_bytes = True, 0
+            else:
+                command_bytes = 1
+            continue
+        if command_next:
+            active = {0xfb: True, 0xfa: False}.get(c, active)
+            command_next = False
+            continue
+        command_bytes = 0
+        if not active:
+            out.append(c)
+        elif literals:
+            out.append(c)
+            if second is not None:
+                out.append(second)
+                second = None
+            literals -= 1
+        else:
+            low, high = c & 0xf, c >> 4
+            first_char = None if low == writers.MEATPACK_FULL_CHAR else writers.MEATPACK_CHARS[low]
+            second_char = None if high == writers.MEATPACK_FULL_CHAR else writers.MEATPACK_CHARS[high]
+            if first_char is None:
+                literals = 1 if second_char is not None else 2
+                second = second_char
+            else:
+                out.append(first_char)
+                if first_char != ord("\n"):
+                    if second_char is None:
+                        literals = 1
+                    else:
+                        out.append(second_char)
+    return out.decode()
+
+def stripped_lines(text):
+    return [line.rstrip(" ") for line in text.splitlines() if line.strip()]
+
+def test_meatpack_keeps_every_line():
+    assert {len(line) % 2 for line in GCODE.splitlines()} == {0, 1}
+    packed = writers.meatpack(GCODE.encode())
+    decoded = unmeatpack(writers.MEATPACK_ENABLE_PACKING + packed)
+    assert stripped_lines(decoded) == stripped_lines(GCODE)
+
+def test_meatpack_pads_odd_lines_only():
+    assert writers.meatpack_lines(b"G1 X1\nG1 X12\n") == b"G1 X1\nG1 X12 \n"
+    assert writers.meatpack_lines(b"G1 X1\nG1X") == b"G1 X1\nG1X\n"
+
+def test_meatpack_writer_round_trip(tmp_path, monkeypatch):
+    # Small buffers make the writer pack in many chunks that end inside lines
+    monkeypatch.setattr(writers, 'WRITE_BUFFER_SIZE', 37)
+    path = tmp_path / "out.gcode.mp"
+    with writers.MeatPackWriter(str(path)) as writer:
+        for line in GCODE.splitlines(keepends=True):
+            writer.write(line)
+    decoded = unmeatpack(path.read_bytes())
+    assert stripped_lines(decoded) == stripped_lines(GCODE)
+
+def test_gzip_round_trip(tmp_path):
+    path = tmp_path / "out.gcode.gz"
+    with writers.open_gzip(str(path)) as writer:
+        writer.write(GCODE)
+    assert gzip.decompress(path.read_bytes()).decode() == GCODE
+
+def read_bgcode_blocks(data):
+    "(type, encoding, decoded payload) of every block of a binary g-code file, checking the CRCs"
+    assert data[:4] == writers.BGCODE_MAGIC
+    position = 10
+    blocks = []
+    while position < len(data):
+        block_type, compression, size = struct.unpack_from("<HHI", data, position)
+        header_size = 8
+        compressed_size = size
+        if compression != writers.BGCODE_COMPRESSION_NONE:
+            compressed_size, = struct.unpack_from("<I", data, position + 8)
+            header_size = 12
+        encoding, = struct.unpack_from("<H", data, position + header_size)
+        end = position + header_size + 2 + compressed_size
+        crc, = struct.unpack_from("<I", data, end)
+        assert crc == zlib.crc32(data[position:end])
+        payload = data[position + header_size + 2:end]
+        if compression == writers.BGCODE_COMPRESSION_DEFLATE:
+            payload = zlib.decompress(payload)
+        assert len(payload) == size
+        blocks.append((block_type, encoding, payload))
+        position = end + 4
+    return blocks
+
+def test_bgcode_round_trip(tmp_path, monkeypatch):
+    monkeypatch.setattr(writers, 'BGCODE_MAX_GCODE_BLOCK', 200)
+    for use_meatpack in (True, False):
+        path = tmp_path / "out.bgcode"
+        with writers.BgcodeWriter(str(path), {'printer_model': ''}, {'filament used [mm]': '1.00'},
+                                  {'Producer': 'test'}, use_meatpack) as writer:
+            writer.write(GCODE)
+        blocks = read_bgcode_blocks(path.read_bytes())
+        assert blocks[1][2] == b"filament used [mm]=1.00\n"
+        gcode_blocks = [block for block in blocks if block[0] == writers.BGCODE_BLOCK_GCODE]
+        assert len(gcode_blocks) > 1
+        text = "".join(unmeatpack(payload) if encoding == writers.BGCODE_ENCODING_MEATPACK else payload.decode()
+                       for _, encoding, payload in gcode_blocks)
+        assert stripped_lines(text) == stripped_lines(GCODE)
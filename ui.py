@@ -1,59 +1,168 @@
+import json
+import logging
+import time
+from contextlib import contextmanager
+
 import bpy
 
+from . import defaults, profiling
+
+log = logging.getLogger(__name__)
+
 class spiralizer_settings(bpy.types.PropertyGroup):
     extrusion_height : bpy.props.FloatProperty(name="Extrusion height",
-                                               default=0.1,
+                                               default=defaults.SETTINGS['extrusion_height'],
                                                soft_min=0.01, soft_max=0.5)
     extrusion_width : bpy.props.FloatProperty(name="Extrusion width",
-                                              default=0.1,
+                                              default=defaults.SETTINGS['extrusion_width'],
                                               soft_min=0.2, soft_max=1.1)
 
+    adaptive_layers : bpy.props.BoolProperty(name="Adaptive layers",
+                                             default=defaults.SETTINGS['adaptive_layers'],
+                                             description="Vary the layer height with the slope of the surface instead of slicing by extrusion height")
+    min_extrusion_height : bpy.props.FloatProperty(name="Min height",
+                                                   default=defaults.SETTINGS['min_extrusion_height'],
+                                                   min=0.001, soft_min=0.01, soft_max=0.5)
+    max_extrusion_height : bpy.props.FloatProperty(name="Max height",
+                                                   default=defaults.SETTINGS['max_extrusion_height'],
+                                                   min=0.001, soft_min=0.01, soft_max=0.5)
+    cusp_height : bpy.props.FloatProperty(name="Cusp height",
+                                          default=defaults.SETTINGS['cusp_height'],
+                                          min=0.0001, soft_max=0.2,
+                                          description="Largest distance between the steps of the layers and the surface")
+
+    slice_processes : bpy.props.IntProperty(name="Slicing processes",
+                                            default=defaults.SETTINGS['slice_processes'], min=0, soft_max=64,
+                                            description="Worker processes slicing z-bands in parallel, 0 uses all cores")
+
     extrusion_feed_rate_black: bpy.props.IntProperty(name="Feed rate black (mm/s)",
-                                                     default=10,
+                                                     default=defaults.SETTINGS['extrusion_feed_rate_black'],
                                                      soft_min=5, soft_max=200)
 
     extrusion_feed_rate_white: bpy.props.IntProperty(name="Feed rate white [default.] (mm/s)",
-                                                     default=40,
+                                                     default=defaults.SETTINGS['extrusion_feed_rate_white'],
                                                      soft_min=5, soft_max=200)
 
     extrusion_feed_rate_map: bpy.props.StringProperty(
         name="Feed rate weightmap - grayscale of vertex color gets mapped feedrate black and white speeds",
-        default="Feedrate"
+        default=defaults.SETTINGS['extrusion_feed_rate_map']
+    )
+
+    extrusion_width_black : bpy.props.FloatProperty(name="Extrusion width black",
+                                                    default=defaults.SETTINGS['extrusion_width_black'],
+                                                    soft_min=0.05, soft_max=1.1)
+    extrusion_width_map: bpy.props.StringProperty(
+        name="Width weightmap - grayscale of vertex color gets mapped to extrusion width black and extrusion width",
+        default=defaults.SETTINGS['extrusion_width_map']
     )
     
     travel_feed_rate : bpy.props.FloatProperty(name="Travel feed rate (mm/s)",
-                                               default=100,
+                                               default=defaults.SETTINGS['travel_feed_rate'],
                                                soft_min=5, soft_max=200)
 
     rotation_direction : bpy.props.EnumProperty(name="Rotation direction",
                                                 items=(('CW', 'Clockwise', ""),
-                                                       ('CCW', 'Couter-clockwise', "")))
+                                                       ('CCW', 'Couter-clockwise', "")),
+                                                default=defaults.SETTINGS['rotation_direction'])
+    interpolation_mode : bpy.props.EnumProperty(name="Interpolation",
+                                                items=(('CLOSEST', 'Closest vertex', "Move towards the closest vertex of the next layer"),
+                                                       ('ARC_LENGTH', 'Arc length', "Blend both layers at the same normalised arc length from the seam")),
+                                                default=defaults.SETTINGS['interpolation_mode'])
+    decimate_tolerance : bpy.props.FloatProperty(name="Decimate tolerance (mm)",
+                                                 default=defaults.SETTINGS['decimate_tolerance'], min=0.0, soft_max=0.1, precision=3,
+                                                 description="Drop spiral points within this distance of the simplified path, 0 keeps all")
     toolpath_type : bpy.props.EnumProperty(name="Toolpath type",
                                            items=(('CURVE', 'Curve', ""),
                                                   ('MESH', 'Mesh', ""),
-                                                  ('NOZZLEBOSS', 'Nozzleboss Mesh', "")))
+                                                  ('NOZZLEBOSS', 'Nozzleboss Mesh', "")),
+                                           default=defaults.SETTINGS['toolpath_type'])
 
     filament_change_layers : bpy.props.StringProperty(name="Filament change layers",
-                                                      default="")
+                                                      default=defaults.SETTINGS['filament_change_layers'])
 
     z_offset : bpy.props.FloatProperty(name="Z-Offset (mm)",
-                                       default=0.2,
+                                       default=defaults.SETTINGS['z_offset'],
                                        soft_min=0, soft_max=0.8)
 
+    gcode_compact : bpy.props.BoolProperty(
+        name="Compact g-code", default=defaults.SETTINGS['gcode_compact'],
+        description="Leave out unchanged F, X, Y and Z words and trailing zeros"
+    )
+    gcode_precision_xy : bpy.props.IntProperty(name="XY decimals", default=defaults.SETTINGS['gcode_precision_xy'], min=0, max=6)
+    gcode_precision_z : bpy.props.IntProperty(name="Z decimals", default=defaults.SETTINGS['gcode_precision_z'], min=0, max=6)
+    gcode_precision_e : bpy.props.IntProperty(name="E decimals", default=defaults.SETTINGS['gcode_precision_e'], min=0, max=6)
+    gcode_precision_f : bpy.props.IntProperty(name="F decimals", default=defaults.SETTINGS['gcode_precision_f'], min=0, max=6)
+
+    max_segments_per_second : bpy.props.IntProperty(
+        name="Max segments/s", default=defaults.SETTINGS['max_segments_per_second'], min=0, soft_max=2000,
+        description="Merge moves so the firmware never has to plan more segments per second than this, 0 disables"
+    )
+    gcode_arcs : bpy.props.BoolProperty(
+        name="Fit arcs", default=defaults.SETTINGS['gcode_arcs'],
+        description="Replace runs of moves by G2/G3 arcs"
+    )
+    gcode_arc_tolerance : bpy.props.FloatProperty(
+        name="Arc tolerance (mm)", default=defaults.SETTINGS['gcode_arc_tolerance'], min=0.0001, soft_max=0.1,
+        description="Largest distance between the arc and the points and segments it replaces"
+    )
+    estimate_print_time : bpy.props.BoolProperty(
+        name="Estimate print time", default=defaults.SETTINGS['estimate_print_time'],
+        description="Plan the moves like the firmware on export, report the print time and color the spiral by achieved speed and flow"
+    )
+    acceleration : bpy.props.FloatProperty(
+        name="Acceleration (mm/s²)", default=defaults.SETTINGS['acceleration'], min=1, soft_max=20000
+    )
+    square_corner_velocity : bpy.props.FloatProperty(
+        name="Square corner velocity (mm/s)", default=defaults.SETTINGS['square_corner_velocity'], min=0, soft_max=20,
+        description="Speed through a 90 degree corner, sets the junction deviation unless that is given"
+    )
+    junction_deviation : bpy.props.FloatProperty(
+        name="Junction deviation (mm)", default=defaults.SETTINGS['junction_deviation'], min=0, soft_max=0.1, precision=4,
+        description="Junction deviation of the firmware, 0 derives it from the square corner velocity"
+    )
+    gcode_format : bpy.props.EnumProperty(name="Format",
+        items=[('TEXT', 'G-code', 'Plain g-code text (.gcode)'),
+               ('GZIP', 'gzip', 'gzip compressed g-code (.gcode.gz)'),
+               ('MEATPACK', 'MeatPack', 'MeatPack encoded g-code (.gcode.mp)'),
+               ('BGCODE', 'Binary g-code', 'Binary g-code blocks with CRC32 checksums (.bgcode)')],
+        default=defaults.SETTINGS['gcode_format'])
+
+    use_cache : bpy.props.BoolProperty(
+        name="Cache results", default=defaults.SETTINGS['use_cache'],
+        description="Keep slices, spirals and moves on disk and reuse them while their inputs do not change"
+    )
+    cache_size : bpy.props.IntProperty(
+        name="Cache size (MB)", default=defaults.SETTINGS['cache_size'], min=1, soft_max=16384,
+        description="Least recently used results are deleted beyond this size"
+    )
+    cache_directory : bpy.props.StringProperty(
+        name="Cache directory", default=defaults.SETTINGS['cache_directory'], subtype='DIR_PATH',
+        description="Absolute path of the cache.\nIf missing, the user's cache directory is used"
+    )
+
+    log_level : bpy.props.EnumProperty(name="Log level",
+        items=[(level, level.capitalize(), f"Print {level.lower()} and more important messages to the console")
+               for level in profiling.LOG_LEVELS],
+        default=defaults.SETTINGS['log_level'])
+    use_cprofile : bpy.props.BoolProperty(
+        name="cProfile", default=defaults.SETTINGS['use_cprofile'],
+        description="Run the operators under cProfile and add the slowest functions to the report"
+    )
+
     gcode_directory : bpy.props.StringProperty(
-        name="File", default="", subtype='FILE_PATH',
+        name="File", default=defaults.SETTINGS['gcode_directory'], subtype='FILE_PATH',
         description = 'Destination directory.\nIf missing, the .blend-file directory will be used'
     )
     start_gcode : bpy.props.StringProperty(
-        name="Start g-code", default='',
+        name="Start g-code", default=defaults.SETTINGS['start_gcode'],
         description="Text block for starting g-code"
     )
     filament_change_gcode : bpy.props.StringProperty(
-        name="Filament ch. g-code", default='',
+        name="Filament ch. g-code", default=defaults.SETTINGS['filament_change_gcode'],
         description="Text block inserted when filament changed"
     )
     end_gcode : bpy.props.StringProperty(
-        name="End g-code", default='',
+        name="End g-code", default=defaults.SETTINGS['end_gcode'],
         description="Text block for end g-code"
     )
 
@@ -79,6 +188,14 @@ class SlicePanel(bpy.types.Panel):
         row.prop(props, 'extrusion_height')
         row.prop(props, 'extrusion_width')
 
+        row = col.row()
+        row.prop(props, 'adaptive_layers')
+        if props.adaptive_layers:
+            row = col.row()
+            row.prop(props, 'min_extrusion_height')
+            row.prop(props, 'max_extrusion_height')
+            row.prop(props, 'cusp_height')
+
         row = col.row()
         row.prop(props, 'extrusion_feed_rate_white')
 
@@ -90,6 +207,12 @@ class SlicePanel(bpy.types.Panel):
             row = col.row()
             row.prop_search(props, "extrusion_feed_rate_map", data,
                             "color_attributes", text="Feed rate")
+            row = col.row()
+            row.prop_search(props, "extrusion_width_map", data,
+                            "color_attributes", text="Width")
+            if props.extrusion_width_map in data.color_attributes:
+                row = col.row()
+                row.prop(props, 'extrusion_width_black')
 
         row = col.row()
         row.prop(props, 'travel_feed_rate')
@@ -97,9 +220,18 @@ class SlicePanel(bpy.types.Panel):
         row = col.row()
         row.prop(props, 'rotation_direction')
 
+        row = col.row()
+        row.prop(props, 'interpolation_mode')
+
+        row = col.row()
+        row.prop(props, 'decimate_tolerance')
+
         row = col.row()
         row.prop(props, 'toolpath_type')
         
+        row = col.row()
+        row.prop(props, 'slice_processes')
+
         row = col.row()
         row.operator('spiralizer.slice')
 
@@ -115,8 +247,144 @@ class SlicePanel(bpy.types.Panel):
         col.prop_search(props, 'end_gcode', bpy.data, 'texts')
         col.prop_search(props, 'filament_change_gcode', bpy.data, 'texts')
         col.prop(props, 'gcode_directory')
+        col.prop(props, 'gcode_format')
         col.prop(props, 'z_offset')
+        col.prop(props, 'gcode_compact')
+        if props.gcode_compact:
+            row = col.row(align=True)
+            row.prop(props, 'gcode_precision_xy')
+            row.prop(props, 'gcode_precision_z')
+            row = col.row(align=True)
+            row.prop(props, 'gcode_precision_e')
+            row.prop(props, 'gcode_precision_f')
+        col.prop(props, 'max_segments_per_second')
+        row = col.row(align=True)
+        row.prop(props, 'gcode_arcs')
+        if props.gcode_arcs:
+            row.prop(props, 'gcode_arc_tolerance')
+        col.prop(props, 'estimate_print_time')
+        if props.estimate_print_time:
+            col.prop(props, 'acceleration')
+            row = col.row(align=True)
+            row.prop(props, 'square_corner_velocity')
+            row.prop(props, 'junction_deviation')
         
         row = col.row(align=True)
         row.scale_y = 2.0
         row.operator('spiralizer.gcode_export')
+
+        col.separator()
+        row = col.row(align=True)
+        row.prop(props, 'use_cache')
+        if props.use_cache:
+            row.prop(props, 'cache_size')
+            col.prop(props, 'cache_directory')
+
+        col.separator()
+        row = col.row(align=True)
+        row.prop(props, 'log_level')
+        row.prop(props, 'use_cprofile')
+        for operation in ('slice', 'spiralize', 'export'):
+            if operation in profiling.last_reports:
+                for line in profiling.summary_lines(profiling.last_reports[operation]):
+                    col.label(text=line)
+
+# Text block holding the reports of the last runs as JSON
+REPORT_TEXT = "spiralizer_report.json"
+
+@contextmanager
+def profiled(props, operation):
+    "profiling.profiled with the settings in props, the reports are written to the REPORT_TEXT text block"
+    profiling.set_log_level(props.log_level)
+    with profiling.profiled(operation, props.use_cprofile) as profile:
+        yield profile
+    text = bpy.data.texts.get(REPORT_TEXT) or bpy.data.texts.new(REPORT_TEXT)
+    text.from_string(json.dumps(profiling.last_reports, indent=2))
+
+# Seconds of work per timer tick of a modal operator, the UI handles events in between
+TICK_SECONDS = 0.1
+
+class StepsOperator:
+    """
+    Operator mixin running the generator step_function(context, interactive), which yields (done, total)
+    after every bounded piece of work and only changes the scene in its last step.
+    Invoked from the UI it runs modal, stepping from a timer with a progress bar. ESC closes the
+    generator, which cancels the run without leaving anything behind. The generator gets the context of
+    invoke and must read what it needs from it before its first yield.
+    Executed, e.g. from scripts, it runs to the end at once.
+    """
+    step_function = None
+
+    def execute(self, context):
+        wm = context.window_manager
+        wm.progress_begin(0, 1)
+        try:
+            for done, total in self.step_function(context, False):
+                wm.progress_update(done / max(total, 1))
+        finally:
+            wm.progress_end()
+        return {'FINISHED'}
+
+    def invoke(self, context, event):
+        self.generator = self.step_function(context, True)
+        self.profile = None
+        self.timer = None
+        context.window_manager.progress_begin(0, 1)
+        result = self.tick(context)
+        if result == {'RUNNING_MODAL'}:
+            self.timer = context.window_manager.event_timer_add(0.01, window=context.window)
+            context.window_manager.modal_handler_add(self)
+        return result
+
+    def modal(self, context, event):
+        if event.type == 'ESC' and event.value == 'PRESS':
+            self.step(self.generator.close)
+            self.finish(context)
+            self.report({'WARNING'}, f"{self.bl_label} cancelled")
+            return {'CANCELLED'}
+        if event.type != 'TIMER':
+            return {'PASS_THROUGH'}
+        return self.tick(context)
+
+    def step(self, call):
+        """
+        call() with the Profile of this run active. Between ticks other operators run, the Profile is
+        put aside and paused so that their work is neither counted nor timed in it.
+        """
+        outer, profiling.active = profiling.active, self.profile
+        if self.profile is not None:
+            self.profile.resume()
+        try:
+            return call()
+        finally:
+            self.profile, profiling.active = profiling.active, outer
+            if self.profile is not None:
+                self.profile.pause()
+
+    def tick(self, context):
+        "Run steps for TICK_SECONDS"
+        deadline = time.perf_counter() + TICK_SECONDS
+        try:
+            while time.perf_counter() < deadline:
+                done, total = self.step(lambda: next(self.generator))
+        except StopIteration:
+            self.finish(context)
+            return {'FINISHED'}
+        except Exception as e:
+            log.exception("%s failed", self.bl_label)
+            self.finish(context)
+            self.report({'ERROR'}, f"{self.bl_label} failed: {e}")
+            return {'CANCELLED'}
+        context.window_manager.progress_update(done / max(total, 1))
+        if context.area is not None:
+            context.area.header_text_set(f"{self.bl_label}: layer {done} of {total}, ESC to cancel")
+        return {'RUNNING_MODAL'}
+
+    def finish(self, context):
+        if self.timer is not None:
+            context.window_manager.event_timer_remove(self.timer)
+            self.timer = None
+        context.window_manager.progress_end()
+        if context.area is not None:
+            context.area.header_text_set(None)
+            context.area.tag_redraw()
@@ -0,0 +1,217 @@
+"""
+Streaming writers for compressed and binary g-code files.
+
+All writers take g-code text through write() like a text file does and are used as context managers.
+"""
+import gzip
+import struct
+import zlib
+
+import numpy as np
+
+# Bytes buffered before a file is written to
+WRITE_BUFFER_SIZE = 1 << 20
+
+def open_text(path):
+    "Plain g-code text file"
+    return open(path, 'w', buffering=WRITE_BUFFER_SIZE)
+
+def open_gzip(path, compresslevel=6):
+    "gzip compressed g-code text"
+    return gzip.open(path, 'wt', compresslevel=compresslevel)
+
+# MeatPack packs the most frequent g-code characters into 4 bits, two per byte
+# https://github.com/scottmudge/OctoPrint-MeatPack
+MEATPACK_CHARS = b"0123456789. \nGX"
+MEATPACK_FULL_CHAR = 0b1111
+MEATPACK_SIGNAL = b"\xff\xff"
+MEATPACK_ENABLE_PACKING = MEATPACK_SIGNAL + b"\xfb"
+MEATPACK_DISABLE_PACKING = MEATPACK_SIGNAL + b"\xfa"
+
+_meatpack_codes = np.full(256, MEATPACK_FULL_CHAR, dtype=np.uint8)
+_meatpack_codes[np.frombuffer(MEATPACK_CHARS, dtype=np.uint8)] = np.arange(len(MEATPACK_CHARS))
+
+def meatpack_lines(data):
+    """
+    The bytes data with a space before the newline of every line of odd length, and a newline at the end
+    if its last line is odd and open. Decoders drop the character packed after a newline in the low
+    nibble, so no newline may start a pair.
+    """
+    chars = np.frombuffer(data, dtype=np.uint8)
+    ends = np.flatnonzero(chars == ord("\n"))
+    lengths = np.diff(ends, prepend=-1)
+    chars = np.insert(chars, ends[lengths % 2 == 1], ord(" "))
+    if len(chars) % 2:
+        chars = np.append(chars, np.uint8(ord("\n")))
+    return chars.tobytes()
+
+def meatpack(data):
+    """
+    Pack the bytes data, whole lines of g-code, with MeatPack (see meatpack_lines).
+    Every pair of characters becomes one byte, the first character in the low nibble. A character without
+    a 4 bit code is marked 0b1111 and follows the packed byte in full.
+    """
+    data = meatpack_lines(data)
+    chars = np.frombuffer(data, dtype=np.uint8)
+    first, second = chars[0::2], chars[1::2]
+    first_code, second_code = _meatpack_codes[first], _meatpack_codes[second]
+    first_full = first_code == MEATPACK_FULL_CHAR
+    second_full = second_code == MEATPACK_FULL_CHAR
+
+    sizes = 1 + first_full.astype(np.int64) + second_full
+    positions = np.cumsum(sizes) - sizes
+    out = np.empty(int(sizes.sum()), dtype=np.uint8)
+    out[positions] = first_code | (second_code << 4)
+    out[positions[first_full] + 1] = first[first_full]
+    out[positions[second_full] + 1 + first_full[second_full]] = second[second_full]
+    return out.tobytes()
+
+class MeatPackWriter:
+    "MeatPack encoded g-code, as it is sent to a printer with MeatPack support"
+    def __init__(self, path):
+        self.file = open(path, 'wb', buffering=WRITE_BUFFER_SIZE)
+        self.file.write(MEATPACK_ENABLE_PACKING)
+        self.pending = []
+        self.pending_size = 0
+
+    def write(self, text):
+        data = text.encode()
+        self.pending.append(data)
+        self.pending_size += len(data)
+        if self.pending_size >= WRITE_BUFFER_SIZE:
+            self.pack(final=False)
+
+    def pack(self, final):
+        "Pack the pending lines. An unfinished line is carried over, or at the end ended by a newline."
+        data = b"".join(self.pending)
+        end = len(data) if final else data.rfind(b"\n") + 1
+        data, carry = data[:end], data[end:]
+        if data:
+            self.file.write(meatpack(data))
+        self.pending = [carry]
+        self.pending_size = len(carry)
+
+    def close(self):
+        self.pack(final=True)
+        self.file.write(MEATPACK_DISABLE_PACKING)
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# Binary g-code, https://github.com/prusa3d/libbgcode/blob/main/doc/specifications.md
+BGCODE_MAGIC = b"GCDE"
+BGCODE_VERSION = 1
+BGCODE_CHECKSUM_CRC32 = 1
+BGCODE_BLOCK_GCODE = 1
+BGCODE_BLOCK_SLICER_METADATA = 2
+BGCODE_BLOCK_PRINTER_METADATA = 3
+BGCODE_BLOCK_PRINT_METADATA = 4
+BGCODE_COMPRESSION_NONE = 0
+BGCODE_COMPRESSION_DEFLATE = 1
+BGCODE_ENCODING_INI = 0
+BGCODE_ENCODING_NONE = 0
+BGCODE_ENCODING_MEATPACK = 1
+BGCODE_MAX_GCODE_BLOCK = 65535 # bytes of g-code text per block
+
+class BgcodeWriter:
+    """
+    Binary g-code file. The metadata blocks are written up front, the g-code is cut into blocks at line ends.
+    Every block is optionally MeatPack encoded, deflate compressed and followed by its CRC32.
+    """
+    def __init__(self, path, printer_metadata, print_metadata, slicer_metadata, use_meatpack=True, compress=True):
+        self.use_meatpack = use_meatpack
+        self.compress = compress
+        self.file = open(path, 'wb', buffering=WRITE_BUFFER_SIZE)
+        self.file.write(BGCODE_MAGIC + struct.pack("<IH", BGCODE_VERSION, BGCODE_CHECKSUM_CRC32))
+        for block_type, metadata in ((BGCODE_BLOCK_PRINTER_METADATA, printer_metadata),
+                                     (BGCODE_BLOCK_PRINT_METADATA, print_metadata),
+                                     (BGCODE_BLOCK_SLICER_METADATA, slicer_metadata)):
+            ini = "".join(f"{key}={value}\n" for key, value in metadata.items()).encode()
+            self.write_block(block_type, BGCODE_ENCODING_INI, ini)
+        self.pending = []
+        self.pending_size = 0
+
+    def write_block(self, block_type, encoding, data):
+        compression = BGCODE_COMPRESSION_NONE
+        payload = data
+        if self.compress:
+            compressed = zlib.compress(data)
+            if len(compressed) < len(data):
+                compression = BGCODE_COMPRESSION_DEFLATE
+                payload = compressed
+        header = struct.pack("<HHI", block_type, compression, len(data))
+        if compression != BGCODE_COMPRESSION_NONE:
+            header += struct.pack("<I", len(payload))
+        block = header + struct.pack("<H", encoding) + payload
+        self.file.write(block + struct.pack("<I", zlib.crc32(block)))
+
+    def write_gcode_block(self, text):
+        data = text.encode()
+        if self.use_meatpack:
+            self.write_block(BGCODE_BLOCK_GCODE, BGCODE_ENCODING_MEATPACK,
+                             MEATPACK_ENABLE_PACKING + meatpack(data) + MEATPACK_DISABLE_PACKING)
+        else:
+            self.write_block(BGCODE_BLOCK_GCODE, BGCODE_ENCODING_NONE, data)
+
+    def write(self, text):
+        self.pending.append(text)
+        self.pending_size += len(text)
+        if self.pending_size < BGCODE_MAX_GCODE_BLOCK:
+            return
+        text = "".join(self.pending)
+        start = 0
+        while len(text) - start >= BGCODE_MAX_GCODE_BLOCK:
+            end = text.rfind("\n", start, start + BGCODE_MAX_GCODE_BLOCK) + 1
+            if end <= start: # a single line longer than a block
+                end = start + BGCODE_MAX_GCODE_BLOCK
+            self.write_gcode_block(text[start:end])
+            start = end
+        self.pending = [text[start:]]
+        self.pending_size = len(text) - start
+
+    def close(self):
+        text = "".join(self.pending)
+        if text:
+            self.write_gcode_block(text)
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# File extension of every output format
+FORMAT_EXTENSIONS = {
+    'TEXT': '.gcode',
+    'GZIP': '.gcode.gz',
+    'MEATPACK': '.gcode.mp',
+    'BGCODE': '.bgcode',
+}
+
+def with_extension(path, gcode_format):
+    "path with the file extension of gcode_format"
+    if gcode_format == 'TEXT':
+        if '.gcode' not in path: path += '.gcode'
+    else:
+        extension = FORMAT_EXTENSIONS[gcode_format]
+        if not path.endswith(extension):
+            if path.endswith('.gcode'):
+                path = path[:-len('.gcode')]
+            path += extension
+    return path
+
+def open_output(path, gcode_format, print_metadata):
+    "Writer for the g-code file in gcode_format"
+    if gcode_format == 'GZIP':
+        return open_gzip(path)
+    if gcode_format == 'MEATPACK':
+        return MeatPackWriter(path)
+    if gcode_format == 'BGCODE':
+        return BgcodeWriter(path, {'printer_model': '', 'filament_type': ''}, print_metadata,
+                            {'Producer': 'Spiralizer'})
+    return open_text(path)